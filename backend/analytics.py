@@ -0,0 +1,215 @@
+"""
+Buffered analytics for prediction impressions and acceptances
+/api/events only adds events to per-session, per-minute buckets held in
+memory. Once a bucket's minute is over, a background thread writes it as
+one document with insert_many, so Mongo writes scale with active writing
+sessions rather than keystrokes. Memory is bounded: when MAX_BUCKETS are
+open (e.g. Mongo is down and nothing drains), new events are dropped and
+counted, and clients are asked to back off before that point.
+"""
+
+import atexit
+import os
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from tracing import logger
+
+BUCKET_SECONDS = int(os.getenv("EVENTS_BUCKET_SECONDS", 60))
+FLUSH_SECONDS = float(os.getenv("EVENTS_FLUSH_SECONDS", 5))
+MAX_BUCKETS = int(os.getenv("EVENTS_MAX_BUCKETS", 20000))   # open session-minutes per worker
+RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", 90))
+MAX_BATCH = 200         # events taken from one request
+INSERT_BATCH = 500      # documents per insert_many
+BUSY_RATIO = 0.8        # past this share of MAX_BUCKETS clients are told to send less often
+BACKOFF_SECONDS = 30
+
+EVENT_TYPES = ("impression", "accept", "dismiss", "write")
+RANKS = frozenset(["1", "2", "3", "4", "5", "C1", "C2", "C3"])
+MAX_WORDS = 10000       # words written reported by one event
+PROVIDER = re.compile(r"[^a-z0-9_-]")
+DUPLICATE_KEY = 11000
+
+
+def _provider(value):
+    """Provider name safe to use as a field name"""
+    name = PROVIDER.sub("", str(value or "").lower())[:32]
+    return name or "unknown"
+
+
+class Bucket:
+    """Counts of one writing session over one BUCKET_SECONDS window"""
+
+    __slots__ = ("session_id", "user_id", "book_id", "start", "counts", "providers",
+                 "ranks", "personal", "words", "first", "last")
+
+    def __init__(self, session_id, user_id, book_id, start):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.book_id = book_id
+        self.start = start
+        self.counts = Counter()     # event type -> count
+        self.providers = {}         # event type -> Counter of providers
+        self.ranks = Counter()      # accepted rank -> count
+        self.personal = 0           # accepted words that came from the style index
+        self.words = 0              # words written
+        self.first = None
+        self.last = None
+
+    def add(self, event, now):
+        kind = event.get("type")
+        if kind not in EVENT_TYPES:
+            return False
+        self.counts[kind] += 1
+        if kind in ("impression", "accept"):
+            self.providers.setdefault(kind, Counter())[_provider(event.get("provider"))] += 1
+        if kind == "accept":
+            if str(event.get("rank")) in RANKS:
+                self.ranks[str(event["rank"])] += 1
+            if event.get("personal") is True:
+                self.personal += 1
+        if kind == "write":
+            words = event.get("words")
+            if isinstance(words, int) and not isinstance(words, bool):
+                self.words += max(0, min(words, MAX_WORDS))
+        self.first = self.first or now
+        self.last = now
+        return True
+
+    def events(self):
+        return sum(self.counts.values())
+
+    def to_doc(self):
+        return {
+            "sessionId": self.session_id,
+            "userId": self.user_id,
+            "bookId": self.book_id,
+            "bucket": datetime.fromtimestamp(self.start, timezone.utc),
+            "bucketSeconds": BUCKET_SECONDS,
+            "counts": dict(self.counts),
+            "providers": {kind: dict(c) for kind, c in self.providers.items()},
+            "acceptedRanks": dict(self.ranks),
+            "acceptedPersonal": self.personal,
+            "wordsWritten": self.words,
+            "firstAt": datetime.fromtimestamp(self.first, timezone.utc),
+            "lastAt": datetime.fromtimestamp(self.last, timezone.utc),
+        }
+
+
+class EventBuffer:
+    def __init__(self, events_collection, max_buckets=MAX_BUCKETS, flush_seconds=FLUSH_SECONDS):
+        self.events_collection = events_collection
+        self.max_buckets = max_buckets
+        self.flush_seconds = flush_seconds
+        self.buckets = {}   # (session_id, bucket start) -> Bucket
+        self.unsent = []    # documents of a failed insert, retried first
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stats = {"accepted": 0, "rejected": 0, "dropped": 0, "documents": 0, "flushes": 0, "failures": 0}
+        self.reported_drops = 0
+
+        events_collection.create_index([("userId", 1), ("bucket", -1)])
+        events_collection.create_index("bucket", expireAfterSeconds=RETENTION_DAYS * 86400)
+
+        threading.Thread(target=self._flush_loop, name="events-flush", daemon=True).start()
+        atexit.register(self.flush, force=True)
+
+    # ---------- ingestion ----------
+
+    def add(self, session_id, user_id, book_id, events, now=None):
+        """Count a batch of events; returns (accepted, rejected, dropped) without touching Mongo"""
+        now = now or time.time()
+        start = int(now // BUCKET_SECONDS * BUCKET_SECONDS)
+        overflow = max(0, len(events) - MAX_BATCH)
+        events = events[:MAX_BATCH]
+        accepted = rejected = 0
+        with self.lock:
+            key = (session_id, start)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) + len(self.unsent) >= self.max_buckets:
+                    self.stats["dropped"] += len(events) + overflow
+                    return 0, 0, len(events) + overflow
+                bucket = self.buckets[key] = Bucket(session_id, user_id, book_id, start)
+            for event in events:
+                if isinstance(event, dict) and bucket.add(event, now):
+                    accepted += 1
+                else:
+                    rejected += 1
+            if not bucket.events():
+                del self.buckets[key]
+            self.stats["accepted"] += accepted
+            self.stats["rejected"] += rejected
+            self.stats["dropped"] += overflow
+        return accepted, rejected, overflow
+
+    def busy(self):
+        """Nearly full: clients should batch more and send less often"""
+        return len(self.buckets) + len(self.unsent) >= self.max_buckets * BUSY_RATIO
+
+    def depth(self):
+        return len(self.buckets) + len(self.unsent)
+
+    # ---------- flushing ----------
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error flushing analytics events")
+
+    def flush(self, force=False):
+        """Insert buckets whose window has ended (all of them with force)"""
+        with self.flush_lock:
+            now = time.time()
+            with self.lock:
+                due = [key for key, bucket in self.buckets.items()
+                       if force or bucket.start + BUCKET_SECONDS <= now]
+                docs = self.unsent + [self.buckets.pop(key).to_doc() for key in due]
+                self.unsent = []
+                dropped = self.stats["dropped"] - self.reported_drops
+                self.reported_drops = self.stats["dropped"]
+            if dropped:
+                logger.warning("Analytics events dropped", extra={"fields": {"dropped": dropped}})
+
+            written = 0
+            retry = []
+            for i in range(0, len(docs), INSERT_BATCH):
+                batch = docs[i:i + INSERT_BATCH]
+                try:
+                    self.events_collection.insert_many(batch, ordered=False)
+                    written += len(batch)
+                except BulkWriteError as e:
+                    # insert_many set _id on every document: duplicates were written by an earlier try
+                    failed = {err["index"] for err in e.details.get("writeErrors", [])
+                              if err.get("code") != DUPLICATE_KEY}
+                    retry += [doc for j, doc in enumerate(batch) if j in failed]
+                    written += len(batch) - len(failed)
+                except PyMongoError as e:
+                    retry += docs[i:]
+                    logger.warning("Analytics flush failed, retrying",
+                                   extra={"fields": {"pending": len(retry), "error": str(e)}})
+                    break
+            if retry:
+                with self.lock:
+                    self.stats["failures"] += 1
+                    self.unsent = retry + self.unsent
+                    # Still bounded while Mongo is away: the oldest documents go first
+                    while len(self.unsent) > self.max_buckets:
+                        self.stats["dropped"] += sum(self.unsent.pop(0)["counts"].values())
+            with self.lock:
+                self.stats["documents"] += written
+                if docs:
+                    self.stats["flushes"] += 1
+            return written
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, openBuckets=len(self.buckets), unsent=len(self.unsent))
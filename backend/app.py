@@ -3,16 +3,42 @@ Flask Backend for Next Word Prediction App
 Handles user registration with MongoDB and Clerk authentication
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from flask_mail import Mail, Message
+from flask_sock import Sock
+from werkzeug.middleware.proxy_fix import ProxyFix
 from pymongo import MongoClient
 from bson import ObjectId
 from datetime import datetime, timezone
 import os
+import hmac
+import hashlib
 from dotenv import load_dotenv
 import base64
-import cohere
+import tracing
+import profiling
+import serializers
+import collab
+import autosave
+import summaries
+import exporters
+import importers
+import personalization
+import retrieval
+import ratelimit
+import providers
+import changes
+import invalidation
+import jobs
+import analytics
+import health
+import ingest
+import repositories
+import warmcache
+import gridfs
+from serializers import serialize_book, serialize_book_summary
+from tracing import logger, span
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,9 +46,33 @@ load_dotenv()
 # Initialize Flask app
 app = Flask(__name__)
 
+# orjson-backed JSON provider with native datetime/ObjectId handling
+serializers.init_app(app)
+
 # Enable CORS to allow frontend requests from React app
 CORS(app, origins=["http://localhost:5173", "http://localhost:5174", "http://localhost:3000"])
 
+# Behind a reverse proxy, trust this many X-Forwarded-For hops for client IPs
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+# Per-request trace IDs and span timing (see tracing.py)
+tracing.init_app(app)
+
+# On-demand sampling profiler (admin endpoint / SIGUSR2, see profiling.py)
+profiling.init_app(app, ignore_endpoints={"start_profile", "get_profile"})
+
+# Per-endpoint body limits, checked before the body is read; book saves stream (see ingest.py)
+ingest.init_app(app, {
+    "create_book": ingest.BOOK_LIMIT,
+    "update_book": ingest.BOOK_LIMIT,
+    "bulk_books": ingest.BOOK_LIMIT,
+    "predict_next_words": ingest.BOOK_LIMIT,
+    "import_books": ingest.IMPORT_LIMIT,
+    "record_events": ingest.EVENTS_LIMIT,
+}, streaming=["create_book", "update_book", "import_books"])
+
 # Flask-Mail configuration
 app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
 app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
@@ -34,14 +84,35 @@ app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER', os.getenv('
 
 mail = Mail(app)
 
+# WebSocket support for the collaborative editing channel
+sock = Sock(app)
+
 # MongoDB connection using environment variable
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "next_word_prediction")
 
+# Connection pool use, reported by /readyz
+mongo_pool = health.PoolMonitor()
+mongo_error = None
+
+# Set in the MongoDB block below; stay None when the connection fails, so
+# predictions keep working without personalization, retrieval or analytics
+style_indexer = None
+passage_indexer = None
+event_buffer = None
+job_queue = None
+user_cache = None
+invalidation_bus = None
+
 # Initialize MongoDB client
 try:
     # Connect with serverSelectionTimeoutMS to fail fast if connection issues
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+    # Every Mongo command is recorded as a span under the active request
+    client = MongoClient(
+        MONGO_URI,
+        serverSelectionTimeoutMS=5000,
+        event_listeners=[tracing.MongoSpanListener(), mongo_pool]
+    )
     
     # Force connection test by calling server_info()
     client.server_info()
@@ -49,15 +120,79 @@ try:
     db = client[DB_NAME]
     users_collection = db["users"]
     books_collection = db["books"]
+    summaries_collection = db["summaries"]
+    styles_collection = db["style_indexes"]
+    tombstones_collection = db["book_tombstones"]
     
-    # Create index on clerkUserId for faster lookups (if doesn't exist)
-    users_collection.create_index("clerkUserId", unique=True)
-    books_collection.create_index("userId")
-    books_collection.create_index([("userId", 1), ("createdAt", -1)])
+    # Route handlers go through these (query shapes, projections, indexes; see repositories.py)
+    user_repository = repositories.MongoUserRepository(users_collection)
+    book_repository = repositories.MongoBookRepository(books_collection)
+    user_repository.ensure_indexes()
+    book_repository.ensure_indexes()
+
+    # Materialized per-user dashboard counts, kept current on every book write
+    summary_store = summaries.SummaryStore(books_collection, summaries_collection)
+
+    # Open collaborative editing rooms, flushed to books_collection periodically
+    collab_hub = collab.CollabHub(books_collection, summary_store)
+
+    # Write-behind buffer for editor autosaves (replays crashed journals on startup)
+    autosave_buffer = autosave.AutosaveBuffer(books_collection, summary_store)
+
+    # Per-user vocabulary/name tables used to personalize predictions
+    style_indexer = personalization.StyleIndexer(books_collection, styles_collection)
+
+    # Hashed TF-IDF over each open book's paragraphs, for relevant earlier passages in prompts
+    passage_indexer = retrieval.PassageIndexer(books_collection)
+
+    # "Changes since" feed for incremental library sync (adds the (userId, updatedAt) index)
+    change_feed = changes.ChangeFeed(books_collection, tombstones_collection,
+                                     write_delay=autosave_buffer.write_delay)
+
+    # Evict this worker's caches when any worker or instance writes (change streams, else polling)
+    user_cache = invalidation.LocalCache()
+    invalidation_bus = invalidation.InvalidationBus([
+        invalidation.Source("books", books_collection, ["userId"], "updatedAt"),
+        invalidation.Source("book_tombstones", tombstones_collection, ["userId", "bookId"], "deletedAt", "delete"),
+        invalidation.Source("users", users_collection, ["clerkUserId"], "updatedAt"),
+    ])
+
+    def on_book_change(change):
+        if change.reset:
+            style_indexer.invalidate_all()
+            passage_indexer.invalidate_all()
+            exporters.export_cache.clear()
+            return
+        style_indexer.invalidate(change.doc.get("userId"))
+        passage_indexer.invalidate(change.doc.get("bookId", change.id))
+        exporters.export_cache.evict_book(change.doc.get("bookId", change.id))
+
+    def on_user_change(change):
+        if change.doc.get("clerkUserId"):
+            user_cache.evict(change.doc["clerkUserId"])
+        else:
+            user_cache.clear()
+
+    invalidation_bus.subscribe("books", on_book_change)
+    invalidation_bus.subscribe("book_tombstones", on_book_change)
+    invalidation_bus.subscribe("users", on_user_change)
+    invalidation_bus.start()
+
+    # Suggestion impressions/acceptances, counted in memory and inserted per session-minute
+    event_buffer = analytics.EventBuffer(db["events"])
+
+    # Background jobs (exports, summary rebuilds); see jobs.py for dedicated runners
+    job_queue = jobs.JobQueue(db["jobs"])
+    job_files = gridfs.GridFSBucket(db, bucket_name=jobs.FILES_BUCKET)
+    if jobs.RUNNER != "off":
+        # Process pool unless JOB_RUNNER=thread opts into threads in this worker
+        job_runner = jobs.JobRunner(job_queue, db,
+                                    processes=0 if jobs.RUNNER == "thread" else max(jobs.PROCESSES, 1)).start()
     
     print("✅ Connected to MongoDB successfully!")
     print(f"📁 Database: {DB_NAME}")
 except Exception as e:
+    mongo_error = str(e)
     print(f"❌ MongoDB connection error: {e}")
     print("Please check your MONGO_URI in .env file")
 
@@ -71,6 +206,82 @@ def home():
     })
 
 
+# ==================== HEALTH ENDPOINTS ====================
+
+def mongo_check():
+    if mongo_error:
+        return {"ok": False, "error": f"Not connected at startup: {mongo_error}"}
+    return health.mongo_probe(client, mongo_pool)
+
+
+def predictions_check():
+    return dict(health.predictions_probe(prediction_engine, upstream_stats),
+                warmCache=warm_table.snapshot())
+
+
+def queues_check():
+    """Depths of this worker's write-behind buffers and of the shared job queue"""
+    if mongo_error:
+        return {"ok": False, "error": "MongoDB unavailable"}
+    runner = globals().get("job_runner")
+    return {
+        "ok": True,
+        "degraded": event_buffer.busy(),
+        "autosavePending": autosave_buffer.depth(),
+        "events": event_buffer.snapshot(),
+        "jobsQueued": job_queue.collection.count_documents({"status": "queued"}),
+        "jobsRunning": len(runner.running) if runner else None,
+        "jobSlots": runner.slots if runner else None,
+        "collabRooms": len(collab_hub.rooms),
+    }
+
+
+def invalidation_check():
+    """Stale caches are a correctness risk but not a reason to stop serving"""
+    if mongo_error:
+        return {"ok": False, "error": "MongoDB unavailable"}
+    sources = invalidation_bus.snapshot()
+    return {
+        "ok": True,
+        "degraded": any(source["error"] for source in sources.values()),
+        "sources": sources,
+    }
+
+
+health_checker = health.HealthChecker({
+    "mongo": mongo_check,
+    "predictions": predictions_check,
+    "queues": queues_check,
+    "invalidation": invalidation_check,
+})
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Liveness: the process is up and serving requests
+    Deliberately checks no dependencies, so an outage doesn't restart every worker
+    """
+    return jsonify({
+        "status": "success",
+        "message": "alive",
+        **health.liveness()
+    }), 200
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """
+    Readiness: 200 when MongoDB answers and predictions can be served, else 503
+    Probe results are cached for HEALTH_CACHE_SECONDS
+    """
+    result = health_checker.check()
+    return jsonify({
+        "status": "success" if result["ready"] else "error",
+        **result
+    }), 200 if result["ready"] else 503
+
+
 @app.route("/api/contact", methods=["POST"])
 def send_contact_email():
     """
@@ -200,7 +411,7 @@ def register_user():
             }), 400
         
         # Check if user already exists in database
-        existing_user = users_collection.find_one({"clerkUserId": clerk_user_id})
+        existing_user = user_repository.get(clerk_user_id)
         
         if existing_user:
             # User already exists, return success (for login flow)
@@ -226,9 +437,9 @@ def register_user():
         }
         
         # Insert user into MongoDB
-        result = users_collection.insert_one(new_user)
+        inserted_id = user_repository.insert(new_user)
         
-        if result.inserted_id:
+        if inserted_id:
             return jsonify({
                 "status": "success",
                 "message": "User registered successfully",
@@ -260,18 +471,23 @@ def get_user(clerk_user_id):
     Used to fetch user data on dashboard
     """
     try:
-        user = users_collection.find_one({"clerkUserId": clerk_user_id})
-        
-        if user:
-            return jsonify({
-                "status": "success",
-                "user": {
+        profile = user_cache.get(clerk_user_id)
+        if profile is None:
+            user = user_repository.get(clerk_user_id)
+            if user:
+                profile = {
                     "clerkUserId": user["clerkUserId"],
                     "email": user["email"],
                     "username": user.get("username"),
                     "fullName": user.get("fullName"),
                     "createdAt": user["createdAt"].isoformat() if user.get("createdAt") else None
                 }
+                user_cache.put(clerk_user_id, profile)
+        
+        if profile:
+            return jsonify({
+                "status": "success",
+                "user": profile
             }), 200
         else:
             return jsonify({
@@ -287,6 +503,52 @@ def get_user(clerk_user_id):
         }), 500
 
 
+@app.route("/api/users/<clerk_user_id>/summary/rebuild", methods=["POST"])
+def rebuild_user_summary(clerk_user_id):
+    """
+    Recompute a user's dashboard counts from their books in the background
+    Returns 202 with the job to poll at /api/jobs/<job_id>
+    """
+    try:
+        job = job_queue.enqueue(
+            "summary.rebuild", {"userId": clerk_user_id},
+            user_id=clerk_user_id,
+            priority=jobs.PRIORITY_BACKGROUND,
+            dedupe_key=f"summary:{clerk_user_id}"
+        )
+        return job_accepted(job)
+
+    except Exception as e:
+        print(f"Error queueing summary rebuild: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
+@app.route("/api/users/<clerk_user_id>/summary", methods=["GET"])
+def get_user_summary(clerk_user_id):
+    """
+    Get dashboard counts for a user
+    Total/active books, words, favorites, archived, per-genre and per-status
+    counts, served from the user's materialized summary document
+    """
+    try:
+        summary = summary_store.get(clerk_user_id)
+
+        return jsonify({
+            "status": "success",
+            "summary": summaries.format_summary(summary)
+        }), 200
+
+    except Exception as e:
+        print(f"Error fetching summary: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
 # ==================== BOOK/DOCUMENT ENDPOINTS ====================
 
 @app.route("/api/books", methods=["POST"])
@@ -295,9 +557,10 @@ def create_book():
     Create a new book/document
     Requires: userId, title
     Optional: description, coverImage (base64), genre
+    Large bodies (covers) are parsed off the request stream
     """
     try:
-        data = request.get_json()
+        data = ingest.read_json()
         
         if not data:
             return jsonify({
@@ -322,6 +585,7 @@ def create_book():
             "coverImage": data.get("coverImage", ""),  # Base64 or URL
             "genre": data.get("genre", ""),
             "content": "",  # Will be updated in editor
+            "contentPreview": "",
             "wordCount": 0,
             "status": "draft",
             "isFavorite": False,
@@ -330,14 +594,15 @@ def create_book():
             "updatedAt": datetime.now(timezone.utc)
         }
         
-        result = books_collection.insert_one(new_book)
+        book_id = book_repository.insert(new_book)
         
-        if result.inserted_id:
+        if book_id:
+            summary_store.record_change(None, new_book)
             return jsonify({
                 "status": "success",
                 "message": "Book created successfully",
                 "book": {
-                    "id": str(result.inserted_id),
+                    "id": book_id,
                     "title": new_book["title"],
                     "description": new_book["description"],
                     "coverImage": new_book["coverImage"],
@@ -352,6 +617,13 @@ def create_book():
                 "message": "Failed to create book"
             }), 500
             
+    except ingest.BodyTooLarge as e:
+        return ingest.too_large(e.limit)
+    except ingest.MalformedBody as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid JSON body: {e}"
+        }), 400
     except Exception as e:
         print(f"Error creating book: {e}")
         return jsonify({
@@ -360,6 +632,31 @@ def create_book():
         }), 500
 
 
+def book_filters(args):
+    """
+    Library listing filters from request args
+    Supports filtering by status, genre, favorites, archived
+    """
+    filters = {}
+    if args.get("status"):
+        filters["status"] = args["status"]
+    if args.get("genre"):
+        filters["genre"] = args["genre"]
+    if args.get("favorite") == "true":
+        filters["is_favorite"] = True
+    if args.get("archived") == "true":
+        filters["is_archived"] = True
+    elif args.get("archived") == "false":
+        filters["is_archived"] = False
+    return filters
+
+
+def list_user_books(user_id, args):
+    """Formatted library listing, sorted by updatedAt descending"""
+    books = book_repository.list_for_user(user_id, **book_filters(args))
+    return [serialize_book_summary(autosave_buffer.overlay(book)) for book in books]
+
+
 @app.route("/api/books/user/<user_id>", methods=["GET"])
 def get_user_books(user_id):
     """
@@ -367,48 +664,15 @@ def get_user_books(user_id):
     Supports filtering by status, favorites, archived
     """
     try:
-        # Build query
-        query = {"userId": user_id}
-        
-        # Optional filters
-        status = request.args.get("status")
-        is_favorite = request.args.get("favorite")
-        is_archived = request.args.get("archived")
-        
-        if status:
-            query["status"] = status
-        if is_favorite == "true":
-            query["isFavorite"] = True
-        if is_archived == "true":
-            query["isArchived"] = True
-        elif is_archived == "false":
-            query["isArchived"] = False
-        
-        # Get books sorted by updatedAt descending
-        books = list(books_collection.find(query).sort("updatedAt", -1))
-        
-        # Format response
-        formatted_books = []
-        for book in books:
-            formatted_books.append({
-                "id": str(book["_id"]),
-                "title": book["title"],
-                "description": book.get("description", ""),
-                "coverImage": book.get("coverImage", ""),
-                "genre": book.get("genre", ""),
-                "content": book.get("content", "")[:100] + "..." if book.get("content") else "",
-                "wordCount": book.get("wordCount", 0),
-                "status": book.get("status", "draft"),
-                "isFavorite": book.get("isFavorite", False),
-                "isArchived": book.get("isArchived", False),
-                "createdAt": book["createdAt"].isoformat() if book.get("createdAt") else None,
-                "updatedAt": book["updatedAt"].isoformat() if book.get("updatedAt") else None
-            })
-        
+        # Taken before the read so writes racing with it show up in the next sync
+        sync_token = change_feed.current_token()
+        formatted_books = list_user_books(user_id, request.args)
+
         return jsonify({
             "status": "success",
             "books": formatted_books,
-            "count": len(formatted_books)
+            "count": len(formatted_books),
+            "syncToken": sync_token
         }), 200
         
     except Exception as e:
@@ -419,32 +683,64 @@ def get_user_books(user_id):
         }), 500
 
 
+@app.route("/api/books/changes", methods=["GET"])
+def get_book_changes():
+    """
+    Books created, updated or deleted since a sync token
+    Requires: userId, since (syncToken from a previous listing or sync)
+    Changed books are returned unfiltered; reset=true means the token is
+    missing, expired or too far behind and the client should reload its list
+    """
+    try:
+        user_id = request.args.get("userId")
+        token = request.args.get("since")
+
+        if not user_id:
+            return jsonify({
+                "status": "error",
+                "message": "User ID is required"
+            }), 400
+
+        try:
+            since = changes.decode_token(token) if token else None
+        except ValueError:
+            return jsonify({
+                "status": "error",
+                "message": "Invalid sync token"
+            }), 400
+
+        books, deleted, sync_token, reset = change_feed.changes_since(user_id, since)
+        formatted_books = [serialize_book_summary(autosave_buffer.overlay(book)) for book in books]
+
+        return jsonify({
+            "status": "success",
+            "books": formatted_books,
+            "deleted": deleted,
+            "count": len(formatted_books),
+            "reset": reset,
+            "syncToken": sync_token
+        }), 200
+
+    except Exception as e:
+        print(f"Error fetching book changes: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
 @app.route("/api/books/<book_id>", methods=["GET"])
 def get_book(book_id):
     """
     Get a single book by ID
     """
     try:
-        book = books_collection.find_one({"_id": ObjectId(book_id)})
+        book = autosave_buffer.overlay(book_repository.get(book_id))
         
         if book:
             return jsonify({
                 "status": "success",
-                "book": {
-                    "id": str(book["_id"]),
-                    "userId": book["userId"],
-                    "title": book["title"],
-                    "description": book.get("description", ""),
-                    "coverImage": book.get("coverImage", ""),
-                    "genre": book.get("genre", ""),
-                    "content": book.get("content", ""),
-                    "wordCount": book.get("wordCount", 0),
-                    "status": book.get("status", "draft"),
-                    "isFavorite": book.get("isFavorite", False),
-                    "isArchived": book.get("isArchived", False),
-                    "createdAt": book["createdAt"].isoformat() if book.get("createdAt") else None,
-                    "updatedAt": book["updatedAt"].isoformat() if book.get("updatedAt") else None
-                }
+                "book": serialize_book(book)
             }), 200
         else:
             return jsonify({
@@ -464,9 +760,10 @@ def get_book(book_id):
 def update_book(book_id):
     """
     Update a book's content or metadata
+    Large bodies (whole manuscripts) are parsed off the request stream
     """
     try:
-        data = request.get_json()
+        data = ingest.read_json()
         
         if not data:
             return jsonify({
@@ -474,6 +771,20 @@ def update_book(book_id):
                 "message": "No data provided"
             }), 400
         
+        # Editor autosaves (?autosave=true) that only carry content/wordCount
+        # are acknowledged from the write-behind buffer and flushed later
+        buffered = {f: data[f] for f in autosave.BUFFERED_FIELDS if f in data}
+        if "wordCount" in buffered:
+            buffered["wordCount"] = summaries.word_count(buffered["wordCount"])
+        if (request.args.get("autosave") == "true" and buffered
+                and len(buffered) == len(data) and not collab_hub.get(book_id)):
+            ObjectId(book_id)  # Reject malformed IDs before acknowledging
+            autosave_buffer.submit(book_id, buffered)
+            return jsonify({
+                "status": "success",
+                "message": "Autosave accepted"
+            }), 202
+
         # Build update document
         update_data = {"updatedAt": datetime.now(timezone.utc)}
         
@@ -484,13 +795,41 @@ def update_book(book_id):
         for field in updatable_fields:
             if field in data:
                 update_data[field] = data[field]
+        if "wordCount" in update_data:
+            update_data["wordCount"] = summaries.word_count(update_data["wordCount"])
+
+        # A direct write takes over any buffered autosave: it carries the
+        # buffered content/wordCount along, unless it sets either itself
+        # (content and its word count only ever go together)
+        carried = autosave_buffer.take(book_id)
+        if not set(carried) & set(update_data):
+            update_data.update(carried)
+
+        update_doc = {"$set": update_data}
+        if "content" in update_data:
+            update_data["contentPreview"] = summaries.content_preview(update_data["content"])
+            room = collab_hub.get(book_id)
+            if room:
+                # Keep live editing sessions in step with the saved content
+                revision, ops = room.replace(update_data["content"], update_data.get("wordCount"))
+                room.broadcast({"type": "op", "revision": revision, "ops": ops, "clientId": None})
+                update_data["revision"] = revision
+            else:
+                update_doc["$inc"] = {"revision": 1}
+
+        # Returns the summary fields as they were before the write
+        try:
+            before = book_repository.update(book_id, update_doc)
+        except Exception:
+            if carried:
+                autosave_buffer.submit(book_id, carried)  # acknowledged earlier: keep it for the next flush
+            raise
         
-        result = books_collection.update_one(
-            {"_id": ObjectId(book_id)},
-            {"$set": update_data}
-        )
-        
-        if result.modified_count > 0:
+        if before:
+            summary_store.record_change(before, dict(before, **update_data))
+            if "content" in update_data:
+                style_indexer.invalidate(before.get("userId"))
+                passage_indexer.invalidate(book_id)
             return jsonify({
                 "status": "success",
                 "message": "Book updated successfully"
@@ -498,9 +837,16 @@ def update_book(book_id):
         else:
             return jsonify({
                 "status": "error",
-                "message": "Book not found or no changes made"
+                "message": "Book not found"
             }), 404
             
+    except ingest.BodyTooLarge as e:
+        return ingest.too_large(e.limit)
+    except ingest.MalformedBody as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Invalid JSON body: {e}"
+        }), 400
     except Exception as e:
         print(f"Error updating book: {e}")
         return jsonify({
@@ -515,9 +861,13 @@ def delete_book(book_id):
     Delete a book
     """
     try:
-        result = books_collection.delete_one({"_id": ObjectId(book_id)})
+        before = book_repository.delete(book_id)
+        autosave_buffer.discard(book_id)
         
-        if result.deleted_count > 0:
+        if before:
+            summary_store.record_change(before, None)
+            style_indexer.invalidate(before.get("userId"))
+            change_feed.record_deletes(before.get("userId"), [book_id])
             return jsonify({
                 "status": "success",
                 "message": "Book deleted successfully"
@@ -536,31 +886,467 @@ def delete_book(book_id):
         }), 500
 
 
+@app.route("/api/books/<book_id>/export", methods=["GET"])
+def export_book(book_id):
+    """
+    Export a book as a file
+    Requires: format (txt, md, epub, docx)
+    Streams the document; unchanged books are served from the export cache
+    """
+    try:
+        fmt = exporters.normalize_format(request.args.get("format"))
+
+        if not fmt:
+            return jsonify({
+                "status": "error",
+                "message": "format must be one of: " + ", ".join(exporters.FORMATS)
+            }), 400
+
+        book = autosave_buffer.overlay(book_repository.get(book_id, repositories.EXPORT_PROJECTION))
+
+        if not book:
+            return jsonify({
+                "status": "error",
+                "message": "Book not found"
+            }), 404
+
+        key = exporters.cache_key(book, fmt)
+        etag = hashlib.sha1(repr(key).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            return Response(status=304)
+
+        content_type = exporters.FORMATS[fmt][0]
+        headers = {
+            "Content-Disposition": f'attachment; filename="{exporters.export_filename(book, fmt)}"',
+            "ETag": f'"{etag}"'
+        }
+
+        cached = exporters.export_cache.get(key)
+        if cached is not None:
+            return Response(cached, content_type=content_type, headers=headers)
+
+        body = exporters.export_cache.tee(key, exporters.stream_export(book, fmt))
+        return Response(stream_with_context(body), content_type=content_type, headers=headers)
+
+    except Exception as e:
+        print(f"Error exporting book: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
+@app.route("/api/books/<book_id>/export", methods=["POST"])
+def queue_book_export(book_id):
+    """
+    Render a book export in the background
+    Requires: format (txt, md, epub, docx), in the query string or JSON body
+    Returns 202 with the job; download the file from /api/jobs/<job_id>/download
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        fmt = exporters.normalize_format(request.args.get("format") or data.get("format"))
+
+        if not fmt:
+            return jsonify({
+                "status": "error",
+                "message": "format must be one of: " + ", ".join(exporters.FORMATS)
+            }), 400
+
+        # The job reads the book from Mongo, so write out this worker's buffered autosaves first
+        autosave_buffer.flush(force=True, book_ids={book_id})
+        book = book_repository.get(book_id, repositories.JOB_PROJECTION)
+
+        if not book:
+            return jsonify({
+                "status": "error",
+                "message": "Book not found"
+            }), 404
+
+        job = job_queue.enqueue(
+            "export", {"bookId": book_id, "format": fmt},
+            user_id=book.get("userId"),
+            priority=jobs.PRIORITY_INTERACTIVE,
+            dedupe_key=":".join(map(str, ("export",) + exporters.cache_key(book, fmt)))
+        )
+        return job_accepted(job)
+
+    except Exception as e:
+        print(f"Error queueing export: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
+@app.route("/api/books/import", methods=["POST"])
+def import_books():
+    """
+    Import manuscripts from a multipart/form-data upload
+    Requires: userId (query string, or a form field sent before the files),
+    one or more .txt, .md, .docx or .zip files
+    Optional: genre
+    Streams newline-delimited JSON progress events while the upload is read
+    """
+    try:
+        boundary = importers.multipart_boundary(request.content_type)
+
+        if not boundary:
+            return jsonify({
+                "status": "error",
+                "message": "Expected a multipart/form-data upload"
+            }), 400
+
+        importer = importers.BookImporter(
+            books_collection,
+            summary_store,
+            user_id=request.args.get("userId"),
+            genre=request.args.get("genre", "")
+        )
+        events = importers.import_multipart(request.stream, boundary, importer,
+                                            total_bytes=request.content_length,
+                                            max_bytes=ingest.IMPORT_LIMIT)
+
+        def generate():
+            try:
+                for event in events:
+                    yield app.json.dumps(event) + "\n"
+                style_indexer.invalidate(importer.user_id)
+            except Exception as e:
+                print(f"Error importing books: {e}")
+                yield app.json.dumps({"event": "error", "status": "error",
+                                      "message": "Internal server error"}) + "\n"
+
+        return Response(stream_with_context(generate()), content_type="application/x-ndjson")
+
+    except Exception as e:
+        print(f"Error importing books: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
+@sock.route("/ws/books/<book_id>")
+def book_channel(ws, book_id):
+    """
+    Collaborative editing channel for a book
+    Exchanges insert/delete operations against the current revision,
+    see collab.py for the message format
+    """
+    try:
+        ObjectId(book_id)
+    except Exception:
+        ws.send('{"type": "error", "message": "Invalid book ID"}')
+        return
+    # The room starts from Mongo and its flushes would supersede a buffered autosave
+    autosave_buffer.flush(force=True, book_ids={book_id})
+    collab.handle_session(collab_hub, ws, book_id)
+
+
+# Metadata fields that bulk operations may change (content goes through PUT)
+BULK_UPDATABLE_FIELDS = ["title", "description", "coverImage", "genre",
+                         "status", "isFavorite", "isArchived"]
+BULK_MAX_OPERATIONS = 500
+
+
+@app.route("/api/books/bulk", methods=["POST"])
+def bulk_books():
+    """
+    Update or delete several of a user's books in one round trip
+    Requires: userId, operations [{op: "update" | "delete", id, fields}]
+    Optional: ordered (default true) - stop at the first failing operation
+    Query params filter the returned list like /api/books/user/<user_id>
+    """
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({
+                "status": "error",
+                "message": "No data provided"
+            }), 400
+
+        user_id = data.get("userId")
+        operations = data.get("operations")
+        ordered = data.get("ordered", True) is not False
+
+        if not user_id or not isinstance(operations, list) or not operations:
+            return jsonify({
+                "status": "error",
+                "message": "User ID and operations are required"
+            }), 400
+
+        if len(operations) > BULK_MAX_OPERATIONS:
+            return jsonify({
+                "status": "error",
+                "message": f"At most {BULK_MAX_OPERATIONS} operations per request"
+            }), 400
+
+        now = datetime.now(timezone.utc)
+        results = [None] * len(operations)
+        pending = []  # (index, ObjectId, op, updated fields)
+
+        for i, item in enumerate(operations):
+            item = item if isinstance(item, dict) else {}
+            op = item.get("op")
+            results[i] = {"index": i, "id": item.get("id"), "op": op}
+            try:
+                _id = ObjectId(item.get("id"))
+            except Exception:
+                results[i].update(status="error", message="Invalid book ID")
+                if ordered:
+                    break
+                continue
+
+            if op == "delete":
+                pending.append((i, _id, op, None))
+            elif op == "update":
+                fields = {k: v for k, v in (item.get("fields") or {}).items()
+                          if k in BULK_UPDATABLE_FIELDS}
+                if not fields:
+                    results[i].update(status="error", message="No updatable fields")
+                    if ordered:
+                        break
+                    continue
+                fields["updatedAt"] = now
+                pending.append((i, _id, op, fields))
+            else:
+                results[i].update(status="error", message="Unknown operation")
+                if ordered:
+                    break
+
+        # One indexed read to report missing books per item (and feed the summary)
+        existing = {
+            book["_id"]: book for book in book_repository.summaries_for_user(
+                user_id, [_id for _, _id, _, _ in pending]
+            )
+        } if pending else {}
+
+        writes = []
+        for i, _id, op, fields in pending:
+            if _id in existing:
+                writes.append((i, _id, op, fields))
+            else:
+                results[i].update(status="not_found", message="Book not found")
+
+        # Buffered autosaves of updated books go first, or the newer updatedAt would supersede them
+        updated = {str(_id) for _, _id, op, _ in writes if op == "update"}
+        if updated:
+            autosave_buffer.flush(force=True, book_ids=updated)
+
+        failed = book_repository.bulk(user_id, [(op, _id, fields) for _, _id, op, fields in writes],
+                                      ordered=ordered)
+
+        stopped = False
+        deleted_ids = []
+        for position, (i, _id, op, fields) in enumerate(writes):
+            if stopped:
+                results[i].update(status="skipped")
+            elif position in failed:
+                results[i].update(status="error", message=failed[position])
+                stopped = ordered
+            else:
+                results[i]["status"] = "ok"
+                before = existing.get(_id)
+                after = dict(before, **fields) if before and fields else None
+                summary_store.record_change(before, after)
+                existing[_id] = after
+                if op == "delete":
+                    autosave_buffer.discard(results[i]["id"])
+                    deleted_ids.append(str(_id))
+        change_feed.record_deletes(user_id, deleted_ids)
+
+        # Anything after an ordered failure was never attempted
+        for i, item in enumerate(operations):
+            if results[i] is None:
+                item = item if isinstance(item, dict) else {}
+                results[i] = {"index": i, "id": item.get("id"), "op": item.get("op")}
+            results[i].setdefault("status", "skipped")
+
+        sync_token = change_feed.current_token()
+        formatted_books = list_user_books(user_id, request.args)
+
+        return jsonify({
+            "status": "success",
+            "results": results,
+            "errors": sum(1 for r in results if r["status"] in ("error", "not_found")),
+            "books": formatted_books,
+            "count": len(formatted_books),
+            "syncToken": sync_token
+        }), 200
+
+    except Exception as e:
+        print(f"Error running bulk book operations: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
+# ==================== JOB ENDPOINTS ====================
+
+def format_job(job):
+    """Public job fields plus a download link for finished exports"""
+    formatted = jobs.public_job(job)
+    if job.get("type") == "export" and job.get("status") == "succeeded":
+        formatted["downloadUrl"] = f"/api/jobs/{formatted['id']}/download"
+    return formatted
+
+
+def job_accepted(job):
+    """202 response for a queued (or already queued) job"""
+    response = jsonify({
+        "status": "success",
+        "message": "Job queued",
+        "job": format_job(job)
+    })
+    response.headers["Location"] = f"/api/jobs/{job['_id']}"
+    return response, 202
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """
+    Get the status of a background job
+    status: queued, running, succeeded or failed; result is set once it succeeded
+    """
+    try:
+        job = job_queue.get(job_id) if ObjectId.is_valid(job_id) else None
+
+        if not job:
+            return jsonify({
+                "status": "error",
+                "message": "Job not found"
+            }), 404
+
+        return jsonify({
+            "status": "success",
+            "job": format_job(job)
+        }), 200
+
+    except Exception as e:
+        print(f"Error fetching job: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
+@app.route("/api/jobs/<job_id>/download", methods=["GET"])
+def download_job_file(job_id):
+    """
+    Download the file produced by a finished export job
+    """
+    try:
+        job = job_queue.get(job_id) if ObjectId.is_valid(job_id) else None
+        result = (job or {}).get("result") or {}
+
+        if not job or job.get("status") != "succeeded" or not result.get("fileId"):
+            return jsonify({
+                "status": "error",
+                "message": "No file for this job"
+            }), 404
+
+        try:
+            stream = job_files.open_download_stream(ObjectId(result["fileId"]))
+        except gridfs.errors.NoFile:
+            return jsonify({
+                "status": "error",
+                "message": "File has expired"
+            }), 410
+
+        def chunks():
+            with stream:
+                while True:
+                    chunk = stream.readchunk()
+                    if not chunk:
+                        break
+                    yield chunk
+
+        headers = {
+            "Content-Disposition": f'attachment; filename="{result["filename"]}"',
+            "Content-Length": str(stream.length)
+        }
+        return Response(chunks(), content_type=result["contentType"], headers=headers)
+
+    except Exception as e:
+        print(f"Error downloading job file: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
 # ============================================
 # WORD PREDICTION API
 # ============================================
 
 # Initialize Cohere client
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
-co = cohere.ClientV2(api_key=COHERE_API_KEY) if COHERE_API_KEY else None
+
+# Cohere / local model / n-gram backends with latency-based routing (see providers.py)
+prediction_engine = providers.build_engine(COHERE_API_KEY)
+if not prediction_engine.providers:
+    logger.warning("No prediction model configured, serving n-gram fallbacks only",
+                   extra={"fields": {"fallbacks": [p.name for p in prediction_engine.fallbacks]}})
+
+# Per-genre predictions for openings, paragraph starts and dialogue tags (see warmcache.py)
+warm_table = warmcache.WarmTable.load()
+if len(warm_table):
+    print(f"🔥 Loaded {len(warm_table)} warm prediction contexts")
+
+# Per-user / per-IP token buckets and upstream model load tracking (see ratelimit.py)
+predict_limiter = ratelimit.RateLimiter()
+upstream_stats = ratelimit.UpstreamStats()
 
 @app.route("/api/predict", methods=["POST"])
 def predict_next_words():
     """
-    Predict next words using Cohere API
+    Predict next words using the fastest healthy prediction provider
     Returns 5 probable + 3 creative word predictions for literary writing
+    Optional: userId, to re-rank with the author's own style index, and
+    bookId, to quote relevant earlier passages of the book in the prompt
+    Openings, paragraph starts and dialogue tags found in the warm table
+    are answered without a model call (provider "warm")
+    Rate limited per user and IP (429 with Retry-After); responses carry
+    recommendedIntervalMs, the minimum gap clients should leave between calls
     """
     try:
-        if not co:
-            print("Cohere API key not configured")
+        if not prediction_engine.available():
+            logger.error("No prediction provider configured")
             return jsonify({
                 "status": "error",
-                "message": "Cohere API key not configured"
+                "message": "No prediction provider configured"
             }), 500
 
-        data = request.get_json()
-        text = data.get("text", "").strip()
-        genre = data.get("genre", "fiction").strip()
+        with span("predict.parse_request"):
+            data = request.get_json()
+            text = data.get("text", "").strip()
+            genre = data.get("genre", "fiction").strip()
+            style_index = style_indexer.get(data.get("userId")) if style_indexer else None
+
+        # Common short contexts are answered from the warm table without any model call
+        with span("predict.warm") as warm_span:
+            warm_key, warm_words = warm_table.lookup(genre, text)
+            if warm_key is not None:
+                warm_span.set("key", warm_key)
+                warm_span.set("genre", genre.lower())
+                warm_span.set("hit", warm_words is not None)
+
+        if warm_words:
+            predictions = personalization.personalize(
+                providers.format_predictions(warm_words), style_index, text
+            )
+            interval_ms = upstream_stats.recommended_interval_ms()
+            response = jsonify({
+                "status": "success",
+                "predictions": predictions,
+                "provider": "warm",
+                "recommendedIntervalMs": interval_ms
+            })
+            response.headers["X-Recommended-Interval-Ms"] = str(interval_ms)
+            return response, 200
 
         if not text:
             # Return default predictions for empty text
@@ -578,93 +1364,229 @@ def predict_next_words():
                 ]
             }), 200
 
-        # Extract last 30 words for context
-        words_list = text.split()
-        last_30_words = " ".join(words_list[-30:]) if len(words_list) > 30 else text
+        allowed, retry_after = predict_limiter.acquire(
+            ratelimit.predict_limits(data.get("userId"), request.remote_addr)
+        )
+        if not allowed:
+            interval_ms = upstream_stats.recommended_interval_ms()
+            response = jsonify({
+                "status": "error",
+                "message": "Too many prediction requests",
+                "retryAfter": round(retry_after, 2),
+                "recommendedIntervalMs": interval_ms
+            })
+            response.headers["Retry-After"] = ratelimit.retry_after_header(retry_after)
+            response.headers["X-Recommended-Interval-Ms"] = str(interval_ms)
+            return response, 429
 
-        prompt = f"""You are a literary-level predictive writing assistant trained to help professional novelists.
+        with span("predict.retrieve") as retrieve_span:
+            passages = []
+            if retrieval.BUDGET_TOKENS and passage_indexer:
+                book_index = passage_indexer.get(data.get("bookId"), data.get("userId"))
+                passages = book_index.search(text) if book_index else []
+            retrieve_span.set("passages", len(passages))
 
-You analyze narrative flow, pacing, emotional tone, and genre conventions before predicting the next words.
+        with span("predict.build_prompt"):
+            query = providers.build_query(text, genre, style_index, passages=passages)
 
-Genre: "{genre}"
+        try:
+            with upstream_stats.track():
+                words, provider_name = prediction_engine.predict(query)
+        except providers.ProviderError as e:
+            return jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 503
 
-Recent Context:
-"{last_30_words}"
+        with span("predict.format_response", provider=provider_name):
+            # Top up partial answers with n-gram guesses for this context
+            words = providers.fill_words(words, query)
 
-Return:
-- 5 highly probable next words
-- 3 creative alternative words
+            # Build predictions with types
+            predictions = providers.format_predictions(words)
 
-Format:
-comma-separated list only (8 words total, probable first then creative)
-lowercase only, no punctuation, no explanation"""
+            # Local re-ranking from the author's own manuscripts (no extra tokens)
+            predictions = personalization.personalize(predictions, style_index, query.text)
 
-        response = co.chat(
-            model="command-a-03-2025",
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
+        interval_ms = upstream_stats.recommended_interval_ms()
+        response = jsonify({
+            "status": "success",
+            "predictions": predictions,
+            "provider": provider_name,
+            "recommendedIntervalMs": interval_ms
+        })
+        response.headers["X-Recommended-Interval-Ms"] = str(interval_ms)
+        return response, 200
 
-        # Parse the response
-        generated_text = response.message.content[0].text.strip()
-        print(f"Cohere response: {generated_text}")
-        
-        # Extract words - split by comma and clean
-        import re
-        # First try comma-separated
-        if ',' in generated_text:
-            words = [w.strip().lower() for w in generated_text.split(',')]
-        else:
-            # Fallback to space-separated
-            words = generated_text.lower().split()
-        
-        # Clean words - remove any non-alphabetic characters
-        words = [re.sub(r'[^a-z]', '', w) for w in words]
-        words = [w for w in words if w]  # Remove empty strings
-        words = words[:8]  # Take only first 8
-
-        # Ensure we have exactly 8 words (pad with defaults if needed)
-        default_probable = ["and", "the", "to", "of", "a"]
-        default_creative = ["beneath", "whispered", "shadows"]
-        
-        while len(words) < 5:
-            words.append(default_probable[len(words)])
-        while len(words) < 8:
-            words.append(default_creative[len(words) - 5])
-
-        # Build predictions with types
-        predictions = []
-        for i, word in enumerate(words[:5]):
-            predictions.append({
-                "id": i + 1,
-                "word": word,
-                "rank": str(i + 1),
-                "type": "probable"
-            })
-        for i, word in enumerate(words[5:8]):
-            predictions.append({
-                "id": i + 6,
-                "word": word,
-                "rank": f"C{i + 1}",
-                "type": "creative"
-            })
+    except Exception as e:
+        logger.exception("Error predicting words")
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
+
+
+# ============================================
+# ANALYTICS EVENTS API
+# ============================================
+
+@app.route("/api/events", methods=["POST"])
+def record_events():
+    """
+    Record prediction impressions/acceptances and writing activity
+    Body: sessionId, events [{type: impression|accept|dismiss|write, ...}],
+    optional userId and bookId. Events are only counted in memory (written
+    per session-minute in the background), so this never waits on MongoDB
+    """
+    try:
+        # navigator.sendBeacon posts JSON as text/plain
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("events"), list):
+            return jsonify({
+                "status": "error",
+                "message": "events must be a list"
+            }), 400
+
+        session_id = str(data.get("sessionId") or "")[:64]
+        if not session_id:
+            return jsonify({
+                "status": "error",
+                "message": "sessionId is required"
+            }), 400
+
+        if event_buffer is None:
+            return jsonify({
+                "status": "error",
+                "message": "Analytics unavailable"
+            }), 503
+
+        user_id = str(data["userId"])[:64] if data.get("userId") else None
+        book_id = str(data["bookId"])[:64] if data.get("bookId") else None
+        accepted, rejected, dropped = event_buffer.add(session_id, user_id, book_id, data["events"])
+
+        body = {
+            "status": "success",
+            "accepted": accepted,
+            "rejected": rejected,
+            "dropped": dropped
+        }
+        busy = dropped or event_buffer.busy()
+        if busy:
+            body["retryAfter"] = analytics.BACKOFF_SECONDS
+        response = jsonify(body)
+        if busy:
+            response.headers["Retry-After"] = str(analytics.BACKOFF_SECONDS)
+        return response, 202
+
+    except Exception as e:
+        print(f"Error recording events: {e}")
+        return jsonify({
+            "status": "error",
+            "message": "Internal server error"
+        }), 500
+
+
+# ============================================
+# ADMIN ENDPOINTS
+# ============================================
+
+# Shared secret for admin endpoints; they are disabled when unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def is_admin_request():
+    """Check the X-Admin-Token header against ADMIN_TOKEN"""
+    if not ADMIN_TOKEN:
+        return False
+    token = request.headers.get("X-Admin-Token", "")
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+@app.route("/api/admin/profile", methods=["POST"])
+def start_profile():
+    """
+    Start a sampling profile + tracemalloc snapshot on this worker
+    Body: seconds (default 10) or requests, optional intervalMs,
+    wait=true to block until a seconds-bounded run finishes
+    """
+    if not is_admin_request():
+        return jsonify({
+            "status": "error",
+            "message": "Unauthorized"
+        }), 401
+
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            interval = float(data.get("intervalMs", 5)) / 1000
+            if not 0 < interval <= 1:
+                raise ValueError("intervalMs must be between 0 and 1000")
+            session = profiling.start_session(
+                seconds=data.get("seconds"),
+                requests=data.get("requests"),
+                interval=max(interval, 0.001)
+            )
+        except (TypeError, ValueError) as e:
+            return jsonify({
+                "status": "error",
+                "message": f"Invalid profiling options: {e}"
+            }), 400
+        if session is None:
+            return jsonify({
+                "status": "error",
+                "message": "A profiling session is already running"
+            }), 409
+
+        if data.get("wait") and session.seconds:
+            session.wait(session.seconds + 5)
+            return get_profile()
 
         return jsonify({
             "status": "success",
-            "predictions": predictions
-        }), 200
+            "message": "Profiling started",
+            "pid": os.getpid(),
+            "profile": session.summary()
+        }), 202
 
     except Exception as e:
-        print(f"Error predicting words: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error starting profiler")
         return jsonify({
             "status": "error",
-            "message": str(e)
+            "message": "Internal server error"
         }), 500
 
 
+@app.route("/api/admin/profile", methods=["GET"])
+def get_profile():
+    """
+    Get the latest profile from this worker
+    ?format=collapsed returns the raw collapsed stacks (for flamegraph.pl / speedscope)
+    """
+    if not is_admin_request():
+        return jsonify({
+            "status": "error",
+            "message": "Unauthorized"
+        }), 401
+
+    session = profiling.current_session()
+    if not session:
+        return jsonify({
+            "status": "error",
+            "message": "No profile has been recorded"
+        }), 404
+
+    if request.args.get("format") == "collapsed":
+        return Response(session.collapsed(), mimetype="text/plain")
+
+    return jsonify({
+        "status": "success",
+        "pid": os.getpid(),
+        "profile": session.summary(),
+        "collapsed": session.collapsed(),
+        "allocations": session.allocations
+    }), 200
+
+
 # Run the Flask app
 if __name__ == "__main__":
     # Get port from environment or default to 10000
@@ -0,0 +1,264 @@
+"""
+Write-behind buffer for editor autosaves
+Autosaves are acknowledged as soon as they are held in memory and
+appended to a local journal. A background thread writes only the latest
+state of each book to MongoDB once the writer goes idle (or a maximum
+delay passes), so Mongo writes scale with books rather than keystrokes.
+Journals left behind by a crashed worker are replayed on startup.
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from summaries import SUMMARY_PROJECTION, content_preview
+from tracing import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, assume a single process
+    fcntl = None
+
+JOURNAL_DIR = os.getenv("AUTOSAVE_JOURNAL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal"))
+IDLE_SECONDS = float(os.getenv("AUTOSAVE_IDLE_SECONDS", 10))
+MAX_DELAY_SECONDS = float(os.getenv("AUTOSAVE_MAX_DELAY_SECONDS", 30))
+FSYNC = os.getenv("AUTOSAVE_FSYNC", "False").lower() == "true"
+
+# Only these fields go through the buffer; anything else is written directly
+BUFFERED_FIELDS = ("content", "wordCount")
+
+
+def _utc(moment):
+    """Mongo hands dates back naive (in UTC); make them comparable with ours"""
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment
+
+
+def _flush_updates(books_collection, latest, summary_store=None):
+    """
+    Write {book_id: fields} to Mongo in one unordered bulk_write
+    Each update only applies while the stored updatedAt is older than the
+    buffered one, so a late flush or a replayed journal never overwrites a
+    newer save, collab or bulk write; superseded entries are skipped.
+    """
+    ids = {}
+    for book_id in latest:
+        try:
+            ids[book_id] = ObjectId(book_id)
+        except Exception:
+            continue
+    if not ids:
+        return 0
+
+    # Read the stored stamps (and the old word counts for the summaries) first
+    stored = {
+        str(book["_id"]): book
+        for book in books_collection.find({"_id": {"$in": list(ids.values())}},
+                                          dict(SUMMARY_PROJECTION, updatedAt=1))
+    }
+    requests = []
+    written = []
+    for book_id, _id in ids.items():
+        fields = latest[book_id]
+        stamp = fields.get("updatedAt")
+        book = stored.get(book_id)
+        if book is None or (stamp and book.get("updatedAt") and _utc(book["updatedAt"]) >= stamp):
+            continue
+        query = {"_id": _id}
+        if stamp:
+            # Checked again by Mongo in case a direct write lands meanwhile
+            query["updatedAt"] = {"$not": {"$gte": stamp}}
+        update = {"$set": fields}
+        if "content" in fields:
+            update["$set"] = dict(fields, contentPreview=content_preview(fields["content"]))
+            update["$inc"] = {"revision": 1}
+        requests.append(UpdateOne(query, update))
+        written.append(book_id)
+    if not requests:
+        return 0
+
+    books_collection.bulk_write(requests, ordered=False)
+    if summary_store:
+        for book_id in written:
+            book = stored[book_id]
+            book.pop("updatedAt", None)
+            summary_store.record_change(book, dict(book, **latest[book_id]))
+    return len(requests)
+
+
+class AutosaveBuffer:
+    def __init__(self, books_collection, summary_store=None, journal_dir=JOURNAL_DIR,
+                 idle_seconds=IDLE_SECONDS, max_delay_seconds=MAX_DELAY_SECONDS):
+        self.books_collection = books_collection
+        self.summary_store = summary_store
+        self.journal_dir = journal_dir
+        self.idle_seconds = idle_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.flush_interval = min(idle_seconds, max_delay_seconds) / 2 or 1
+        # Longest time between an autosave's updatedAt stamp and its Mongo write
+        self.write_delay = max_delay_seconds + self.flush_interval
+        self.pending = {}  # book_id -> {"fields": {...}, "first": t, "last": t}
+        self.lock = threading.Lock()
+        self.stats = {"accepted": 0, "flushedBooks": 0, "flushes": 0, "replayedBooks": 0}
+
+        os.makedirs(journal_dir, exist_ok=True)
+        # Unique per process start: a restarted worker that gets its old PID
+        # back must still replay that PID's journal instead of reusing it
+        self.journal_path = os.path.join(
+            journal_dir, f"autosave-{os.getpid()}-{int(time.time() * 1000):x}.jsonl")
+        self.replay_orphaned_journals()
+        self.journal = open(self.journal_path, "a", encoding="utf-8")
+        if fcntl:
+            fcntl.flock(self.journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        threading.Thread(target=self._flush_loop, name="autosave-flush", daemon=True).start()
+        atexit.register(self.flush, force=True)
+
+    # ---------- writes ----------
+
+    def submit(self, book_id, fields):
+        """Buffer an autosave; returns immediately once it is journaled"""
+        now = time.time()
+        stamp = datetime.now(timezone.utc)
+        # Mongo keeps milliseconds; compare flushes against what it will store
+        fields = dict(fields, updatedAt=stamp.replace(microsecond=stamp.microsecond // 1000 * 1000))
+        record = json.dumps({"bookId": book_id, "fields": fields, "ts": now}, default=str)
+        with self.lock:
+            self.journal.write(record + "\n")
+            self.journal.flush()
+            if FSYNC:
+                os.fsync(self.journal.fileno())
+            entry = self.pending.get(book_id)
+            if entry is None:
+                self.pending[book_id] = {"fields": fields, "first": now, "last": now}
+            else:
+                entry["fields"].update(fields)
+                entry["last"] = now
+            self.stats["accepted"] += 1
+
+    def discard(self, book_id):
+        """Drop a book's buffered autosave (the book was deleted)"""
+        with self.lock:
+            self.pending.pop(book_id, None)
+
+    def take(self, book_id):
+        """
+        Remove and return a book's buffered fields (without the stamp), for
+        a direct write to carry: a later flush of them would either be
+        skipped as older than that write or overwrite it
+        """
+        with self.lock:
+            entry = self.pending.pop(book_id, None)
+        if not entry:
+            return {}
+        return {f: v for f, v in entry["fields"].items() if f != "updatedAt"}
+
+    # ---------- reads ----------
+
+    def overlay(self, book):
+        """Apply buffered fields to a book document fetched from Mongo"""
+        if not self.pending or not book:
+            return book
+        entry = self.pending.get(str(book["_id"]))
+        if entry:
+            book.update(entry["fields"])
+            if "content" in entry["fields"]:
+                book["contentPreview"] = content_preview(entry["fields"]["content"])
+        return book
+
+    def depth(self):
+        return len(self.pending)
+
+    # ---------- flushing ----------
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error flushing autosave buffer")
+
+    def flush(self, force=False, book_ids=None):
+        """Write books that went idle (or waited too long) to Mongo"""
+        now = time.time()
+        with self.lock:
+            due = {
+                book_id: entry for book_id, entry in self.pending.items()
+                if (book_ids is None or book_id in book_ids) and (
+                    force
+                    or now - entry["last"] >= self.idle_seconds
+                    or now - entry["first"] >= self.max_delay_seconds
+                )
+            }
+            for book_id in due:
+                del self.pending[book_id]
+        if not due:
+            return 0
+
+        try:
+            count = _flush_updates(self.books_collection, {b: e["fields"] for b, e in due.items()},
+                                   self.summary_store)
+        except Exception:
+            # Put them back (newer autosaves win) and try again next round
+            with self.lock:
+                for book_id, entry in due.items():
+                    newer = self.pending.get(book_id)
+                    if newer:
+                        entry["fields"].update(newer["fields"])
+                        entry["last"] = newer["last"]
+                    self.pending[book_id] = entry
+            raise
+
+        with self.lock:
+            self.stats["flushes"] += 1
+            self.stats["flushedBooks"] += count
+            self._compact_journal()
+        return count
+
+    def _compact_journal(self):
+        """Rewrite the journal with only what is still pending (call with lock held)"""
+        self.journal.seek(0)
+        self.journal.truncate()
+        for book_id, entry in self.pending.items():
+            self.journal.write(json.dumps(
+                {"bookId": book_id, "fields": entry["fields"], "ts": entry["last"]}, default=str
+            ) + "\n")
+        self.journal.flush()
+        if FSYNC:
+            os.fsync(self.journal.fileno())
+
+    # ---------- recovery ----------
+
+    def replay_orphaned_journals(self):
+        """Flush journals of workers that died before writing them to Mongo"""
+        for path in glob.glob(os.path.join(self.journal_dir, "autosave-*.jsonl")):
+            if path == self.journal_path:
+                continue
+            with open(path, "r+", encoding="utf-8") as f:
+                if fcntl:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue  # Journal of a live worker
+                latest = {}
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn final line from the crash
+                    fields = record["fields"]
+                    if "updatedAt" in fields:
+                        fields["updatedAt"] = datetime.fromisoformat(fields["updatedAt"])
+                    latest.setdefault(record["bookId"], {}).update(fields)
+                if latest:
+                    count = _flush_updates(self.books_collection, latest, self.summary_store)
+                    self.stats["replayedBooks"] += count
+                    print(f"♻️  Replayed {count} autosaved book(s) from {os.path.basename(path)}")
+            os.remove(path)
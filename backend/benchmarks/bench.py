@@ -0,0 +1,425 @@
+"""
+Load-test and benchmark harness for the backend API
+Drives the routes in app.py at a configurable concurrency and reports
+throughput and p50/p95/p99 latency per route, saved as JSON so runs can
+be compared.
+
+Examples (run from backend/):
+    # In-process with mongomock + fake Cohere (no services needed)
+    python benchmarks/bench.py --in-process --mongomock -o results.json
+
+    # Against a running server (start it with CO_API_URL pointing at
+    # benchmarks/fake_cohere.py) and a local mongod
+    python benchmarks/bench.py --url http://localhost:5000 -c 32
+
+    # Compare with an earlier run
+    python benchmarks/bench.py --in-process --mongomock --compare results.json
+
+    # Route handlers on the in-memory repositories (book/user storage cost left out)
+    python benchmarks/bench.py --in-process --mongomock --repositories memory -s routes -s dashboard
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_cohere import start_fake_cohere  # noqa: E402
+
+LOREM = (
+    "The lantern swung in the wind as she climbed the last of the stairs, "
+    "counting the doors the way her mother had taught her, one for each "
+    "secret the house had kept. "
+)
+
+
+# ==================== TARGETS ====================
+
+class HttpTarget:
+    """Talks to a running server over keep-alive HTTP connections (one per thread)"""
+
+    def __init__(self, base_url):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.https = parsed.scheme == "https"
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = self.local.conn = cls(self.host, self.port, timeout=60)
+        return conn
+
+    def request(self, method, path, body=None):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        for attempt in range(2):
+            conn = self._conn()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                return resp.status, data
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+
+class InProcessTarget:
+    """Calls the Flask app through its test client, skipping the network"""
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        resp = client.open(path, method=method, data=body,
+                           content_type="application/json" if body is not None else None)
+        return resp.status_code, resp.get_data()
+
+
+def load_app(mongomock=False, repositories="mongo"):
+    """
+    Import app.py in this process, optionally backed by mongomock
+    repositories="memory" swaps the handlers' book/user repositories for
+    the in-memory ones; the rest of the app still needs (mock) MongoDB
+    """
+    if mongomock:
+        # Job processes would connect to a real MongoDB; run jobs on threads instead
+        os.environ.setdefault("JOB_RUNNER", "thread")
+        import mongomock as _mongomock
+        import mongomock.gridfs
+        import pymongo
+        pymongo.MongoClient = _mongomock.MongoClient
+        mongomock.gridfs.enable_gridfs_integration()  # export job files
+    sys.path.insert(0, BACKEND_DIR)
+    import app as backend_app
+    if repositories == "memory":
+        import repositories as repos
+        backend_app.book_repository = repos.MemoryBookRepository()
+        backend_app.user_repository = repos.MemoryUserRepository()
+    return backend_app.app
+
+
+# ==================== HELPERS ====================
+
+def encode(payload):
+    return json.dumps(payload).encode()
+
+
+def expect_json(status, data, label):
+    if status >= 400:
+        raise RuntimeError(f"{label} failed during setup ({status}): {data[:200]!r}")
+    return json.loads(data)
+
+
+def create_book(target, user_id, title, content=None):
+    status, data = target.request("POST", "/api/books", encode({
+        "userId": user_id, "title": title, "genre": "fantasy",
+        "description": "Benchmark book"
+    }))
+    book_id = expect_json(status, data, "create_book")["book"]["id"]
+    if content:
+        status, data = target.request("PUT", f"/api/books/{book_id}", encode({
+            "content": content, "wordCount": len(content.split())
+        }))
+        expect_json(status, data, "update_book")
+    return book_id
+
+
+def register_user(target):
+    user_id = f"bench_{uuid.uuid4().hex[:12]}"
+    status, data = target.request("POST", "/api/users/register", encode({
+        "clerkUserId": user_id, "email": f"{user_id}@bench.local", "fullName": "Bench User"
+    }))
+    expect_json(status, data, "register_user")
+    return user_id
+
+
+def manuscript(size_bytes):
+    return (LOREM * (size_bytes // len(LOREM) + 1))[:size_bytes]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+# ==================== SCENARIOS ====================
+# Each scenario does its setup and returns next_request(i) -> (label, method, path, body)
+
+def scenario_routes(target, args):
+    """Round-robin over every book/user/predict route"""
+    user_id = register_user(target)
+    book_id = create_book(target, user_id, "Routes benchmark", manuscript(20_000))
+    created = deque()
+    register_body = encode({"clerkUserId": user_id, "email": f"{user_id}@bench.local"})
+    predict_body = encode({"text": manuscript(400), "genre": "fantasy"})
+
+    def create(i):
+        return "POST /api/books", "POST", "/api/books", encode({
+            "userId": user_id, "title": f"Book {i}", "genre": "fantasy"
+        })
+
+    def delete(i):
+        try:
+            doomed = created.popleft()
+        except IndexError:
+            doomed = "000000000000000000000000"
+        return "DELETE /api/books/<id>", "DELETE", f"/api/books/{doomed}", None
+
+    ops = [
+        lambda i: ("GET /", "GET", "/", None),
+        lambda i: ("POST /api/users/register", "POST", "/api/users/register", register_body),
+        lambda i: ("GET /api/users/<id>", "GET", f"/api/users/{user_id}", None),
+        create,
+        lambda i: ("GET /api/books/user/<id>", "GET", f"/api/books/user/{user_id}", None),
+        lambda i: ("GET /api/books/<id>", "GET", f"/api/books/{book_id}", None),
+        lambda i: ("PUT /api/books/<id>", "PUT", f"/api/books/{book_id}",
+                   encode({"title": f"Routes benchmark {i}"})),
+        lambda i: ("POST /api/predict", "POST", "/api/predict", predict_body),
+        delete,
+    ]
+
+    def next_request(i):
+        return ops[i % len(ops)](i)
+
+    def on_response(label, status, data):
+        if label == "POST /api/books" and status == 201:
+            created.append(json.loads(data)["book"]["id"])
+
+    return next_request, on_response
+
+
+def scenario_autosave_storm(target, args):
+    """Concurrent full-content PUTs of ~1MB manuscripts (what Editor autosave sends)"""
+    user_id = register_user(target)
+    book_ids = [create_book(target, user_id, f"Autosave {n}") for n in range(args.concurrency)]
+    base = manuscript(args.manuscript_bytes)
+    prefix = json.dumps({"wordCount": len(base.split()), "content": base})[:-2].encode()
+
+    def next_request(i):
+        book_id = book_ids[i % len(book_ids)]
+        # Vary the tail so every save is a real modification
+        return "PUT /api/books/<id> (1MB)", "PUT", f"/api/books/{book_id}", prefix + f' {i}"}}'.encode()
+
+    return next_request, None
+
+
+def scenario_dashboard(target, args):
+    """Listing a library of N books, as the Dashboard does on every visit"""
+    user_id = register_user(target)
+    for n in range(args.library_size):
+        create_book(target, user_id, f"Library book {n}")
+    paths = [
+        f"/api/books/user/{user_id}?archived=false",
+        f"/api/books/user/{user_id}?archived=true",
+    ]
+
+    def next_request(i):
+        return f"GET /api/books/user/<id> ({args.library_size} books)", "GET", paths[i % 2], None
+
+    return next_request, None
+
+
+def scenario_predict_burst(target, args):
+    """Bursts of /api/predict with varying context"""
+    words = manuscript(4000).split()
+
+    def next_request(i):
+        start = (i * 7) % (len(words) - 60)
+        body = encode({"text": " ".join(words[start:start + 60]), "genre": "fantasy"})
+        return "POST /api/predict", "POST", "/api/predict", body
+
+    return next_request, None
+
+
+SCENARIOS = {
+    "routes": scenario_routes,
+    "autosave_storm": scenario_autosave_storm,
+    "dashboard": scenario_dashboard,
+    "predict_burst": scenario_predict_burst,
+}
+
+
+# ==================== RUNNER ====================
+
+def run_scenario(target, name, args):
+    next_request, on_response = SCENARIOS[name](target, args)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    counter = iter(range(args.requests))
+    counter_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            label, method, path, body = next_request(i)
+            start = time.perf_counter()
+            try:
+                status, data = target.request(method, path, body)
+            except Exception:
+                status, data = 599, b""
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            latencies[label].append(elapsed_ms)
+            if status >= 500 or (status >= 400 and not label.startswith("DELETE")):
+                errors[label] += 1
+            if on_response:
+                on_response(label, status, data)
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for _ in range(args.concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - wall_start
+
+    routes = {}
+    for label, values in latencies.items():
+        values.sort()
+        routes[label] = {
+            "requests": len(values),
+            "errors": errors[label],
+            "throughputRps": round(len(values) / wall, 2),
+            "meanMs": round(sum(values) / len(values), 3),
+            "p50Ms": round(percentile(values, 50), 3),
+            "p95Ms": round(percentile(values, 95), 3),
+            "p99Ms": round(percentile(values, 99), 3),
+            "maxMs": round(values[-1], 3),
+        }
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "wallSeconds": round(wall, 3),
+        "requests": total,
+        "errors": sum(errors.values()),
+        "throughputRps": round(total / wall, 2),
+        "routes": routes,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def print_report(report, baseline=None):
+    for name, result in report["scenarios"].items():
+        print(f"\n📊 {name}: {result['requests']} requests in {result['wallSeconds']}s "
+              f"({result['throughputRps']} req/s, {result['errors']} errors)")
+        print(f"  {'route':<45} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+        old_routes = (baseline or {}).get("scenarios", {}).get(name, {}).get("routes", {})
+        for label, stats in result["routes"].items():
+            line = (f"  {label:<45} {stats['throughputRps']:>9} {stats['p50Ms']:>9} "
+                    f"{stats['p95Ms']:>9} {stats['p99Ms']:>9}")
+            old = old_routes.get(label)
+            if old and old.get("p95Ms"):
+                change = (stats["p95Ms"] - old["p95Ms"]) / old["p95Ms"] * 100
+                line += f"   p95 {change:+.1f}% vs baseline"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Typen backend API")
+    target_group = parser.add_mutually_exclusive_group()
+    target_group.add_argument("--url", default="http://localhost:5000", help="Running server to benchmark")
+    target_group.add_argument("--in-process", action="store_true", help="Import app.py and use Flask's test client")
+    parser.add_argument("--mongomock", action="store_true", help="Back the in-process app with mongomock")
+    parser.add_argument("--repositories", choices=["mongo", "memory"], default="mongo",
+                        help="Book/user storage behind the in-process route handlers")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario(s) to run (default: all)")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-n", "--requests", type=int, default=400, help="Requests per scenario")
+    parser.add_argument("--manuscript-bytes", type=int, default=1_000_000)
+    parser.add_argument("--library-size", type=int, default=500)
+    parser.add_argument("--cohere-latency-ms", type=float, default=150)
+    parser.add_argument("--cohere-jitter-ms", type=float, default=50)
+    parser.add_argument("--cohere-error-rate", type=float, default=0.0)
+    parser.add_argument("--cohere-error-status", type=int, default=500)
+    parser.add_argument("--cohere-replay", metavar="DIR", help="Serve Cohere calls from a recorded cassette")
+    parser.add_argument("-o", "--output", help="Write results JSON here")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    if args.in_process:
+        # The cohere SDK reads CO_API_URL at import time, so set it up before loading app.py
+        fake = start_fake_cohere(latency_ms=args.cohere_latency_ms, jitter_ms=args.cohere_jitter_ms,
+                                 error_rate=args.cohere_error_rate, error_status=args.cohere_error_status,
+                                 mode="replay" if args.cohere_replay else "fake",
+                                 cassette_dir=args.cohere_replay)
+        os.environ["CO_API_URL"] = fake.url
+        os.environ["COHERE_API_KEY"] = "bench-fake-key"
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        # All load comes from one client; measure the server, not the per-client limits
+        os.environ.setdefault("PREDICT_RATE_PER_IP", "1000000")
+        os.environ.setdefault("PREDICT_BURST_PER_IP", "1000000")
+        if not args.mongomock:
+            os.environ.setdefault("DB_NAME", "typen_benchmark")
+        target = InProcessTarget(load_app(mongomock=args.mongomock, repositories=args.repositories))
+        target_desc = "in-process (mongomock)" if args.mongomock else "in-process"
+        if args.repositories == "memory":
+            target_desc += " + memory repositories"
+    else:
+        target = HttpTarget(args.url)
+        target_desc = args.url
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "gitRevision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "target": target_desc,
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "scenarios": {},
+    }
+
+    for name in args.scenario or list(SCENARIOS):
+        print(f"▶️  Running {name}...")
+        report["scenarios"][name] = run_scenario(target, name, args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Fake Cohere API server for benchmarks and offline testing
+Point the backend at it with CO_API_URL=http://127.0.0.1:<port>
+(read by the cohere SDK when it is imported). Three modes:
+
+  fake     answers POST /v2/chat with a fixed 8-word prediction
+  record   forwards every request to the real API (with the caller's
+           Authorization header) and saves request and response to a
+           cassette directory
+  replay   serves recorded responses back; the nth identical request
+           gets the nth recording (cycling), unknown requests get the
+           fixed prediction (--on-miss fake) or a 404 (--on-miss error)
+
+fake and replay add --latency-ms plus up to --jitter-ms of delay (or the
+recorded upstream latency with --recorded-latency) and fail --error-rate
+of requests with --error-status. Delays and failures are drawn from
+--seed and the request itself, so a run replays the same way whatever
+the concurrency. Cassettes hold the prompts, i.e. manuscript text: keep
+recordings of real books out of the repo.
+
+    python benchmarks/fake_cohere.py --mode record --cassette cassettes/eval
+    python benchmarks/fake_cohere.py --mode replay --cassette cassettes/eval --error-rate 0.05
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_TEXT = "the, a, his, her, their, shimmering, forsaken, velvet"
+DEFAULT_UPSTREAM = "https://api.cohere.com"
+FORWARD_HEADERS = ("Authorization", "Content-Type", "Accept", "X-Client-Name")
+UPSTREAM_TIMEOUT = 60
+
+
+class Cassette:
+    """Recorded exchanges, one JSON file per distinct request"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.entries = {}
+        self.played = Counter()
+        self.lock = threading.Lock()
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            self.entries[os.path.basename(path)[:-5]] = entry
+
+    @staticmethod
+    def key(path, raw):
+        try:
+            canonical = json.dumps(json.loads(raw), sort_keys=True, separators=(",", ":")).encode()
+        except ValueError:
+            canonical = raw
+        return hashlib.sha256(path.encode() + b"\n" + canonical).hexdigest()[:32]
+
+    def record(self, key, path, raw, status, body, latency_ms):
+        with self.lock:
+            entry = self.entries.setdefault(key, {"request": {"path": path, "body": _json_or_text(raw)},
+                                                  "responses": []})
+            entry["responses"].append({"status": status, "body": body, "latencyMs": round(latency_ms, 1)})
+            tmp = os.path.join(self.directory, f".{key}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entry, f, indent=2, ensure_ascii=False)
+            os.replace(tmp, os.path.join(self.directory, f"{key}.json"))
+
+    def play(self, key):
+        """(recorded response, how many times this request came before) or (None, count)"""
+        with self.lock:
+            n = self.played[key]
+            self.played[key] += 1
+            entry = self.entries.get(key)
+        if entry is None or not entry["responses"]:
+            return None, n
+        return entry["responses"][n % len(entry["responses"])], n
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _json_or_text(raw):
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw.decode("utf-8", "replace")
+
+
+class FakeCohereHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        server = self.server
+
+        if server.mode == "record":
+            self._forward(raw)
+            return
+
+        key = Cassette.key(self.path, raw)
+        recorded = None
+        if server.cassette is not None:
+            recorded, n = server.cassette.play(key)
+        else:
+            with server.lock:
+                n = server.requests
+                server.requests += 1
+        rng = random.Random(f"{server.seed}:{key}:{n}")
+
+        if recorded is not None and server.recorded_latency:
+            delay = recorded["latencyMs"] * server.latency_scale
+        else:
+            delay = server.latency_ms + rng.uniform(0, server.jitter_ms)
+        time.sleep(delay / 1000)
+
+        if rng.random() < server.error_rate:
+            headers = {"Retry-After": "1"} if server.error_status == 429 else {}
+            self._send(server.error_status, {"message": "injected failure"}, headers)
+        elif recorded is not None:
+            self._send(recorded["status"], recorded["body"])
+        elif server.cassette is not None and server.on_miss == "error":
+            self._send(404, {"message": "request not in cassette"})
+        elif not self.path.startswith("/v2/chat"):
+            self._send(404, {"message": "not found"})
+        else:
+            self._send(200, {
+                "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "finish_reason": "COMPLETE",
+                "message": {
+                    "role": "assistant",
+                    "content": [{"type": "text", "text": server.reply_text}]
+                },
+                "usage": {
+                    "billed_units": {"input_tokens": 120, "output_tokens": 16},
+                    "tokens": {"input_tokens": 180, "output_tokens": 16}
+                }
+            })
+
+    def _forward(self, raw):
+        """Proxy to the real API and record the exchange"""
+        server = self.server
+        headers = {name: self.headers[name] for name in FORWARD_HEADERS if self.headers.get(name)}
+        request = urllib.request.Request(server.upstream + self.path, data=raw, headers=headers, method="POST")
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=UPSTREAM_TIMEOUT) as response:
+                status, payload = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, payload = e.code, e.read()
+        except OSError as e:
+            # Not recorded: an unreachable upstream says nothing about the API
+            self._send(502, {"message": f"upstream unreachable: {e}"})
+            return
+        latency_ms = (time.perf_counter() - started) * 1000
+        body = _json_or_text(payload)
+        server.cassette.record(Cassette.key(self.path, raw), self.path, raw, status, body, latency_ms)
+        self._send(status, body)
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_fake_cohere(port=0, latency_ms=150, jitter_ms=50, error_rate=0.0,
+                      reply_text=DEFAULT_TEXT, mode="fake", cassette_dir=None,
+                      upstream=DEFAULT_UPSTREAM, error_status=500, recorded_latency=False,
+                      latency_scale=1.0, on_miss="fake", seed=0):
+    """Start the server on a daemon thread and return it (server.url is set)"""
+    if mode in ("record", "replay") and not cassette_dir:
+        raise ValueError(f"{mode} mode needs a cassette directory")
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeCohereHandler)
+    server.daemon_threads = True
+    server.mode = mode
+    server.cassette = Cassette(cassette_dir) if mode in ("record", "replay") else None
+    server.upstream = upstream.rstrip("/")
+    server.latency_ms = latency_ms
+    server.jitter_ms = jitter_ms
+    server.error_rate = error_rate
+    server.error_status = error_status
+    server.recorded_latency = recorded_latency
+    server.latency_scale = latency_scale
+    server.on_miss = on_miss
+    server.reply_text = reply_text
+    server.seed = seed
+    server.requests = 0
+    server.lock = threading.Lock()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--mode", choices=["fake", "record", "replay"], default="fake")
+    parser.add_argument("--cassette", help="Cassette directory (record and replay)")
+    parser.add_argument("--upstream", default=os.getenv("COHERE_UPSTREAM_URL", DEFAULT_UPSTREAM),
+                        help="Real API to record from")
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--recorded-latency", action="store_true", help="Replay with the recorded latencies")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiplier for recorded latencies")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500, help="Status of injected failures (e.g. 429, 503)")
+    parser.add_argument("--on-miss", choices=["fake", "error"], default="fake")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = start_fake_cohere(args.port, args.latency_ms, args.jitter_ms, args.error_rate,
+                               mode=args.mode, cassette_dir=args.cassette, upstream=args.upstream,
+                               error_status=args.error_status, recorded_latency=args.recorded_latency,
+                               latency_scale=args.latency_scale, on_miss=args.on_miss, seed=args.seed)
+    detail = f", {len(server.cassette)} recorded requests in {args.cassette}" if server.cassette is not None else ""
+    print(f"🤖 Fake Cohere ({args.mode}) listening on {server.url} (CO_API_URL={server.url}){detail}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
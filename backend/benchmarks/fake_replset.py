@@ -0,0 +1,192 @@
+"""
+Replica-set stand-in for change stream tests
+Wraps mongomock so collections support watch(): writes made through the
+stand-in are appended to a shared in-memory oplog, and change streams
+replay it from their resume token. It can also act like a standalone
+server (watch() fails with code 40573), drop open streams as a lost
+connection would, and truncate its oplog to force "resume token lost"
+errors.
+
+Only the write methods the backend uses are recorded, and only $match
+stages of a watch pipeline are applied.
+"""
+
+import threading
+import time
+
+import mongomock
+from mongomock import filtering
+from pymongo.errors import AutoReconnect, OperationFailure
+
+
+class ReplicaSetStandIn:
+    def __init__(self, standalone=False):
+        self.client = mongomock.MongoClient()
+        self.standalone = standalone
+        self.oplog = []         # (sequence, event)
+        self.first = 0          # oldest sequence still in the oplog
+        self.sequence = 0
+        self.generation = 0     # bumped to drop every open stream
+        self.cond = threading.Condition()
+
+    def collection(self, db_name, name):
+        return WatchableCollection(self, self.client[db_name][name])
+
+    def record(self, ns, op, _id, full_document=None):
+        with self.cond:
+            self.sequence += 1
+            event = {
+                "_id": {"_data": str(self.sequence)},
+                "operationType": op,
+                "ns": ns,
+                "documentKey": {"_id": _id},
+            }
+            if full_document is not None:
+                event["fullDocument"] = full_document
+            self.oplog.append((self.sequence, event))
+            self.cond.notify_all()
+
+    def drop_streams(self):
+        """Fail open change streams like a dropped connection"""
+        with self.cond:
+            self.generation += 1
+            self.cond.notify_all()
+
+    def truncate_oplog(self):
+        """Drop all history, so open streams lose their resume point"""
+        with self.cond:
+            self.first = self.sequence + 1
+            self.oplog = []
+            self.cond.notify_all()
+
+    def events_after(self, ns, sequence):
+        with self.cond:
+            if sequence + 1 < self.first:
+                raise OperationFailure("Resume token is no longer in the oplog", code=286)
+            return [(seq, event) for seq, event in self.oplog if seq > sequence and event["ns"] == ns]
+
+
+class WatchableCollection:
+    def __init__(self, standin, collection):
+        self._standin = standin
+        self._collection = collection
+        self._ns = {"db": collection.database.name, "coll": collection.name}
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def _ids(self, filter, many):
+        cursor = self._collection.find(filter, {"_id": 1})
+        return [doc["_id"] for doc in (cursor if many else cursor.limit(1))]
+
+    def _changed(self, op, ids):
+        for _id in ids:
+            full = None if op == "delete" else self._collection.find_one({"_id": _id})
+            self._standin.record(self._ns, op, _id, full)
+
+    def insert_one(self, document, *args, **kwargs):
+        result = self._collection.insert_one(document, *args, **kwargs)
+        self._changed("insert", [result.inserted_id])
+        return result
+
+    def insert_many(self, documents, *args, **kwargs):
+        result = self._collection.insert_many(documents, *args, **kwargs)
+        self._changed("insert", result.inserted_ids)
+        return result
+
+    def update_one(self, filter, update, *args, **kwargs):
+        ids = self._ids(filter, False)
+        result = self._collection.update_one(filter, update, *args, **kwargs)
+        self._changed("update", ids or ([result.upserted_id] if result.upserted_id else []))
+        return result
+
+    def update_many(self, filter, update, *args, **kwargs):
+        ids = self._ids(filter, True)
+        result = self._collection.update_many(filter, update, *args, **kwargs)
+        self._changed("update", ids)
+        return result
+
+    def replace_one(self, filter, replacement, *args, **kwargs):
+        ids = self._ids(filter, False)
+        result = self._collection.replace_one(filter, replacement, *args, **kwargs)
+        self._changed("replace", ids or ([result.upserted_id] if result.upserted_id else []))
+        return result
+
+    def find_one_and_update(self, filter, update, *args, **kwargs):
+        ids = self._ids(filter, False)
+        result = self._collection.find_one_and_update(filter, update, *args, **kwargs)
+        self._changed("update", ids)
+        return result
+
+    def delete_one(self, filter, *args, **kwargs):
+        ids = self._ids(filter, False)
+        result = self._collection.delete_one(filter, *args, **kwargs)
+        self._changed("delete", ids)
+        return result
+
+    def delete_many(self, filter, *args, **kwargs):
+        ids = self._ids(filter, True)
+        result = self._collection.delete_many(filter, *args, **kwargs)
+        self._changed("delete", ids)
+        return result
+
+    def find_one_and_delete(self, filter, *args, **kwargs):
+        ids = self._ids(filter, False)
+        result = self._collection.find_one_and_delete(filter, *args, **kwargs)
+        self._changed("delete", ids)
+        return result
+
+    def watch(self, pipeline=None, full_document=None, resume_after=None, max_await_time_ms=None, **kwargs):
+        standin = self._standin
+        if standin.standalone:
+            raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+        if resume_after is not None:
+            position = int(resume_after["_data"])
+            standin.events_after(self._ns, position)  # raises if history was lost
+        else:
+            position = standin.sequence
+        matches = [stage["$match"] for stage in pipeline or [] if "$match" in stage]
+        return FakeChangeStream(standin, self._ns, position, matches, full_document,
+                                (max_await_time_ms or 1000) / 1000)
+
+
+class FakeChangeStream:
+    def __init__(self, standin, ns, position, matches, full_document, max_await):
+        self.standin = standin
+        self.ns = ns
+        self.position = position
+        self.matches = matches
+        self.full_document = full_document
+        self.max_await = max_await
+        self.generation = standin.generation
+
+    @property
+    def resume_token(self):
+        return {"_data": str(self.position)}
+
+    def try_next(self):
+        """Next matching event, or None after waiting up to max_await"""
+        deadline = time.monotonic() + self.max_await
+        while True:
+            if self.generation != self.standin.generation:
+                raise AutoReconnect("Connection to the stand-in was dropped")
+            for seq, event in self.standin.events_after(self.ns, self.position):
+                self.position = seq
+                if all(filtering.filter_applies(match, event) for match in self.matches):
+                    if event["operationType"] == "update" and self.full_document != "updateLookup":
+                        event = {k: v for k, v in event.items() if k != "fullDocument"}
+                    return event
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            with self.standin.cond:
+                self.standin.cond.wait(min(remaining, 0.05))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
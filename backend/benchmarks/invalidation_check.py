@@ -0,0 +1,157 @@
+"""
+End-to-end check of the cross-worker invalidation bus
+Two buses play two workers, each with its own user cache. A write made
+by "worker A" must evict the key cached by "worker B":
+
+    cd backend
+    python benchmarks/invalidation_check.py                    # replica-set stand-in
+    python benchmarks/invalidation_check.py --mongo-uri "mongodb://localhost:27017/?replicaSet=rs0"
+
+Without --mongo-uri, the scenarios run against fake_replset.py: change
+streams, resume after a dropped stream, reset after the oplog lost the
+resume token, and the polling fallback of a standalone server. With
+--mongo-uri only the change stream scenario runs, against a scratch
+database (start a one-node replica set with `mongod --replSet rs0` and
+`rs.initiate()` in mongosh).
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import invalidation  # noqa: E402
+
+
+class Worker:
+    """A bus plus the cache it keeps current"""
+
+    def __init__(self, name, users_collection, mode, poll_seconds=0.2):
+        self.name = name
+        self.cache = invalidation.LocalCache()
+        self.resets = 0
+        self.bus = invalidation.InvalidationBus(
+            [invalidation.Source("users", users_collection, ["clerkUserId"], "updatedAt")],
+            mode=mode, poll_seconds=poll_seconds, retry_seconds=0.2,
+        )
+        self.bus.subscribe("users", self.on_change)
+
+    def on_change(self, change):
+        if change.reset:
+            self.resets += 1
+            self.cache.clear()
+        elif change.doc.get("clerkUserId"):
+            self.cache.evict(change.doc["clerkUserId"])
+        else:
+            self.cache.clear()
+
+    def mode(self):
+        return self.bus.sources["users"].mode
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def touch(users, clerk_user_id, name):
+    users.update_one({"clerkUserId": clerk_user_id},
+                     {"$set": {"fullName": name, "updatedAt": datetime.now(timezone.utc)}},
+                     upsert=True)
+
+
+def evicts(users, worker, clerk_user_id, name):
+    """worker caches the user, someone else writes it, the entry must go"""
+    worker.cache.put(clerk_user_id, {"fullName": "stale"})
+    touch(users, clerk_user_id, name)
+    return wait_for(lambda: worker.cache.get(clerk_user_id) is None)
+
+
+def scenario_stream(users, standin=None):
+    a = Worker("A", users, "stream")
+    b = Worker("B", users, "stream")
+    a.bus.start()
+    b.bus.start()
+    results = []
+    try:
+        results.append(("both workers on change streams",
+                        wait_for(lambda: a.mode() == b.mode() == "stream")))
+        time.sleep(0.2)  # let the streams open before writing
+        results.append(("write in A evicts in B", evicts(users, b, "user_1", "Ada")))
+        results.append(("write in B evicts in A", evicts(users, a, "user_1", "Grace")))
+        if standin is not None:
+            # Connection drops, a write happens, and the oplog rolls over before reconnecting
+            standin.drop_streams()
+            touch(users, "user_2", "Linus")
+            standin.truncate_oplog()
+            results.append(("lost resume token resets caches",
+                            wait_for(lambda: b.resets > 0)))
+            results.append(("stream recovers after reset", evicts(users, b, "user_1", "Alan")))
+    finally:
+        a.bus.stop()
+        b.bus.stop()
+    return results
+
+
+def scenario_poll(users):
+    a = Worker("A", users, "auto")
+    b = Worker("B", users, "auto")
+    a.bus.start()
+    b.bus.start()
+    results = []
+    try:
+        results.append(("standalone falls back to polling",
+                        wait_for(lambda: a.mode() == b.mode() == "poll")))
+        results.append(("polled write evicts in B", evicts(users, b, "user_3", "Barbara")))
+        b.cache.put("user_4", {"fullName": "untouched"})
+        time.sleep(0.5)
+        results.append(("overlap window does not re-evict", b.cache.get("user_4") is not None))
+    finally:
+        a.bus.stop()
+        b.bus.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", help="A real replica set to run the change stream scenario against")
+    args = parser.parse_args()
+
+    results = []
+    if args.mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(args.mongo_uri)
+        db = client["typen_invalidation_check"]
+        try:
+            print("▶️  Change streams (real replica set)")
+            results += scenario_stream(db["users"])
+        finally:
+            client.drop_database(db.name)
+    else:
+        import fake_replset
+        print("▶️  Change streams (replica-set stand-in)")
+        standin = fake_replset.ReplicaSetStandIn()
+        results += scenario_stream(standin.collection("typen", "users"), standin)
+        print("▶️  Polling fallback (standalone stand-in)")
+        standalone = fake_replset.ReplicaSetStandIn(standalone=True)
+        results += scenario_poll(standalone.collection("typen", "users"))
+
+    for label, ok in results:
+        print(f"  {'ok ' if ok else 'FAIL'} {label}")
+    failures = sum(1 for _, ok in results if not ok)
+    print(f"📊 {len(results) - failures}/{len(results)} checks passed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""
+Fuzz and benchmark corpus for prediction_parser.parse
+
+    cd backend
+    python benchmarks/parser_bench.py                 # corpus + 20000 fuzz cases + timing
+    python benchmarks/parser_bench.py --fuzz 200000 --seed 7
+
+The corpus holds answers in the shapes models actually produce. Every
+case, and every fuzzed mutation of one, must parse without raising into
+at most 8 distinct lowercase words that don't repeat the context's last
+word, with a quality between 0 and 1. Corpus cases also pin the words
+and whether the answer is good enough to serve. Timing compares the
+parser with the split/regex/pad code it replaced in /api/predict.
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import prediction_parser  # noqa: E402
+
+CONTEXT = "The sun was setting over the"
+WORDS = ["horizon", "mountains", "ocean", "city", "valley", "crimson", "ethereal", "forgotten"]
+
+# (label, raw model output, expected words or None to only check invariants, servable)
+CORPUS = [
+    ("clean", "horizon, mountains, ocean, city, valley, crimson, ethereal, forgotten", WORDS, True),
+    ("no spaces", "horizon,mountains,ocean,city,valley,crimson,ethereal,forgotten", WORDS, True),
+    ("capitalized", "Horizon, Mountains, Ocean, City, Valley, Crimson, Ethereal, Forgotten", WORDS, True),
+    ("trailing period", "horizon, mountains, ocean, city, valley, crimson, ethereal, forgotten.", WORDS, True),
+    ("numbered", "1. horizon\n2. mountains\n3. ocean\n4. city\n5. valley\n6. crimson\n7. ethereal\n8. forgotten",
+     WORDS, True),
+    ("bullets", "- horizon\n- mountains\n- ocean\n- city\n- valley\n- crimson\n- ethereal\n- forgotten", WORDS, True),
+    ("preamble", "Here are the predictions: horizon, mountains, ocean, city, valley, crimson, ethereal, forgotten",
+     WORDS, True),
+    ("labels", "Probable: horizon, mountains, ocean, city, valley\nCreative: crimson, ethereal, forgotten",
+     WORDS, True),
+    ("quoted", '"horizon", "mountains", "ocean", "city", "valley", "crimson", "ethereal", "forgotten"', WORDS, True),
+    ("markdown", "**horizon**, *mountains*, `ocean`, city, valley, _crimson_, ethereal, forgotten", WORDS, True),
+    ("semicolons", "horizon; mountains; ocean; city; valley; crimson; ethereal; forgotten", WORDS, True),
+    ("spaces only", "horizon mountains ocean city valley crimson ethereal forgotten", WORDS, True),
+    ("curly apostrophe", "horizon, mountains, ocean, city, valley, crimson, ethereal, world’s",
+     WORDS[:7] + ["world's"], True),
+    ("repeats context", "the, horizon, mountains, ocean, city, valley, crimson, ethereal, forgotten", WORDS, True),
+    ("duplicates", "horizon, horizon, mountains, ocean, ocean, city, valley, crimson, ethereal, forgotten",
+     WORDS, True),
+    ("multi-word items", "setting sun, distant hills, ocean, city, valley, crimson, ethereal, forgotten",
+     ["setting", "distant", "ocean", "city", "valley", "crimson", "ethereal", "forgotten"], True),
+    ("too many", ", ".join(WORDS + ["extra", "more", "words"]), WORDS, True),
+    ("too few", "horizon, mountains, ocean", WORDS[:3], False),
+    ("prose", "The next word is most likely horizon, because the sentence describes a sunset.", None, False),
+    ("refusal", "I'm sorry, but I can't help with that request.", None, False),
+    ("prose no commas", "Based on the context the most natural continuation would be horizon.", None, False),
+    ("empty", "", [], False),
+    ("whitespace", "   \n\t  ", [], False),
+    ("punctuation", "!!!,,,;;;...", [], False),
+    ("digits", "1, 2, 3, 4, 5, 6, 7, 8", [], False),
+    ("json", '["horizon","mountains","ocean","city","valley","crimson","ethereal","forgotten"]', WORDS, True),
+    ("long word", "horizon, " + "a" * 40 + ", mountains, ocean, city, valley, crimson, ethereal, forgotten",
+     WORDS, True),
+    ("non-latin", "горизонт, 地平线, horizon, mountains", ["horizon", "mountains"], False),
+]
+
+# Strings mixed into fuzzed answers
+NOISE = [",", ", ", "\n", ";", "|", ":", ".", "!", "?", " ", "  ", "\t", "-", "*", "**", '"', "'", "’",
+         "1.", "2)", "Probable:", "Creative:", "the", "The", "é", "ß", "🙂", "\x00", "​", "<b>", "</b>",
+         "a" * 30, "horizon", "setting sun"]
+
+
+def legacy_parse(generated_text):
+    """The parsing /api/predict did inline before prediction_parser existed"""
+    if ',' in generated_text:
+        words = [w.strip().lower() for w in generated_text.split(',')]
+    else:
+        words = generated_text.lower().split()
+    words = [re.sub(r'[^a-z]', '', w) for w in words]
+    words = [w for w in words if w]
+    words = words[:8]
+    default_probable = ["and", "the", "to", "of", "a"]
+    default_creative = ["beneath", "whispered", "shadows"]
+    while len(words) < 5:
+        words.append(default_probable[len(words)])
+    while len(words) < 8:
+        words.append(default_creative[len(words) - 5])
+    return words
+
+
+def check_invariants(raw, result):
+    words = result.words
+    problems = []
+    if len(words) > prediction_parser.WORDS_NEEDED:
+        problems.append("more than 8 words")
+    if len(set(words)) != len(words):
+        problems.append("duplicate words")
+    if "the" in words:
+        problems.append("repeats the context's last word")
+    if any(w != w.lower() or not re.fullmatch(r"[a-z]+(?:'[a-z]+)*", w) for w in words):
+        problems.append("word is not lowercase letters")
+    if not 0.0 <= result.quality <= 1.0:
+        problems.append("quality out of range")
+    return problems
+
+
+def run_corpus():
+    failures = 0
+    for label, raw, expected, servable in CORPUS:
+        result = prediction_parser.parse(raw, CONTEXT)
+        problems = check_invariants(raw, result)
+        if expected is not None and result.words != expected:
+            problems.append(f"expected {expected}")
+        if result.complete != servable:
+            problems.append(f"expected complete={servable}")
+        mark = "ok " if not problems else "FAIL"
+        print(f"  {mark} {label:<18} q={result.quality:<5} {result.words}")
+        for problem in problems:
+            print(f"       - {problem}")
+        failures += bool(problems)
+    return failures
+
+
+def mutate(rng, raw):
+    pieces = list(raw)
+    for _ in range(rng.randint(1, 8)):
+        op = rng.random()
+        pos = rng.randint(0, len(pieces))
+        if op < 0.5:
+            pieces.insert(pos, rng.choice(NOISE))
+        elif op < 0.8 and pieces:
+            del pieces[min(pos, len(pieces) - 1)]
+        else:
+            pieces.insert(pos, chr(rng.randint(0, 0x2FFF)))
+    return "".join(pieces)
+
+
+def run_fuzz(cases, seed):
+    rng = random.Random(seed)
+    seeds = [raw for _, raw, _, _ in CORPUS]
+    failures = 0
+    for i in range(cases):
+        raw = mutate(rng, rng.choice(seeds))
+        try:
+            result = prediction_parser.parse(raw, CONTEXT)
+        except Exception as e:
+            problems = [f"raised {e!r}"]
+        else:
+            problems = check_invariants(raw, result)
+        if problems:
+            failures += 1
+            if failures <= 10:
+                print(f"  FAIL case {i}: {raw!r}: {problems}")
+    return failures
+
+
+def timeit(fn, inputs, rounds, repeats=5):
+    """Answers per second, from the fastest of several runs (the others caught noise)"""
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(rounds // repeats or 1):
+            for raw in inputs:
+                fn(raw)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return (rounds // repeats or 1) * len(inputs) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fuzz", type=int, default=20000, help="Fuzzed cases to run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=2000, help="Timing rounds over the corpus")
+    args = parser.parse_args()
+
+    print("▶️  Corpus")
+    corpus_failures = run_corpus()
+    print(f"▶️  Fuzzing {args.fuzz} cases (seed {args.seed})")
+    fuzz_failures = run_fuzz(args.fuzz, args.seed)
+
+    inputs = [raw for _, raw, _, _ in CORPUS]
+    new = timeit(lambda raw: prediction_parser.parse(raw, CONTEXT), inputs, args.rounds)
+    old = timeit(legacy_parse, inputs, args.rounds)
+    print(f"📊 parse: {new:,.0f} answers/s, legacy inline parsing: {old:,.0f} answers/s")
+    print(f"📊 corpus failures: {corpus_failures}, fuzz failures: {fuzz_failures}")
+    return 1 if corpus_failures or fuzz_failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,421 @@
+"""
+Offline evaluation of next-word predictions
+Replays held-out text through the same path /api/predict uses (prompt,
+provider routing, parsing, n-gram top-up, personalization) and checks
+whether the word the author actually wrote next was predicted:
+
+  probable top-1 / top-5   first probable word / any of the 5 probable words
+  creative top-1 / top-3   first creative word / any of the 3 creative words
+  any                      any of the 8 suggestions
+
+It also reports latency percentiles, model tokens per prediction (and
+cost, given prices) and the cache hit ratio, as JSON comparable across
+runs. Text comes from the bundled public-domain corpus
+(eval_corpus.json) or from books stored in MongoDB; only the last
+--holdout share of each text is predicted, and with --personalize the
+author's style index is built from the rest.
+
+Examples (run from backend/):
+    # n-gram baseline, no services needed
+    python benchmarks/predict_eval.py --providers ngram -o ngram.json
+
+    # Cohere through the fake server, with an exact-context cache
+    python benchmarks/predict_eval.py --providers cohere --fake-cohere --cache
+
+    # How often the warm table (warmcache.py) answers before the engine, and how well
+    python benchmarks/predict_eval.py --providers cohere --fake-cohere --warm-cache warm_predictions.json
+
+    # Record real Cohere answers once, then re-run offline from the cassette
+    python benchmarks/predict_eval.py --providers cohere --cohere-record cassettes/eval
+    python benchmarks/predict_eval.py --providers cohere --cohere-replay cassettes/eval --recorded-latency
+
+    # A local model on a user's own books, compared with a baseline
+    LOCAL_MODEL_URL=http://localhost:11434 python benchmarks/predict_eval.py --providers local \\
+        --mongo-uri mongodb://localhost:27017 --user user_abc123 --personalize --compare ngram.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from bench import git_revision, percentile  # noqa: E402
+
+CORPUS_PATH = os.path.join(BENCH_DIR, "eval_corpus.json")
+TARGET_WORD = re.compile(r"[a-z]+(?:'[a-z]+)*")
+EDGE_PUNCTUATION = "\"'“”‘’()[]{}.,;:!?—–-_*"
+MIN_CONTEXT_WORDS = 5
+MAX_CONTEXT_WORDS = 200    # more than the prompt uses (providers.CONTEXT_WORDS)
+
+
+# ==================== TEXT ====================
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [{"title": d["title"], "genre": d.get("genre", "fiction"), "text": d["text"]}
+                for d in json.load(f)]
+
+
+def load_books(mongo_uri, db_name, user_id, limit):
+    """Stored books as plain text, paragraph by paragraph"""
+    from pymongo import MongoClient
+    import exporters
+
+    query = {"userId": user_id} if user_id else {}
+    books = MongoClient(mongo_uri)[db_name]["books"].find(
+        query, {"title": 1, "genre": 1, "content": 1}
+    ).sort("updatedAt", -1).limit(limit)
+    docs = []
+    for book in books:
+        blocks = exporters.iter_blocks(exporters.iter_content(book.get("content", "")))
+        text = "\n".join(block.text for block in blocks)
+        if len(text.split()) > MIN_CONTEXT_WORDS * 2:
+            docs.append({"title": book.get("title", ""), "genre": book.get("genre") or "fiction", "text": text})
+    return docs
+
+
+def target_word(token):
+    """The token as a predictable word (lowercase, no edge punctuation), or None"""
+    word = token.strip(EDGE_PUNCTUATION).lower().replace("’", "'")
+    return word if TARGET_WORD.fullmatch(word) else None
+
+
+def build_samples(docs, holdout, per_doc, rng):
+    """(doc, context text, target word) from the held-out tail of every doc"""
+    samples = []
+    for doc in docs:
+        tokens = doc["text"].split()
+        start = max(MIN_CONTEXT_WORDS, int(len(tokens) * (1 - holdout)))
+        positions = [i for i in range(start, len(tokens)) if target_word(tokens[i])]
+        if per_doc and len(positions) > per_doc:
+            positions = sorted(rng.sample(positions, per_doc))
+        for i in positions:
+            samples.append((doc, " ".join(tokens[max(0, i - MAX_CONTEXT_WORDS):i]), target_word(tokens[i])))
+    return samples
+
+
+def style_indexes(docs, holdout, personalize):
+    """Style index per genre from the held-in part of every doc (or None)"""
+    if not personalize:
+        return {}
+    import personalization
+
+    tables = defaultdict(list)
+    for doc in docs:
+        tokens = doc["text"].split()
+        held_in = " ".join(tokens[:int(len(tokens) * (1 - holdout))])
+        tables[doc["genre"]].append(personalization.build_book_table(held_in))
+    # The author's whole library feeds their index, whatever the genre
+    index = personalization.StyleIndex([t for group in tables.values() for t in group])
+    return {genre: index for genre in tables}
+
+
+def add_passage_indexes(docs, holdout, budget_tokens):
+    """Passage index of each doc's held-in part, as retrieval.PassageIndexer builds for a saved book"""
+    import retrieval
+
+    for doc in docs:
+        tokens = doc["text"].split()
+        held_in = " ".join(tokens[:int(len(tokens) * (1 - holdout))])
+        doc["passages"] = retrieval.build_book_index([held_in]) if budget_tokens else None
+
+
+# ==================== ENGINE ====================
+
+class ExactCache:
+    """LRU in front of the engine keyed by genre and context, to measure hit ratio"""
+
+    def __init__(self, engine, size=10000):
+        self.engine = engine
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.lookups = 0
+        self.lock = threading.Lock()
+
+    def predict(self, query):
+        key = (query.genre, query.text.lower())
+        with self.lock:
+            self.lookups += 1
+            if key in self.items:
+                self.hits += 1
+                self.items.move_to_end(key)
+                return self.items[key]
+        result = self.engine.predict(query)
+        with self.lock:
+            self.items[key] = result
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return result
+
+    def stats(self):
+        return {"lookups": self.lookups, "hits": self.hits,
+                "hitRatio": round(self.hits / self.lookups, 4) if self.lookups else None}
+
+
+def build_engine(args):
+    import providers
+
+    if args.cohere_record and not os.getenv("COHERE_API_KEY"):
+        sys.exit("❌ Recording needs a real COHERE_API_KEY")
+    if args.fake_cohere or args.cohere_record or args.cohere_replay:
+        from fake_cohere import start_fake_cohere
+        mode = "record" if args.cohere_record else "replay" if args.cohere_replay else "fake"
+        fake = start_fake_cohere(latency_ms=args.cohere_latency_ms, jitter_ms=args.cohere_jitter_ms,
+                                 error_rate=args.cohere_error_rate, error_status=args.cohere_error_status,
+                                 mode=mode, cassette_dir=args.cohere_record or args.cohere_replay,
+                                 recorded_latency=args.recorded_latency, seed=args.seed)
+        os.environ["CO_API_URL"] = fake.url  # read when the cohere SDK is imported
+        os.environ.setdefault("COHERE_API_KEY", "eval-fake-key")
+    engine = providers.build_engine(os.getenv("COHERE_API_KEY"), providers=args.providers,
+                                    fallbacks=args.fallbacks)
+    if not engine.available():
+        sys.exit(f"❌ None of the providers '{args.providers}' is configured")
+    return ExactCache(engine) if args.cache else engine
+
+
+def predict_one(engine, doc, context, style_index, budget_tokens, warm_table=None):
+    """Run one sample the way /api/predict does; returns (probable, creative, provider, usage, passages, ms)"""
+    import personalization
+    import providers
+
+    usage = []
+    passages = []
+    started = time.perf_counter()
+    _, warm_words = warm_table.lookup(doc["genre"], context) if warm_table else (None, None)
+    if warm_words:
+        predictions = personalization.personalize(providers.format_predictions(warm_words), style_index, context)
+        provider_name = "warm"
+    else:
+        book_index = doc.get("passages")
+        passages = book_index.search(context, budget_tokens) if book_index else []
+        query = providers.build_query(context, doc["genre"], style_index, usage, passages)
+        words, provider_name = engine.predict(query)
+        words = providers.fill_words(words, query)
+        predictions = personalization.personalize(providers.format_predictions(words), style_index, query.text)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    probable = [p["word"].lower() for p in predictions if p["type"] == "probable"]
+    creative = [p["word"].lower() for p in predictions if p["type"] == "creative"]
+    return probable, creative, provider_name, usage, len(passages), elapsed_ms
+
+
+# ==================== EVALUATION ====================
+
+def rate(hits, total):
+    return round(hits / total, 4) if total else None
+
+
+def evaluate(engine, samples, indexes, concurrency, budget_tokens=0, warm_table=None):
+    hits = Counter()
+    by_genre = defaultdict(Counter)
+    latencies = []
+    served_by = Counter()
+    calls = Counter()
+    input_tokens = output_tokens = 0
+    passages_used = 0
+    errors = 0
+
+    def run(sample):
+        doc, context, target = sample
+        try:
+            return sample, predict_one(engine, doc, context, indexes.get(doc["genre"]), budget_tokens,
+                                       warm_table), None
+        except Exception as e:
+            return sample, None, e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for (doc, _, target), outcome, error in pool.map(run, samples):
+            if error is not None:
+                errors += 1
+                if errors <= 5:
+                    print(f"  ⚠️  {type(error).__name__}: {error}")
+                continue
+            probable, creative, provider_name, usage, passages, elapsed_ms = outcome
+            passages_used += passages
+            latencies.append(elapsed_ms)
+            served_by[provider_name] += 1
+            for name, tokens_in, tokens_out in usage:
+                calls[name] += 1
+                input_tokens += tokens_in
+                output_tokens += tokens_out
+            result = {
+                "probableTop1": probable[:1] == [target],
+                "probableTop5": target in probable[:5],
+                "creativeTop1": creative[:1] == [target],
+                "creativeTop3": target in creative[:3],
+                "any": target in probable or target in creative,
+            }
+            genre_hits = by_genre[doc["genre"]]
+            genre_hits["samples"] += 1
+            hits["samples"] += 1
+            for metric, hit in result.items():
+                hits[metric] += hit
+                genre_hits[metric] += hit
+
+    done = hits["samples"]
+    latencies.sort()
+    metrics = ("probableTop1", "probableTop5", "creativeTop1", "creativeTop3", "any")
+    return {
+        "samples": len(samples),
+        "errors": errors,
+        "accuracy": {
+            "probable": {"top1": rate(hits["probableTop1"], done), "top5": rate(hits["probableTop5"], done)},
+            "creative": {"top1": rate(hits["creativeTop1"], done), "top3": rate(hits["creativeTop3"], done)},
+            "any": rate(hits["any"], done),
+        },
+        "latencyMs": {
+            "p50": round(percentile(latencies, 50), 3) if latencies else None,
+            "p95": round(percentile(latencies, 95), 3) if latencies else None,
+            "p99": round(percentile(latencies, 99), 3) if latencies else None,
+            "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "max": round(latencies[-1], 3) if latencies else None,
+        },
+        "tokens": {
+            "modelCalls": dict(calls),
+            "callsPerPrediction": round(sum(calls.values()) / done, 3) if done else None,
+            "inputPerPrediction": round(input_tokens / done, 1) if done else None,
+            "outputPerPrediction": round(output_tokens / done, 1) if done else None,
+            "input": input_tokens,
+            "output": output_tokens,
+        },
+        "passagesPerPrediction": round(passages_used / done, 3) if done else None,
+        "providers": dict(served_by),
+        "byGenre": {
+            genre: {"samples": g["samples"], **{m: rate(g[m], g["samples"]) for m in metrics}}
+            for genre, g in sorted(by_genre.items())
+        },
+    }
+
+
+def print_report(report, baseline=None):
+    result = report["result"]
+    old = (baseline or {}).get("result", {})
+
+    def line(label, value, old_value, unit=""):
+        text = f"  {label:<24} {value if value is not None else '-':>10}{unit}"
+        if isinstance(value, (int, float)) and isinstance(old_value, (int, float)):
+            text += f"   ({value - old_value:+.4g} vs baseline)"
+        print(text)
+
+    acc, old_acc = result["accuracy"], old.get("accuracy", {})
+    print(f"\n📊 {result['samples']} predictions, {result['errors']} errors, served by {result['providers']}")
+    line("probable top-1", acc["probable"]["top1"], old_acc.get("probable", {}).get("top1"))
+    line("probable top-5", acc["probable"]["top5"], old_acc.get("probable", {}).get("top5"))
+    line("creative top-1", acc["creative"]["top1"], old_acc.get("creative", {}).get("top1"))
+    line("creative top-3", acc["creative"]["top3"], old_acc.get("creative", {}).get("top3"))
+    line("any of 8", acc["any"], old_acc.get("any"))
+    for pct in ("p50", "p95", "p99"):
+        line(f"latency {pct}", result["latencyMs"][pct], old.get("latencyMs", {}).get(pct), " ms")
+    tokens, old_tokens = result["tokens"], old.get("tokens", {})
+    line("model calls/prediction", tokens["callsPerPrediction"], old_tokens.get("callsPerPrediction"))
+    line("input tokens/prediction", tokens["inputPerPrediction"], old_tokens.get("inputPerPrediction"))
+    line("output tokens/prediction", tokens["outputPerPrediction"], old_tokens.get("outputPerPrediction"))
+    if result.get("passagesPerPrediction"):
+        line("passages/prediction", result["passagesPerPrediction"], old.get("passagesPerPrediction"))
+    if result.get("costUsdPer1kPredictions") is not None:
+        line("USD per 1k predictions", result["costUsdPer1kPredictions"], old.get("costUsdPer1kPredictions"))
+    if result.get("cache"):
+        line("cache hit ratio", result["cache"]["hitRatio"], (old.get("cache") or {}).get("hitRatio"))
+    if result.get("warmCache"):
+        line("warm hit ratio", result["warmCache"]["hitRatio"], (old.get("warmCache") or {}).get("hitRatio"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--providers", default="cohere", help="Routed providers, as in PREDICT_PROVIDERS")
+    parser.add_argument("--fallbacks", default="", help="Fallback providers, as in PREDICT_FALLBACKS")
+    parser.add_argument("--fake-cohere", action="store_true", help="Serve Cohere calls from fake_cohere.py")
+    parser.add_argument("--cohere-latency-ms", type=float, default=150)
+    parser.add_argument("--cohere-jitter-ms", type=float, default=50)
+    parser.add_argument("--cohere-error-rate", type=float, default=0.0)
+    parser.add_argument("--cohere-error-status", type=int, default=500)
+    parser.add_argument("--cohere-record", metavar="DIR", help="Call the real API and record to this cassette")
+    parser.add_argument("--cohere-replay", metavar="DIR", help="Serve Cohere calls from this cassette")
+    parser.add_argument("--recorded-latency", action="store_true", help="Replay with the recorded latencies")
+    parser.add_argument("--cache", action="store_true", help="Put an exact-context cache in front of the engine")
+    parser.add_argument("--warm-cache", metavar="FILE", help="Consult this warm prediction table before the engine")
+    parser.add_argument("--corpus", default=CORPUS_PATH, help="JSON list of {title, genre, text}")
+    parser.add_argument("--mongo-uri", help="Evaluate on stored books instead of the corpus")
+    parser.add_argument("--db", default=os.getenv("DB_NAME", "next_word_prediction"))
+    parser.add_argument("--user", help="Only this user's books")
+    parser.add_argument("--books", type=int, default=20, help="At most this many stored books")
+    parser.add_argument("--holdout", type=float, default=0.2, help="Share of each text that is predicted")
+    parser.add_argument("--samples", type=int, default=50, help="Predictions per text (0 = every word)")
+    parser.add_argument("--personalize", action="store_true", help="Style index from the held-in text")
+    parser.add_argument("--retrieval", action="store_true", help="Quote relevant held-in passages in the prompt")
+    parser.add_argument("--retrieval-budget", type=int, help="Prompt tokens for passages (default RETRIEVAL_BUDGET_TOKENS)")
+    parser.add_argument("--price-in", type=float, help="USD per million input tokens")
+    parser.add_argument("--price-out", type=float, help="USD per million output tokens")
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="Write the report JSON here")
+    parser.add_argument("--compare", help="Earlier report JSON to compare against")
+    args = parser.parse_args()
+
+    docs = (load_books(args.mongo_uri, args.db, args.user, args.books) if args.mongo_uri
+            else load_corpus(args.corpus))
+    if not docs:
+        sys.exit("❌ No text to evaluate on")
+    samples = build_samples(docs, args.holdout, args.samples, random.Random(args.seed))
+    indexes = style_indexes(docs, args.holdout, args.personalize)
+    budget_tokens = 0
+    if args.retrieval:
+        import retrieval
+        budget_tokens = retrieval.BUDGET_TOKENS if args.retrieval_budget is None else args.retrieval_budget
+        add_passage_indexes(docs, args.holdout, budget_tokens)
+    engine = build_engine(args)
+    warm_table = None
+    if args.warm_cache:
+        import warmcache
+        warm_table = warmcache.WarmTable.load(args.warm_cache)
+
+    print(f"▶️  Evaluating {len(samples)} predictions from {len(docs)} texts with '{args.providers}'")
+    result = evaluate(engine, samples, indexes, args.concurrency, budget_tokens, warm_table)
+    if args.price_in is not None or args.price_out is not None:
+        tokens = result["tokens"]
+        if tokens["inputPerPrediction"] is not None:
+            per_prediction = (tokens["inputPerPrediction"] * (args.price_in or 0)
+                              + tokens["outputPerPrediction"] * (args.price_out or 0)) / 1_000_000
+            result["costUsdPer1kPredictions"] = round(per_prediction * 1000, 6)
+    result["cache"] = engine.stats() if isinstance(engine, ExactCache) else None
+    result["warmCache"] = warm_table.snapshot() if warm_table else None
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "gitRevision": git_revision(),
+            "python": platform.python_version(),
+            "source": f"mongodb:{args.db}" if args.mongo_uri else os.path.basename(args.corpus),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "mongo_uri")},
+        },
+        "result": result,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Report saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Incremental library sync ("changes since")
+Clients keep a sync token from their last listing and ask only for what
+changed after it: books whose updatedAt is newer (served from the
+(userId, updatedAt) index) and tombstones of books deleted since. Each
+window overlaps the previous one by CLOCK_SKEW_SECONDS plus the write
+delay of buffered autosaves (stamped when submitted, written up to
+AutosaveBuffer.write_delay later), so neither those nor writes stamped by
+a worker with a slightly slow clock are missed; clients upsert by ID, so
+a book seen twice is harmless. Tombstones expire after
+TOMBSTONE_TTL_DAYS, and a token older than that asks the client to
+reload the full list.
+"""
+
+import os
+from datetime import datetime, timedelta, timezone
+
+from repositories import LIST_PROJECTION
+
+TOMBSTONE_TTL_DAYS = int(os.getenv("TOMBSTONE_TTL_DAYS", 30))
+CLOCK_SKEW_SECONDS = 5
+MAX_CHANGES = 500  # beyond this a full reload is cheaper than a delta
+MAX_TOKEN_LENGTH = 16  # hex milliseconds; today's tokens are 11 characters
+
+
+def encode_token(moment):
+    """Opaque sync token for a point in time"""
+    return format(int(moment.timestamp() * 1000), "x")
+
+
+def decode_token(token):
+    """Inverse of encode_token; raises ValueError for anything else"""
+    if len(token) > MAX_TOKEN_LENGTH:
+        raise ValueError("Invalid sync token")
+    try:
+        ms = int(token, 16)
+        if ms < 0:
+            raise ValueError("Invalid sync token")
+        return datetime.fromtimestamp(ms / 1000, timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError("Invalid sync token")
+
+
+class ChangeFeed:
+    def __init__(self, books_collection, tombstones_collection, write_delay=0):
+        self.books_collection = books_collection
+        self.tombstones_collection = tombstones_collection
+        self.overlap = timedelta(seconds=write_delay + CLOCK_SKEW_SECONDS)
+        books_collection.create_index([("userId", 1), ("updatedAt", 1)])
+        tombstones_collection.create_index([("userId", 1), ("deletedAt", 1)])
+        tombstones_collection.create_index("deletedAt", expireAfterSeconds=TOMBSTONE_TTL_DAYS * 86400)
+
+    def current_token(self):
+        return encode_token(datetime.now(timezone.utc))
+
+    def record_deletes(self, user_id, book_ids):
+        """Leave tombstones so other clients learn about the deletions"""
+        if not user_id or not book_ids:
+            return
+        now = datetime.now(timezone.utc)
+        self.tombstones_collection.insert_many([
+            {"userId": user_id, "bookId": str(book_id), "deletedAt": now} for book_id in book_ids
+        ])
+
+    def changes_since(self, user_id, since):
+        """
+        (books, deleted IDs, token, reset) for changes after since
+        reset=True means the client must reload its full list instead:
+        no/expired token or too many changes.
+        """
+        now = datetime.now(timezone.utc)
+        token = encode_token(now)
+        if since is None or since < now - timedelta(days=TOMBSTONE_TTL_DAYS):
+            return [], [], token, True
+
+        window = since - self.overlap
+        books = list(self.books_collection.find(
+            {"userId": user_id, "updatedAt": {"$gt": window}}, LIST_PROJECTION
+        ).sort("updatedAt", 1).limit(MAX_CHANGES + 1))
+        if len(books) > MAX_CHANGES:
+            return [], [], token, True
+
+        deleted = [
+            t["bookId"] for t in self.tombstones_collection.find(
+                {"userId": user_id, "deletedAt": {"$gt": window}}, {"bookId": 1}
+            )
+        ]
+        return books, deleted, token, False
@@ -0,0 +1,370 @@
+"""
+Real-time collaborative editing for books
+Each open book gets an in-memory room holding the current content and
+revision. Clients send single insert/delete operations against the
+revision they have seen; the server transforms them over any concurrent
+operations, applies them, acks the sender and broadcasts to the other
+sessions. Dirty rooms are flushed to MongoDB on an interval instead of
+once per keystroke.
+
+Rooms live in the worker process, so all sessions of a book must reach
+the same worker (sticky routing on the book ID when running several).
+"""
+
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from summaries import SUMMARY_PROJECTION, content_preview, word_count
+
+from tracing import logger
+
+FLUSH_INTERVAL = float(os.getenv("COLLAB_FLUSH_SECONDS", 5))
+HISTORY_SIZE = 500
+
+
+class StaleRevision(Exception):
+    """The client's base revision is older than the room's history"""
+
+
+# ==================== OPERATIONS ====================
+# insert: {"type": "insert", "pos": int, "text": str}
+# delete: {"type": "delete", "pos": int, "length": int}
+
+def parse_op(op):
+    """Check the shape of a client operation and strip unknown keys"""
+    if not isinstance(op, dict):
+        raise ValueError("Operation must be an object")
+    pos = op.get("pos")
+    if not isinstance(pos, int) or pos < 0:
+        raise ValueError("Operation position must be a non-negative integer")
+    if op.get("type") == "insert":
+        if not isinstance(op.get("text"), str) or not op["text"]:
+            raise ValueError("Insert needs non-empty text")
+        return {"type": "insert", "pos": pos, "text": op["text"]}
+    if op.get("type") == "delete":
+        length = op.get("length")
+        if not isinstance(length, int) or length <= 0:
+            raise ValueError("Delete length must be a positive integer")
+        return {"type": "delete", "pos": pos, "length": length}
+    raise ValueError("Unknown operation type")
+
+
+def apply_op(content, op):
+    pos = op["pos"]
+    if op["type"] == "insert":
+        if pos > len(content):
+            raise ValueError("Operation position out of range")
+        return content[:pos] + op["text"] + content[pos:]
+    if pos + op["length"] > len(content):
+        raise ValueError("Delete range out of range")
+    return content[:pos] + content[pos + op["length"]:]
+
+
+def transform(op, prior, prior_first=True):
+    """
+    Rewrite op (made without seeing prior) so it applies after prior
+    Returns a list, since a delete can be split by a concurrent insert.
+    prior_first says which of two inserts at the same position goes first.
+    """
+    pos = op["pos"]
+    if prior["type"] == "insert":
+        shift = len(prior["text"])
+        if op["type"] == "insert":
+            # Ties go to the operation that reached the server first
+            ahead = prior["pos"] < pos or (prior["pos"] == pos and prior_first)
+            return [dict(op, pos=pos + shift)] if ahead else [op]
+        end = pos + op["length"]
+        if prior["pos"] <= pos:
+            return [dict(op, pos=pos + shift)]
+        if prior["pos"] >= end:
+            return [op]
+        # Insert landed inside the deleted range: keep the inserted text
+        before = prior["pos"] - pos
+        return [
+            {"type": "delete", "pos": pos, "length": before},
+            {"type": "delete", "pos": pos + shift, "length": op["length"] - before},
+        ]
+
+    prior_end = prior["pos"] + prior["length"]
+    if op["type"] == "insert":
+        if pos <= prior["pos"]:
+            return [op]
+        if pos >= prior_end:
+            return [dict(op, pos=pos - prior["length"])]
+        return [dict(op, pos=prior["pos"])]
+
+    end = pos + op["length"]
+    if end <= prior["pos"]:
+        return [op]
+    if pos >= prior_end:
+        return [dict(op, pos=pos - prior["length"])]
+    # Overlapping deletes: only remove what is still there
+    overlap = min(end, prior_end) - max(pos, prior["pos"])
+    remaining = op["length"] - overlap
+    if remaining <= 0:
+        return []
+    return [{"type": "delete", "pos": min(pos, prior["pos"]), "length": remaining}]
+
+
+def transform_ops(ops, priors):
+    """
+    Transform two op lists made on the same content against each other
+    Both lists are sequences: each op applies to the result of the ones
+    before it (as the halves of a split delete do). Returns (ops rewritten
+    to apply after priors, priors rewritten to apply after ops); priors
+    reached the server first.
+    """
+    if not ops or not priors:
+        return ops, priors
+    if len(ops) > 1:
+        # The head moves past all priors, the rest past the priors as moved past the head
+        head, moved = transform_ops(ops[:1], priors)
+        rest, moved = transform_ops(ops[1:], moved)
+        return head + rest, moved
+    if len(priors) > 1:
+        ops, first = transform_ops(ops, priors[:1])
+        ops, rest = transform_ops(ops, priors[1:])
+        return ops, first + rest
+    op, prior = ops[0], priors[0]
+    return transform(op, prior), transform(prior, op, prior_first=False)
+
+
+# ==================== ROOMS ====================
+
+class Session:
+    """One WebSocket connection; sends are serialized with a lock"""
+
+    def __init__(self, ws, client_id):
+        self.ws = ws
+        self.client_id = client_id
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        payload = json.dumps(message)
+        with self.lock:
+            self.ws.send(payload)
+
+
+class Room:
+    def __init__(self, book_id, content, revision):
+        self.book_id = book_id
+        self.content = content
+        self.revision = revision
+        self.word_count = None
+        self.history = deque(maxlen=HISTORY_SIZE)  # (revision, ops) pairs
+        self.sessions = set()
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()     # one flush of the room in flight at a time
+
+    def submit(self, base_revision, op, word_count=None):
+        """Transform op up to the current revision and apply it; returns (revision, ops)"""
+        with self.lock:
+            if base_revision > self.revision:
+                raise ValueError("Revision is ahead of the server")
+            missed = self.revision - base_revision
+            if missed > len(self.history):
+                raise StaleRevision()
+            ops = [op]
+            for _, prior_ops in list(self.history)[len(self.history) - missed:]:
+                ops, _ = transform_ops(ops, prior_ops)
+            content = self.content
+            for o in ops:
+                content = apply_op(content, o)
+            self.content = content
+            self.revision += 1
+            self.history.append((self.revision, ops))
+            if word_count is not None:
+                self.word_count = word_count
+            self.dirty = True
+            return self.revision, ops
+
+    def replace(self, content, word_count=None):
+        """
+        Full-content replacement (e.g. a REST PUT while sessions are open)
+        word_count is the one saved with it; None leaves the stored count
+        alone instead of letting the next flush restore the room's old one
+        """
+        with self.lock:
+            self.word_count = word_count
+            ops = []
+            if self.content:
+                ops.append({"type": "delete", "pos": 0, "length": len(self.content)})
+            if content:
+                ops.append({"type": "insert", "pos": 0, "text": content})
+            self.content = content
+            self.revision += 1
+            self.history.append((self.revision, ops))
+            return self.revision, ops
+
+    def snapshot(self):
+        with self.lock:
+            return {"type": "init", "revision": self.revision, "content": self.content}
+
+    def broadcast(self, message, exclude=None):
+        for session in list(self.sessions):
+            if session is exclude:
+                continue
+            try:
+                session.send(message)
+            except Exception:
+                self.sessions.discard(session)
+
+
+class CollabHub:
+    """Keeps the open rooms of this worker and flushes them to MongoDB"""
+
+    def __init__(self, books_collection, summary_store=None, flush_interval=FLUSH_INTERVAL):
+        self.books_collection = books_collection
+        self.summary_store = summary_store
+        self.flush_interval = flush_interval
+        self.rooms = {}
+        self.closed = Counter()  # book_id -> rooms closed, so a join can tell its read went stale
+        self.lock = threading.Lock()
+        self._flusher = None
+
+    def join(self, book_id, session):
+        while True:
+            with self.lock:
+                room = self.rooms.get(book_id)
+                if room is not None:
+                    return self._enter(room, session)
+                closed = self.closed[book_id]
+            # Read the book without holding up every other join and leave
+            book = self.books_collection.find_one(
+                {"_id": ObjectId(book_id)}, {"content": 1, "revision": 1}
+            )
+            if not book:
+                return None
+            with self.lock:
+                room = self.rooms.get(book_id)
+                if room is None:
+                    if self.closed[book_id] != closed:
+                        continue    # a room was flushed and closed meanwhile: our read may predate it
+                    room = Room(book_id, book.get("content", ""), book.get("revision", 0))
+                    self.rooms[book_id] = room
+                return self._enter(room, session)
+
+    def _enter(self, room, session):
+        """Add session to room (call with the hub lock held)"""
+        room.sessions.add(session)
+        self._ensure_flusher()
+        return room
+
+    def leave(self, room, session):
+        with self.lock:
+            room.sessions.discard(session)
+            if room.sessions:
+                return
+        # The room stays joinable until its last ops are in Mongo, so a new
+        # session never starts from content older than the room's
+        self.flush_room(room)
+        self._close_if_idle(room)
+
+    def _close_if_idle(self, room):
+        """Drop a room nobody is in once everything it holds is flushed"""
+        with self.lock:
+            if room.sessions or room.dirty or self.rooms.get(room.book_id) is not room:
+                return
+            del self.rooms[room.book_id]
+            self.closed[room.book_id] += 1
+
+    def get(self, book_id):
+        return self.rooms.get(book_id)
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="collab-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_all()
+
+    def flush_all(self):
+        for room in list(self.rooms.values()):
+            self.flush_room(room)
+            if not room.sessions:
+                self._close_if_idle(room)   # its last leave could not flush it
+
+    def flush_room(self, room):
+        with room.flush_lock:
+            self._flush_room(room)
+
+    def _flush_room(self, room):
+        with room.lock:
+            if not room.dirty:
+                return
+            update = {
+                "content": room.content,
+                "contentPreview": content_preview(room.content),
+                "revision": room.revision,
+                "updatedAt": datetime.now(timezone.utc),
+            }
+            if room.word_count is not None:
+                update["wordCount"] = room.word_count
+            room.dirty = False
+        try:
+            before = self.books_collection.find_one_and_update(
+                {"_id": ObjectId(room.book_id)},
+                {"$set": update},
+                projection=SUMMARY_PROJECTION,
+                return_document=ReturnDocument.BEFORE
+            )
+            if before and self.summary_store:
+                self.summary_store.record_change(before, dict(before, **update))
+        except Exception:
+            room.dirty = True
+            logger.exception("Error flushing collaborative edits", extra={"fields": {"bookId": room.book_id}})
+
+
+def handle_session(hub, ws, book_id):
+    """
+    Run one WebSocket session until the client disconnects
+    Client -> server: {"type": "op", "baseRevision": n, "op": {...}, "opId": "...", "wordCount": n}
+    Server -> client: init / ack / op / resync / error messages
+    """
+    session = Session(ws, client_id=os.urandom(6).hex())
+    room = hub.join(book_id, session)
+    if room is None:
+        session.send({"type": "error", "message": "Book not found"})
+        return
+    try:
+        init = room.snapshot()
+        init["clientId"] = session.client_id
+        session.send(init)
+        while True:
+            raw = ws.receive()
+            if raw is None:
+                break
+            op_id = None
+            try:
+                message = json.loads(raw)
+                if not isinstance(message, dict) or message.get("type") != "op":
+                    raise ValueError("Unsupported message type")
+                op_id = message.get("opId")
+                base_revision = int(message.get("baseRevision", -1))
+                if base_revision < 0:
+                    raise ValueError("baseRevision is required")
+                op = parse_op(message.get("op"))
+                words = message.get("wordCount")
+                revision, ops = room.submit(base_revision, op, None if words is None else word_count(words))
+            except StaleRevision:
+                session.send(dict(room.snapshot(), type="resync"))
+                continue
+            except (ValueError, TypeError) as e:
+                session.send({"type": "error", "message": str(e), "opId": op_id})
+                continue
+            session.send({"type": "ack", "revision": revision, "ops": ops, "opId": op_id})
+            room.broadcast({"type": "op", "revision": revision, "ops": ops,
+                            "clientId": session.client_id}, exclude=session)
+    finally:
+        hub.leave(room, session)
@@ -0,0 +1,751 @@
+"""
+Server-side book export
+Streams a book's HTML content as plain text, Markdown, EPUB or DOCX.
+The HTML is parsed incrementally into blocks, each block is rendered as
+soon as it is complete, and ZIP-based formats are written through a
+non-seekable stream, so memory stays bounded by the chunk size rather
+than the length of the manuscript. Decoded covers and finished exports
+of unchanged books are cached in memory.
+"""
+
+import base64
+import binascii
+import hashlib
+import ipaddress
+import os
+import re
+import struct
+import socket
+import threading
+import urllib.parse
+import urllib.request
+import uuid
+import zipfile
+from collections import OrderedDict
+from datetime import datetime, timezone
+from html import escape
+from html.parser import HTMLParser
+
+CHUNK_SIZE = 64 * 1024
+EXPORT_CACHE_BYTES = int(float(os.getenv("EXPORT_CACHE_MB", 64)) * 1024 * 1024)
+EXPORT_CACHE_ITEM_BYTES = EXPORT_CACHE_BYTES // 4
+COVER_CACHE_SIZE = 32
+COVER_MAX_BYTES = 5 * 1024 * 1024
+# Hosts remote https covers may be fetched from; empty (the default) means data URLs / base64 only
+COVER_URL_HOSTS = {h.strip().lower() for h in os.getenv("COVER_URL_HOSTS", "").split(",") if h.strip()}
+
+FORMATS = {
+    "txt": ("text/plain; charset=utf-8", "txt"),
+    "md": ("text/markdown; charset=utf-8", "md"),
+    "epub": ("application/epub+zip", "epub"),
+    "docx": ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "docx"),
+}
+FORMAT_ALIASES = {"text": "txt", "plain": "txt", "markdown": "md"}
+
+
+# ==================== HTML -> BLOCKS ====================
+
+BLOCK_TAGS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "li", "blockquote", "pre"}
+INLINE_MARKS = {"b": "b", "strong": "b", "i": "i", "em": "i", "u": "u",
+                "s": "s", "strike": "s", "del": "s"}
+SKIP_TAGS = {"script", "style", "head", "title"}
+WHITESPACE = re.compile(r"[ \t\r\n\f]+")
+
+
+class Block:
+    """One paragraph-level element: kind (p, h1..h6, li, blockquote, pre) and styled runs"""
+
+    __slots__ = ("kind", "runs", "ordered", "number", "depth")
+
+    def __init__(self, kind, runs, ordered=False, number=0, depth=0):
+        self.kind = kind
+        self.runs = runs  # [(text, frozenset of marks)]
+        self.ordered = ordered
+        self.number = number
+        self.depth = depth
+
+    @property
+    def text(self):
+        return "".join(text for text, _ in self.runs)
+
+
+class _BlockParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.ready = []
+        self.runs = []
+        self.kind = "p"
+        self.marks = {}
+        self.lists = []  # [ordered, counter] per open list
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip += 1
+        elif tag in INLINE_MARKS:
+            mark = INLINE_MARKS[tag]
+            self.marks[mark] = self.marks.get(mark, 0) + 1
+        elif tag == "br":
+            self._add("\n", raw=True)
+        elif tag in ("ul", "ol"):
+            self._end_block()
+            self.lists.append([tag == "ol", 0])
+        elif tag in BLOCK_TAGS:
+            if tag in ("p", "div") and self.kind == "li" and not self.runs:
+                return  # <li><p>...</p></li> stays a list item
+            self._end_block()
+            self.kind = "p" if tag == "div" else tag
+            if tag == "li" and self.lists:
+                self.lists[-1][1] += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip = max(0, self.skip - 1)
+        elif tag in INLINE_MARKS:
+            mark = INLINE_MARKS[tag]
+            self.marks[mark] = max(0, self.marks.get(mark, 0) - 1)
+        elif tag in ("ul", "ol"):
+            self._end_block()
+            if self.lists:
+                self.lists.pop()
+        elif tag in BLOCK_TAGS:
+            self._end_block()
+
+    def handle_data(self, data):
+        if not self.skip:
+            self._add(data if self.kind == "pre" else WHITESPACE.sub(" ", data))
+
+    def _add(self, text, raw=False):
+        if not text:
+            return
+        if not self.runs and not raw:
+            text = text.lstrip(" ")
+            if not text:
+                return
+        marks = frozenset(m for m, depth in self.marks.items() if depth)
+        if self.runs and self.runs[-1][1] == marks:
+            self.runs[-1] = (self.runs[-1][0] + text, marks)
+        else:
+            self.runs.append((text, marks))
+
+    def _end_block(self):
+        if self.runs:
+            last_text, last_marks = self.runs[-1]
+            self.runs[-1] = (last_text.rstrip(" "), last_marks)
+            if any(text.strip() for text, _ in self.runs):
+                block = Block(self.kind, self.runs)
+                if self.kind == "li" and self.lists:
+                    block.ordered, block.number = self.lists[-1]
+                    block.depth = len(self.lists) - 1
+                self.ready.append(block)
+        self.runs = []
+        self.kind = "p"
+
+    def drain(self):
+        ready, self.ready = self.ready, []
+        return ready
+
+
+def iter_content(content, size=CHUNK_SIZE):
+    """Slice a content string into chunks"""
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+
+def iter_blocks(chunks):
+    """Parse HTML chunks into Blocks as soon as each block is complete"""
+    parser = _BlockParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.drain()
+    parser.close()
+    parser._end_block()
+    yield from parser.drain()
+
+
+# ==================== TEXT / MARKDOWN ====================
+
+MD_SPECIAL = re.compile(r"([\\`*_\[\]#<>])")
+
+
+def md_escape(text):
+    return MD_SPECIAL.sub(r"\\\1", text)
+
+
+def _list_prefix(block, markdown=False):
+    indent = ("   " if markdown else "  ") * block.depth
+    return f"{indent}{block.number}. " if block.ordered else f"{indent}{'-' if markdown else '•'} "
+
+
+def render_text(book, blocks):
+    title = book.get("title", "")
+    yield f"{title}\n{'=' * len(title)}\n\n"
+    for block in blocks:
+        text = block.text
+        if block.kind == "li":
+            text = _list_prefix(block) + text
+        elif block.kind == "blockquote":
+            text = "    " + text.replace("\n", "\n    ")
+        elif block.kind.startswith("h"):
+            text = text.upper() if block.kind in ("h1", "h2") else text
+        yield text + "\n\n"
+
+
+def _md_run(text, marks):
+    if "\n" in text:
+        return "  \n".join(_md_run(part, marks) for part in text.split("\n"))
+    stripped = text.strip()
+    if not stripped:
+        return text
+    body = md_escape(stripped)
+    if "s" in marks:
+        body = f"~~{body}~~"
+    if "i" in marks:
+        body = f"*{body}*"
+    if "b" in marks:
+        body = f"**{body}**"
+    lead = text[:len(text) - len(text.lstrip())]
+    trail = text[len(text.rstrip()):]
+    return lead + body + trail
+
+
+def render_markdown(book, blocks):
+    yield f"# {md_escape(book.get('title', ''))}\n\n"
+    if book.get("description"):
+        yield f"_{md_escape(book['description'])}_\n\n"
+    for block in blocks:
+        if block.kind == "pre":
+            yield f"```\n{block.text}\n```\n\n"
+            continue
+        text = "".join(_md_run(t, m) for t, m in block.runs)
+        if block.kind.startswith("h") and len(block.kind) == 2:
+            # The book title is the only level-1 heading
+            text = "#" * min(int(block.kind[1]) + 1, 6) + " " + text
+        elif block.kind == "li":
+            text = _list_prefix(block, markdown=True) + text
+        elif block.kind == "blockquote":
+            text = "> " + text.replace("\n", "\n> ")
+        yield text + "\n\n"
+
+
+# ==================== STREAMING ZIP ====================
+
+class _ZipStream:
+    """Write-only, non-seekable sink that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _stream_zip(build):
+    """
+    Run build(zip_file, stream) and yield the archive bytes as they are produced
+    build is a generator that yields whenever it wants buffered bytes flushed
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for _ in build(zf):
+            data = stream.take()
+            if data:
+                yield data
+    data = stream.take()
+    if data:
+        yield data
+
+
+def _write_streamed(zf, name, pieces, flush_every=CHUNK_SIZE):
+    """Write str pieces into one archive member, yielding after every ~chunk"""
+    with zf.open(name, "w", force_zip64=True) as member:
+        pending = 0
+        for piece in pieces:
+            data = piece.encode("utf-8")
+            member.write(data)
+            pending += len(data)
+            if pending >= flush_every:
+                pending = 0
+                yield
+
+
+# ==================== COVERS ====================
+
+_cover_cache = OrderedDict()
+_cover_lock = threading.Lock()
+
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png", "png"),
+    (b"\xff\xd8\xff", "image/jpeg", "jpg"),
+    (b"GIF8", "image/gif", "gif"),
+    (b"RIFF", "image/webp", "webp"),
+)
+
+
+def _sniff_image(data):
+    for signature, media_type, ext in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return media_type, ext
+    return None
+
+
+def _image_size(data):
+    """(width, height) for PNG/JPEG/GIF headers, None if unknown"""
+    try:
+        if data.startswith(b"\x89PNG"):
+            return struct.unpack(">II", data[16:24])
+        if data.startswith(b"GIF8"):
+            return struct.unpack("<HH", data[6:10])
+        if data.startswith(b"\xff\xd8"):
+            i = 2
+            while i < len(data) - 9:
+                if data[i] != 0xFF:
+                    i += 1
+                    continue
+                marker = data[i + 1]
+                length = struct.unpack(">H", data[i + 2:i + 4])[0]
+                if marker in (0xC0, 0xC1, 0xC2):
+                    height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                    return width, height
+                i += 2 + length
+    except struct.error:
+        pass
+    return None
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    """A redirect could lead anywhere, including past the host checks"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_cover_opener = urllib.request.build_opener(_NoRedirects)
+
+
+def _remote_cover_allowed(url):
+    """https on an allow-listed host that only resolves to public addresses"""
+    parts = urllib.parse.urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme != "https" or host not in COVER_URL_HOSTS:
+        return False
+    try:
+        addresses = socket.getaddrinfo(host, parts.port or 443, proto=socket.IPPROTO_TCP)
+    except OSError:
+        return False
+    return bool(addresses) and all(
+        ipaddress.ip_address(address[4][0].split("%")[0]).is_global for address in addresses
+    )
+
+
+def load_cover(cover_image):
+    """
+    Decode a book's coverImage (data URL, bare base64, or https URL on a COVER_URL_HOSTS host)
+    Returns (bytes, media_type, ext) or None; results are cached by content hash
+    """
+    if not cover_image:
+        return None
+    key = hashlib.sha1(cover_image.encode()).hexdigest()
+    with _cover_lock:
+        if key in _cover_cache:
+            _cover_cache.move_to_end(key)
+            return _cover_cache[key]
+
+    data = None
+    try:
+        if cover_image.startswith("data:"):
+            data = base64.b64decode(cover_image.split(",", 1)[1])
+        elif cover_image.startswith(("http://", "https://")):
+            # User-supplied URLs are fetched by the server: never internal hosts
+            if _remote_cover_allowed(cover_image):
+                with _cover_opener.open(cover_image, timeout=5) as resp:
+                    data = resp.read(COVER_MAX_BYTES + 1)
+                if len(data) > COVER_MAX_BYTES:
+                    data = None
+        else:
+            data = base64.b64decode(cover_image, validate=True)
+    except (binascii.Error, ValueError, OSError):
+        data = None
+
+    kind = _sniff_image(data) if data else None
+    cover = (data, kind[0], kind[1]) if kind else None
+    with _cover_lock:
+        _cover_cache[key] = cover
+        while len(_cover_cache) > COVER_CACHE_SIZE:
+            _cover_cache.popitem(last=False)
+    return cover
+
+
+# ==================== EPUB ====================
+
+EPUB_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+XHTML_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><meta charset="utf-8"/><title>{title}</title></head>
+<body>
+"""
+XHTML_TAIL = "</body>\n</html>\n"
+XHTML_MARKS = (("b", "strong"), ("i", "em"), ("u", "u"), ("s", "s"))
+
+
+def _xhtml_runs(block):
+    out = []
+    for text, marks in block.runs:
+        piece = escape(text, quote=False).replace("\n", "<br/>")
+        for mark, tag in XHTML_MARKS:
+            if mark in marks:
+                piece = f"<{tag}>{piece}</{tag}>"
+        out.append(piece)
+    return "".join(out)
+
+
+def _xhtml_block(block):
+    body = _xhtml_runs(block)
+    if block.kind == "li":
+        # Flattened lists: keep numbering/indent without nesting state
+        marker = f"{block.number}. " if block.ordered else "• "
+        return f'<p style="margin-left:{1.5 * (block.depth + 1)}em">{marker}{body}</p>\n'
+    if block.kind == "pre":
+        return f"<pre>{body}</pre>\n"
+    return f"<{block.kind}>{body}</{block.kind}>\n"
+
+
+def render_epub(book, blocks):
+    title = escape(book.get("title", "Untitled"))
+    cover = load_cover(book.get("coverImage"))
+    chapters = []  # (file name, title)
+
+    def chapter_pieces(first_block, block_iter):
+        yield XHTML_HEAD.format(title=title)
+        if first_block is not None:
+            yield _xhtml_block(first_block)
+        for block in block_iter:
+            yield _xhtml_block(block)
+        yield XHTML_TAIL
+
+    def build(zf):
+        zf.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", EPUB_CONTAINER)
+        yield
+
+        # Start a new chapter file at every h1/h2 so readers get a usable TOC
+        block_iter = iter(blocks)
+        carry = None
+        while True:
+            name = f"chapter{len(chapters) + 1:03d}.xhtml"
+            chapters.append((name, carry.text if carry else book.get("title", "Untitled")))
+            split = _ChapterSplitter(block_iter, started=carry is not None)
+            yield from _write_streamed(zf, f"OEBPS/{name}", chapter_pieces(carry, split))
+            carry = split.next_heading
+            if carry is None:
+                break
+
+        if cover:
+            zf.writestr(f"OEBPS/cover.{cover[2]}", cover[0])
+            yield
+
+        nav_items = "".join(
+            f'<li><a href="{name}">{escape(label)}</a></li>' for name, label in chapters
+        )
+        zf.writestr("OEBPS/nav.xhtml", XHTML_HEAD.format(title=title)
+                    + f'<nav epub:type="toc"><h1>{title}</h1><ol>{nav_items}</ol></nav>\n'
+                    + XHTML_TAIL)
+        zf.writestr("OEBPS/content.opf", _epub_opf(book, chapters, cover))
+        yield
+
+    return _stream_zip(build)
+
+
+class _ChapterSplitter:
+    """Iterate blocks until the next h1/h2 (kept in next_heading)"""
+
+    def __init__(self, blocks, started=False):
+        self.blocks = blocks
+        self.next_heading = None
+        self.count = 1 if started else 0
+
+    def __iter__(self):
+        for block in self.blocks:
+            if block.kind in ("h1", "h2") and self.count:
+                self.next_heading = block
+                return
+            self.count += 1
+            yield block
+
+
+def _epub_opf(book, chapters, cover):
+    book_id = book.get("_id") or uuid.uuid4().hex
+    modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>']
+    spine = []
+    for n, (name, _) in enumerate(chapters, 1):
+        manifest.append(f'<item id="c{n}" href="{name}" media-type="application/xhtml+xml"/>')
+        spine.append(f'<itemref idref="c{n}"/>')
+    if cover:
+        manifest.append(f'<item id="cover" href="cover.{cover[2]}" media-type="{cover[1]}" properties="cover-image"/>')
+    description = f"<dc:description>{escape(book['description'])}</dc:description>" if book.get("description") else ""
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="bookid">urn:typen:{escape(str(book_id))}</dc:identifier>
+    <dc:title>{escape(book.get("title", "Untitled"))}</dc:title>
+    <dc:language>en</dc:language>
+    {description}
+    <meta property="dcterms:modified">{modified}</meta>
+  </metadata>
+  <manifest>{"".join(manifest)}</manifest>
+  <spine>{"".join(spine)}</spine>
+</package>
+"""
+
+
+# ==================== DOCX ====================
+
+DOCX_NS = ('xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+           'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+           'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing" '
+           'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+           'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture"')
+
+DOCX_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+  <w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/>
+    <w:pPr><w:spacing w:after="160" w:line="276" w:lineRule="auto"/></w:pPr>
+    <w:rPr><w:rFonts w:ascii="Georgia" w:hAnsi="Georgia"/><w:sz w:val="24"/></w:rPr></w:style>
+  <w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/>
+    <w:rPr><w:b/><w:sz w:val="56"/></w:rPr></w:style>
+  <w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/>
+    <w:pPr><w:keepNext/><w:outlineLvl w:val="0"/></w:pPr><w:rPr><w:b/><w:sz w:val="40"/></w:rPr></w:style>
+  <w:style w:type="paragraph" w:styleId="Heading2"><w:name w:val="heading 2"/><w:basedOn w:val="Normal"/>
+    <w:pPr><w:keepNext/><w:outlineLvl w:val="1"/></w:pPr><w:rPr><w:b/><w:sz w:val="32"/></w:rPr></w:style>
+  <w:style w:type="paragraph" w:styleId="Heading3"><w:name w:val="heading 3"/><w:basedOn w:val="Normal"/>
+    <w:pPr><w:keepNext/><w:outlineLvl w:val="2"/></w:pPr><w:rPr><w:b/><w:sz w:val="28"/></w:rPr></w:style>
+  <w:style w:type="paragraph" w:styleId="Quote"><w:name w:val="Quote"/><w:basedOn w:val="Normal"/>
+    <w:pPr><w:ind w:left="720"/></w:pPr><w:rPr><w:i/></w:rPr></w:style>
+</w:styles>
+"""
+
+DOCX_MARKS = (("b", "<w:b/>"), ("i", "<w:i/>"), ("u", '<w:u w:val="single"/>'), ("s", "<w:strike/>"))
+
+
+def _docx_paragraph(runs, style=None, indent=None, prefix=""):
+    props = ""
+    if style or indent:
+        props = "<w:pPr>"
+        if style:
+            props += f'<w:pStyle w:val="{style}"/>'
+        if indent:
+            props += f'<w:ind w:left="{indent}" w:hanging="360"/>'
+        props += "</w:pPr>"
+    out = [f"<w:p>{props}"]
+    if prefix:
+        runs = [(prefix, frozenset())] + list(runs)
+    for text, marks in runs:
+        rpr = "".join(tag for mark, tag in DOCX_MARKS if mark in marks)
+        rpr = f"<w:rPr>{rpr}</w:rPr>" if rpr else ""
+        lines = escape(text, quote=False).split("\n")
+        body = "<w:br/>".join(f'<w:t xml:space="preserve">{line}</w:t>' for line in lines)
+        out.append(f"<w:r>{rpr}{body}</w:r>")
+    out.append("</w:p>")
+    return "".join(out)
+
+
+def _docx_block(block):
+    if block.kind in ("h1", "h2", "h3", "h4", "h5", "h6"):
+        return _docx_paragraph(block.runs, style=f"Heading{min(int(block.kind[1]), 3)}")
+    if block.kind == "blockquote":
+        return _docx_paragraph(block.runs, style="Quote")
+    if block.kind == "li":
+        prefix = f"{block.number}.\t" if block.ordered else "•\t"
+        return _docx_paragraph(block.runs, indent=720 * (block.depth + 1), prefix=prefix)
+    return _docx_paragraph(block.runs)
+
+
+def _docx_cover(cover):
+    """Inline picture paragraph, scaled to 4 inches wide"""
+    size = _image_size(cover[0]) or (2, 3)
+    cx = 4 * 914400
+    cy = int(cx * size[1] / size[0]) if size[0] else cx * 3 // 2
+    return (
+        '<w:p><w:pPr><w:jc w:val="center"/></w:pPr><w:r><w:drawing>'
+        f'<wp:inline><wp:extent cx="{cx}" cy="{cy}"/><wp:docPr id="1" name="Cover"/>'
+        '<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+        '<pic:pic><pic:nvPicPr><pic:cNvPr id="1" name="Cover"/><pic:cNvPicPr/></pic:nvPicPr>'
+        '<pic:blipFill><a:blip r:embed="rIdCover"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+        f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+        '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></pic:spPr></pic:pic>'
+        '</a:graphicData></a:graphic></wp:inline></w:drawing></w:r></w:p>'
+        '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+    )
+
+
+def render_docx(book, blocks):
+    cover = load_cover(book.get("coverImage"))
+
+    def document_pieces():
+        yield f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:document {DOCX_NS}><w:body>'
+        if cover:
+            yield _docx_cover(cover)
+        yield _docx_paragraph([(book.get("title", "Untitled"), frozenset())], style="Title")
+        if book.get("description"):
+            yield _docx_paragraph([(book["description"], frozenset({"i"}))])
+        for block in blocks:
+            yield _docx_block(block)
+        yield "</w:body></w:document>"
+
+    def build(zf):
+        image_default = ""
+        image_rel = ""
+        if cover:
+            image_default = f'<Default Extension="{cover[2]}" ContentType="{cover[1]}"/>'
+            image_rel = (f'<Relationship Id="rIdCover" Type="http://schemas.openxmlformats.org/'
+                         f'officeDocument/2006/relationships/image" Target="media/cover.{cover[2]}"/>')
+        zf.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            f'{image_default}'
+            '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+            '</Types>'
+        ))
+        zf.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+            '</Relationships>'
+        ))
+        zf.writestr("word/_rels/document.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rIdStyles" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+            f'{image_rel}'
+            '</Relationships>'
+        ))
+        zf.writestr("word/styles.xml", DOCX_STYLES)
+        if cover:
+            zf.writestr(f"word/media/cover.{cover[2]}", cover[0])
+        yield
+        yield from _write_streamed(zf, "word/document.xml", document_pieces())
+
+    return _stream_zip(build)
+
+
+# ==================== EXPORT CACHE ====================
+
+class ExportCache:
+    """LRU of finished exports keyed by book ID, revision and format"""
+
+    def __init__(self, max_bytes=EXPORT_CACHE_BYTES, max_item_bytes=EXPORT_CACHE_ITEM_BYTES):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_item_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and self.items:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def evict_book(self, book_id):
+        """Drop every cached export of a book (keys start with its ID)"""
+        with self.lock:
+            for key in [key for key in self.items if key[0] == book_id]:
+                self.size -= len(self.items.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def tee(self, key, chunks):
+        """Pass chunks through and cache the whole export if it completes and fits"""
+        parts = []
+        total = 0
+        for chunk in chunks:
+            if parts is not None:
+                total += len(chunk)
+                if total > self.max_item_bytes:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            self.put(key, b"".join(parts))
+
+
+export_cache = ExportCache()
+
+RENDERERS = {
+    "txt": render_text,
+    "md": render_markdown,
+    "epub": render_epub,
+    "docx": render_docx,
+}
+
+
+def normalize_format(fmt):
+    fmt = (fmt or "").lower()
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    return fmt if fmt in FORMATS else None
+
+
+def cache_key(book, fmt):
+    updated = book.get("updatedAt")
+    return (str(book["_id"]), book.get("revision", 0),
+            updated.isoformat() if updated else "", fmt)
+
+
+def export_filename(book, fmt):
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", book.get("title", "")).strip("-").lower() or "book"
+    return f"{slug[:80]}.{FORMATS[fmt][1]}"
+
+
+def stream_export(book, fmt):
+    """Yield the exported book as bytes in ~CHUNK_SIZE pieces, rendering block by block"""
+    blocks = iter_blocks(iter_content(book.get("content", "")))
+    buffer = []
+    buffered = 0
+    for piece in RENDERERS[fmt](book, blocks):
+        data = piece if isinstance(piece, bytes) else piece.encode("utf-8")
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= CHUNK_SIZE:
+            yield b"".join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b"".join(buffer)
@@ -0,0 +1,187 @@
+"""
+Liveness and readiness probes
+/healthz only says the process answers requests. /readyz runs the
+dependency probes (MongoDB ping, connection pool use, prediction
+providers, queue depths) and says whether this worker should get
+traffic. Probe results are cached for CACHE_SECONDS and only one caller
+refreshes them at a time (the others get the previous result), so load
+balancer checks never add load to MongoDB, however often they come.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from pymongo import monitoring
+
+from tracing import logger
+
+CACHE_SECONDS = float(os.getenv("HEALTH_CACHE_SECONDS", 5))
+SLOW_PING_MS = 500          # a slower ping is reported as degraded
+POOL_BUSY_RATIO = 0.9       # share of the pool checked out that counts as saturated
+PROVIDER_FAILING = 0.8      # smoothed error rate of a provider that is failing
+PROVIDER_DEGRADED = 0.2
+
+STARTED_AT = time.time()
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Counts checked-out connections and waiting checkouts across the pool
+    Pass an instance to MongoClient(event_listeners=[...])
+    """
+
+    def __init__(self):
+        self.in_use = 0
+        self.waiting = 0
+        self.failed_checkouts = 0
+        self.lock = threading.Lock()
+
+    def connection_check_out_started(self, event):
+        with self.lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            self.waiting -= 1
+            self.in_use += 1
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.waiting -= 1
+            self.failed_checkouts += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    # Pool lifecycle events we don't need
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def snapshot(self, max_pool_size=None):
+        with self.lock:
+            snapshot = {"inUse": self.in_use, "waiting": self.waiting, "failedCheckouts": self.failed_checkouts}
+        if max_pool_size:
+            snapshot["maxPoolSize"] = max_pool_size
+            snapshot["saturation"] = round(snapshot["inUse"] / max_pool_size, 3)
+        return snapshot
+
+
+def mongo_probe(client, pool_monitor):
+    """Ping latency and pool use; not ready when the ping fails or the pool is exhausted"""
+    started = time.perf_counter()
+    client.admin.command("ping")
+    ping_ms = round((time.perf_counter() - started) * 1000, 1)
+    pool_options = getattr(getattr(client, "options", None), "pool_options", None)
+    max_pool_size = getattr(pool_options, "max_pool_size", None)
+    pool = pool_monitor.snapshot(max_pool_size if isinstance(max_pool_size, int) else None)
+    saturated = pool.get("saturation", 0) >= POOL_BUSY_RATIO and pool["waiting"] > 0
+    return {
+        "ok": not saturated,
+        "degraded": ping_ms >= SLOW_PING_MS,
+        "pingMs": ping_ms,
+        "pool": pool,
+    }
+
+
+def provider_state(stats):
+    """closed / degraded / open from a provider's smoothed error rate (no calls yet: closed)"""
+    if stats["errorRate"] >= PROVIDER_FAILING:
+        return "open"
+    if stats["errorRate"] >= PROVIDER_DEGRADED:
+        return "degraded"
+    return "closed"
+
+
+def predictions_probe(engine, upstream_stats):
+    """
+    Ready while any provider is configured
+    A failing upstream is reported but doesn't fail readiness: it fails
+    every worker at once, and taking them all out of rotation helps no one.
+    Serving only fallbacks (no model configured, e.g. a missing API key)
+    is reported as degraded.
+    """
+    providers = engine.snapshot()
+    for stats in providers.values():
+        stats["state"] = provider_state(stats)
+    result = {
+        "ok": engine.available(),
+        "degraded": not engine.providers or any(stats["state"] != "closed" for stats in providers.values()),
+        "providers": providers,
+        "upstream": upstream_stats.snapshot(),
+    }
+    if not engine.providers:
+        result["warning"] = "No prediction model configured, serving fallbacks only"
+    return result
+
+
+class HealthChecker:
+    """Runs named probes and caches the combined result"""
+
+    def __init__(self, probes, cache_seconds=CACHE_SECONDS):
+        self.probes = probes    # name -> callable returning {"ok": bool, ...}
+        self.cache_seconds = cache_seconds
+        self.result = None
+        self.checked_at = 0.0
+        self.refresh_lock = threading.Lock()
+
+    def check(self):
+        """Cached probe results, refreshed by at most one caller at a time"""
+        if self.result is not None and time.monotonic() - self.checked_at < self.cache_seconds:
+            return self._aged()
+        # Someone is already probing: answer with the previous result instead of piling on
+        if not self.refresh_lock.acquire(blocking=self.result is None):
+            return self._aged()
+        try:
+            if self.result is not None and time.monotonic() - self.checked_at < self.cache_seconds:
+                return self._aged()
+            checks = {}
+            for name, probe in self.probes.items():
+                started = time.perf_counter()
+                try:
+                    checks[name] = probe()
+                except Exception as e:
+                    checks[name] = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                checks[name]["probeMs"] = round((time.perf_counter() - started) * 1000, 1)
+            ready = all(check["ok"] for check in checks.values())
+            if not ready and (self.result is None or self.result["ready"]):
+                logger.warning("Worker not ready", extra={"fields": {
+                    "failing": [name for name, check in checks.items() if not check["ok"]]
+                }})
+            self.result = {
+                "ready": ready,
+                "degraded": any(check.get("degraded") for check in checks.values()),
+                "checkedAt": datetime.now(timezone.utc).isoformat(),
+                "checks": checks,
+            }
+            self.checked_at = time.monotonic()
+        finally:
+            self.refresh_lock.release()
+        return self._aged()
+
+    def _aged(self):
+        return dict(self.result, ageSeconds=round(time.monotonic() - self.checked_at, 2))
+
+
+def liveness():
+    return {"pid": os.getpid(), "uptimeSeconds": round(time.time() - STARTED_AT, 1)}
@@ -0,0 +1,519 @@
+"""
+Bulk import of existing manuscripts
+Reads a multipart upload straight from the request stream and turns
+.txt, .md, .docx files (and zip archives of them) into books. Text is
+decoded and split into paragraphs as the bytes arrive; .docx and .zip
+need their central directory, so they are spooled (to disk past
+SPOOL_BYTES) and their XML is parsed with iterparse. Manuscripts longer
+than IMPORT_MAX_BOOK_MB are split into parts at chapter headings, and
+finished books are written in insert_many batches. Progress is reported
+as a stream of events, including throughput in MB/s.
+"""
+
+import codecs
+import os
+import re
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timezone
+from html import escape
+from xml.etree import ElementTree
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from summaries import content_preview
+from tracing import logger
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_BYTES = 1024 * 1024
+MAX_BOOK_BYTES = int(float(os.getenv("IMPORT_MAX_BOOK_MB", 4)) * 1024 * 1024)
+MAX_BOOKS = int(os.getenv("IMPORT_MAX_BOOKS", 1000))
+INSERT_BATCH_SIZE = 50
+INSERT_BATCH_BYTES = 8 * 1024 * 1024
+PROGRESS_INTERVAL = 0.5
+FORM_FIELD_BYTES = 64 * 1024
+
+# Same separator the editor uses between pages
+PAGE_BREAK = "<!-- page-break -->"
+
+EXTENSIONS = {".txt": "text", ".text": "text", ".md": "markdown", ".markdown": "markdown",
+              ".docx": "docx", ".zip": "zip"}
+
+
+class ImportLimitError(Exception):
+    """The upload would create more books than MAX_BOOKS, or is over its byte limit"""
+
+
+def file_kind(filename):
+    return EXTENSIONS.get(os.path.splitext(filename or "")[1].lower())
+
+
+def title_from_filename(filename):
+    stem = os.path.splitext(os.path.basename((filename or "").replace("\\", "/")))[0]
+    return re.sub(r"[_]+", " ", stem).strip() or "Untitled"
+
+
+def multipart_boundary(content_type):
+    """Boundary of a multipart/form-data Content-Type, or None"""
+    mimetype, options = parse_options_header(content_type or "")
+    if mimetype != "multipart/form-data":
+        return None
+    return options.get("boundary")
+
+
+# ==================== MANUSCRIPT -> BOOKS ====================
+
+class Manuscript:
+    """
+    Collects the headings and paragraphs of one file as editor HTML
+    Once the content passes max_bytes it is emitted as a part at the next
+    chapter heading (or, with no heading in sight, at twice the size).
+    """
+
+    def __init__(self, title, emit, max_bytes=MAX_BOOK_BYTES):
+        self.title = title
+        self.emit = emit  # emit(title, content, word_count)
+        self.max_bytes = max_bytes
+        self.pieces = []
+        self.size = 0
+        self.words = 0
+        self.part = 1
+        self.chapters = 0
+
+    def heading(self, text, level=2):
+        text = text.strip()
+        if not text:
+            return
+        if level <= 2:
+            if self.size >= self.max_bytes:
+                self._emit_part()
+            elif self.pieces:
+                self.pieces.append(PAGE_BREAK)
+            self.chapters += 1
+        self._append(f"<h{level}>{escape(text, quote=False)}</h{level}>", text)
+
+    def paragraph(self, html, text):
+        if not text.strip():
+            return
+        if self.size >= self.max_bytes * 2:
+            self._emit_part()
+        self._append(f"<p>{html}</p>", text)
+
+    def _append(self, html, text):
+        self.pieces.append(html)
+        self.size += len(html)
+        self.words += len(text.split())
+
+    def _emit_part(self, final=False):
+        if not self.pieces:
+            return
+        title = self.title if final and self.part == 1 else f"{self.title} (Part {self.part})"
+        self.emit(title, "".join(self.pieces), self.words)
+        self.pieces = []
+        self.size = 0
+        self.words = 0
+        self.part += 1
+
+    def finish(self):
+        self._emit_part(final=True)
+
+
+# ==================== TEXT / MARKDOWN ====================
+
+CHAPTER_HEADING = re.compile(
+    r"^(chapter|part|book|prologue|epilogue|interlude|afterword|foreword)\b[\w .:,'\-]{0,60}$",
+    re.IGNORECASE
+)
+MD_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*$")
+MD_RULE = re.compile(r"^([-*_])(\s*\1){2,}$")
+MD_STRONG = re.compile(r"(\*\*|__)(?=\S)(.+?)(?<=\S)\1")
+MD_EM = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1")
+MD_MARKERS = re.compile(r"[*_]{1,2}")
+
+
+def md_inline(text):
+    html = escape(text, quote=False)
+    return MD_EM.sub(r"<em>\2</em>", MD_STRONG.sub(r"<strong>\2</strong>", html))
+
+
+class TextParser:
+    """
+    Push parser for plain text and Markdown
+    Blank lines end paragraphs; "Chapter 3"-style lines (or # headings in
+    Markdown) become chapter headings.
+    """
+
+    def __init__(self, manuscript, markdown=False):
+        self.manuscript = manuscript
+        self.markdown = markdown
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+        self.pending = ""
+        self.lines = []
+
+    def write(self, data):
+        lines = (self.pending + self.decoder.decode(data)).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self._line(line)
+        if len(self.pending) > CHUNK_SIZE:
+            # No line breaks at all: don't let one "line" grow without bound
+            self.lines.append(self.pending)
+            self.pending = ""
+
+    def close(self):
+        self._line(self.pending + self.decoder.decode(b"", final=True))
+        self.pending = ""
+        self._end_paragraph()
+
+    def _line(self, line):
+        stripped = line.strip()
+        if not stripped:
+            self._end_paragraph()
+            return
+        if self.markdown:
+            match = MD_HEADING.match(stripped)
+            if match:
+                self._end_paragraph()
+                self.manuscript.heading(MD_MARKERS.sub("", match.group(2)), len(match.group(1)))
+                return
+            if MD_RULE.match(stripped):
+                self._end_paragraph()
+                return
+        elif not self.lines and len(stripped) <= 80 and CHAPTER_HEADING.match(stripped):
+            self.manuscript.heading(stripped)
+            return
+        self.lines.append(stripped)
+
+    def _end_paragraph(self):
+        if not self.lines:
+            return
+        text = " ".join(self.lines)
+        self.lines = []
+        if self.markdown:
+            self.manuscript.paragraph(md_inline(text), MD_MARKERS.sub("", text))
+        else:
+            self.manuscript.paragraph(escape(text, quote=False), text)
+
+
+# ==================== DOCX ====================
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DOCX_HEADING = re.compile(r"^heading\s?(\d)$", re.IGNORECASE)
+DOCX_MARKS = ((W + "b", "strong"), (W + "i", "em"), (W + "u", "u"), (W + "strike", "s"))
+
+
+def _docx_flag(rpr, tag):
+    if rpr is None:
+        return False
+    element = rpr.find(tag)
+    return element is not None and element.get(W + "val", "true") not in ("0", "false", "none")
+
+
+def _docx_run(run):
+    pieces = []
+    for child in run:
+        if child.tag == W + "t":
+            pieces.append(child.text or "")
+        elif child.tag in (W + "tab", W + "br", W + "cr"):
+            pieces.append(" ")
+    text = "".join(pieces)
+    html = escape(text, quote=False)
+    if html:
+        rpr = run.find(W + "rPr")
+        for tag, mark in DOCX_MARKS:
+            if _docx_flag(rpr, tag):
+                html = f"<{mark}>{html}</{mark}>"
+    return text, html
+
+
+def parse_docx(fileobj, manuscript):
+    """Walk word/document.xml paragraph by paragraph, clearing each one after use"""
+    with zipfile.ZipFile(fileobj) as zf, zf.open("word/document.xml") as xml:
+        for _, element in ElementTree.iterparse(xml, events=("end",)):
+            if element.tag != W + "p":
+                continue
+            style = element.find(f"{W}pPr/{W}pStyle")
+            style = style.get(W + "val", "") if style is not None else ""
+            runs = [_docx_run(run) for run in element.iter(W + "r")]
+            element.clear()
+            text = "".join(t for t, _ in runs)
+            match = DOCX_HEADING.match(style)
+            if style.lower() == "title" or match:
+                level = min(int(match.group(1)), 6) if match else 1
+                manuscript.heading(text, max(level, 1))
+            else:
+                manuscript.paragraph("".join(h for _, h in runs), text)
+
+
+# ==================== IMPORTER ====================
+
+class BookImporter:
+    """Builds book documents for one user and writes them in insert_many batches"""
+
+    def __init__(self, books_collection, summary_store=None, user_id=None, genre="",
+                 max_book_bytes=MAX_BOOK_BYTES, max_books=MAX_BOOKS):
+        self.books_collection = books_collection
+        self.summary_store = summary_store
+        self.user_id = user_id
+        self.genre = genre or ""
+        self.max_book_bytes = max_book_bytes
+        self.max_books = max_books
+        self.batch = []
+        self.batch_bytes = 0
+        self.books = []  # {"id", "title", "wordCount", "source"} of inserted books
+        self.queued = 0
+        self.failed = 0
+        self.events = []
+
+    # ---------- books ----------
+
+    def add_book(self, source, title, content, word_count):
+        if self.queued >= self.max_books:
+            raise ImportLimitError(f"Import is limited to {self.max_books} books")
+        now = datetime.now(timezone.utc)
+        self.batch.append((source, {
+            "userId": self.user_id,
+            "title": title,
+            "description": "",
+            "coverImage": "",
+            "genre": self.genre,
+            "content": content,
+            "contentPreview": content_preview(content),
+            "wordCount": word_count,
+            "status": "draft",
+            "isFavorite": False,
+            "isArchived": False,
+            "createdAt": now,
+            "updatedAt": now
+        }))
+        self.queued += 1
+        self.batch_bytes += len(content)
+        if len(self.batch) >= INSERT_BATCH_SIZE or self.batch_bytes >= INSERT_BATCH_BYTES:
+            self.flush()
+
+    def drop_queued(self, source):
+        """Forget books of a failed file that were not written yet"""
+        kept = [(s, doc) for s, doc in self.batch if s != source]
+        self.queued -= len(self.batch) - len(kept)
+        self.batch = kept
+        self.batch_bytes = sum(len(doc["content"]) for _, doc in kept)
+
+    def flush(self):
+        if not self.batch:
+            return
+        batch, self.batch, self.batch_bytes = self.batch, [], 0
+        self.books_collection.insert_many([doc for _, doc in batch])
+        inserted = []
+        for source, doc in batch:
+            if self.summary_store:
+                self.summary_store.record_change(None, doc)
+            inserted.append({"id": str(doc["_id"]), "title": doc["title"],
+                             "wordCount": doc["wordCount"], "source": source})
+        self.books.extend(inserted)
+        self.events.append({"event": "inserted", "books": inserted})
+
+    # ---------- files ----------
+
+    def open_file(self, filename):
+        """Parser for one uploaded file: write(bytes) as it arrives, then close()"""
+        kind = file_kind(filename)
+        if kind is None:
+            return None
+        if kind in ("text", "markdown"):
+            manuscript = self._manuscript(filename)
+            return _TextUpload(TextParser(manuscript, markdown=kind == "markdown"), manuscript)
+        return _SpooledUpload(lambda f: self._import_archive(filename, kind, f))
+
+    def _manuscript(self, filename):
+        def emit(title, content, word_count):
+            self.add_book(filename, title, content, word_count)
+        return Manuscript(title_from_filename(filename), emit, self.max_book_bytes)
+
+    def _import_archive(self, filename, kind, fileobj):
+        if kind == "docx":
+            manuscript = self._manuscript(filename)
+            parse_docx(fileobj, manuscript)
+            manuscript.finish()
+            return
+        with zipfile.ZipFile(fileobj) as zf:
+            for info in zf.infolist():
+                name = info.filename
+                base = os.path.basename(name)
+                if info.is_dir() or name.startswith("__MACOSX/") or base.startswith("."):
+                    continue
+                member_kind = file_kind(name)
+                if member_kind in (None, "zip"):
+                    self.events.append({"event": "skipped", "file": name,
+                                        "message": "Unsupported file type"})
+                    continue
+                self.events.append({"event": "file", "file": name})
+                try:
+                    with zf.open(info) as member:
+                        if member_kind == "docx":
+                            self._import_archive(name, "docx", member)
+                            continue
+                        upload = self.open_file(name)
+                        for chunk in iter(lambda: member.read(CHUNK_SIZE), b""):
+                            upload.write(chunk)
+                        upload.close()
+                except ImportLimitError:
+                    raise
+                except Exception as e:
+                    logger.exception("Error importing file", extra={"fields": {"file": name}})
+                    self.drop_queued(name)
+                    self.failed += 1
+                    self.events.append({"event": "error", "file": name,
+                                        "message": f"Could not read file: {e}"})
+
+
+class _TextUpload:
+    def __init__(self, parser, manuscript):
+        self.parser = parser
+        self.manuscript = manuscript
+
+    def write(self, data):
+        self.parser.write(data)
+
+    def close(self):
+        self.parser.close()
+        self.manuscript.finish()
+
+
+class _SpooledUpload:
+    """Zip-based uploads need random access: spool them, then parse on close"""
+
+    def __init__(self, parse):
+        self.parse = parse
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        try:
+            self.file.seek(0)
+            self.parse(self.file)
+        finally:
+            self.file.close()
+
+
+# ==================== MULTIPART STREAM ====================
+
+def _throughput(received, started):
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    return round(received / elapsed / (1024 * 1024), 2)
+
+
+def import_multipart(stream, boundary, importer, total_bytes=None, max_bytes=None):
+    """
+    Parse a multipart/form-data body chunk by chunk and import its files
+    Form fields userId and genre apply to the files that follow them.
+    Reading stops with an error once max_bytes have been received (chunked
+    uploads carry no Content-Length to check up front); that also bounds
+    the zip/EPUB parts spooled to disk.
+    Yields progress events; the last one is "done" (or "error").
+    """
+    decoder = MultipartDecoder(boundary.encode("latin-1"), max_form_memory_size=FORM_FIELD_BYTES)
+    started = time.perf_counter()
+    last_progress = started
+    received = 0
+    files = 0
+    field = None  # [name, bytearray] of the form field being read
+    upload = None
+    filename = None
+
+    try:
+        finished = False
+        while not finished:
+            chunk = stream.read(CHUNK_SIZE)
+            received += len(chunk)
+            if max_bytes is not None and received > max_bytes:
+                raise ImportLimitError(f"Upload is over the {max_bytes // (1024 * 1024)} MB import limit")
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, NeedData):
+                if isinstance(event, Epilogue):
+                    finished = True
+                    break
+                if isinstance(event, File):
+                    filename = event.filename or event.name
+                    if not importer.user_id:
+                        raise ValueError("userId must be sent before the files")
+                    upload = importer.open_file(filename)
+                    if upload is None:
+                        importer.events.append({"event": "skipped", "file": filename,
+                                                "message": "Unsupported file type"})
+                    else:
+                        files += 1
+                        importer.events.append({"event": "file", "file": filename})
+                elif isinstance(event, Field):
+                    field = [event.name, bytearray()]
+                elif isinstance(event, Data):
+                    if field is not None:
+                        field[1].extend(event.data)
+                        if not event.more_data:
+                            value = field[1].decode("utf-8", "replace").strip()
+                            if field[0] == "userId":
+                                importer.user_id = value
+                            elif field[0] == "genre":
+                                importer.genre = value
+                            field = None
+                    elif upload is not None:
+                        try:
+                            upload.write(event.data)
+                            if not event.more_data:
+                                upload.close()
+                        except ImportLimitError:
+                            raise
+                        except Exception as e:
+                            logger.exception("Error importing file", extra={"fields": {"file": filename}})
+                            importer.drop_queued(filename)
+                            importer.failed += 1
+                            importer.events.append({"event": "error", "file": filename,
+                                                    "message": f"Could not read file: {e}"})
+                            upload = None
+                        if not event.more_data:
+                            upload = None
+                event = decoder.next_event()
+            if not chunk and not finished:
+                raise ValueError("Upload ended before the multipart body was complete")
+
+            yield from importer.events
+            importer.events = []
+            now = time.perf_counter()
+            if now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                yield {"event": "progress", "bytes": received, "totalBytes": total_bytes,
+                       "books": importer.queued, "mbPerSec": _throughput(received, started)}
+
+        importer.flush()
+        yield from importer.events
+        importer.events = []
+    except (ValueError, ImportLimitError, RequestEntityTooLarge) as e:
+        message = "Form field is too large" if isinstance(e, RequestEntityTooLarge) else str(e)
+        importer.flush()
+        yield from importer.events
+        yield {"event": "error", "status": "error", "message": message,
+               "books": importer.books, "count": len(importer.books)}
+        return
+
+    seconds = round(time.perf_counter() - started, 3)
+    done = {
+        "event": "done",
+        "status": "success",
+        "books": importer.books,
+        "count": len(importer.books),
+        "files": files,
+        "failedFiles": importer.failed,
+        "bytes": received,
+        "seconds": seconds,
+        "mbPerSec": _throughput(received, started),
+    }
+    logger.info("Import finished", extra={"fields": {
+        "userId": importer.user_id, "books": done["count"], "files": files,
+        "bytes": received, "mbPerSec": done["mbPerSec"]
+    }})
+    yield done
@@ -0,0 +1,246 @@
+"""
+Request body limits and streaming JSON ingestion
+Every endpoint has a body limit (DEFAULT_LIMIT unless init_app is given
+another), and a request whose Content-Length is over it gets 413 before
+any of the body is read. Book saves carry whole manuscripts and base64
+covers: read_json() parses bodies over STREAM_THRESHOLD straight off the
+request stream, READ_BYTES at a time, decoding string values piece by
+piece. A save then holds its content once, instead of the raw body cached
+for the whole request next to the parsed string.
+"""
+
+import codecs
+import json
+import os
+import re
+
+from flask import jsonify, request
+
+DEFAULT_LIMIT = int(float(os.getenv("MAX_BODY_KB", 1024)) * 1024)
+BOOK_LIMIT = int(float(os.getenv("MAX_BOOK_BODY_MB", 16)) * 1024 * 1024)
+IMPORT_LIMIT = int(float(os.getenv("MAX_IMPORT_MB", 200)) * 1024 * 1024)
+EVENTS_LIMIT = 64 * 1024
+STREAM_THRESHOLD = int(float(os.getenv("STREAM_THRESHOLD_KB", 256)) * 1024)
+READ_BYTES = 64 * 1024
+MAX_DEPTH = 32
+
+WHITESPACE = re.compile(r"[ \t\r\n]*")
+# A run of string characters and complete escapes; stops at '"', a cut escape or the buffer end
+STRING_RUN = re.compile(r'[^"\\]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\]*)*')
+LITERAL = re.compile(r"[-+.0-9eEa-z]*")
+LONGEST_ESCAPE = 6      # \uXXXX
+
+
+class BodyTooLarge(Exception):
+    """The body went over the endpoint's limit while it was read"""
+
+    def __init__(self, limit):
+        super().__init__(f"Request body is over {limit} bytes")
+        self.limit = limit
+
+
+class MalformedBody(ValueError):
+    """The body isn't a JSON object"""
+
+
+def too_large(limit):
+    return jsonify({
+        "status": "error",
+        "message": f"Request body is too large (limit {limit // 1024} KB)",
+        "limit": limit
+    }), 413
+
+
+class StreamParser:
+    """
+    Incremental JSON parser over a binary stream
+    Only the current READ_BYTES chunk (plus any unfinished token) is kept;
+    strings are decoded a chunk at a time with json's scanstring and
+    joined once at their closing quote.
+    """
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.read_bytes = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Append the next chunk to the unread part of the buffer; False at the end of the body"""
+        if self.eof:
+            return False
+        chunk = self.stream.read(READ_BYTES)
+        self.read_bytes += len(chunk)
+        if self.read_bytes > self.limit:
+            raise BodyTooLarge(self.limit)
+        try:
+            text = self.decoder.decode(chunk, final=not chunk)
+        except UnicodeDecodeError:
+            raise MalformedBody("Body is not valid UTF-8")
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        """Next non-whitespace character without consuming it ('' at the end of the body)"""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise MalformedBody(f"Expected '{char}'")
+        self.pos += 1
+
+    def parse(self):
+        """The body's top-level JSON object"""
+        result = self.object(0)
+        if self.peek():
+            raise MalformedBody("Extra data after the JSON object")
+        return result
+
+    def value(self, depth):
+        char = self.peek()
+        if char == '"':
+            self.pos += 1
+            return self.string()
+        if char == "{":
+            return self.object(depth + 1)
+        if char == "[":
+            return self.array(depth + 1)
+        return self.literal()
+
+    def object(self, depth):
+        if depth > MAX_DEPTH:
+            raise MalformedBody("JSON is nested too deeply")
+        self.expect("{")
+        result = {}
+        if self.peek() == "}":
+            self.pos += 1
+            return result
+        while True:
+            self.expect('"')
+            key = self.string()
+            self.expect(":")
+            result[key] = self.value(depth)
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("}")
+            return result
+
+    def array(self, depth):
+        if depth > MAX_DEPTH:
+            raise MalformedBody("JSON is nested too deeply")
+        self.expect("[")
+        result = []
+        if self.peek() == "]":
+            self.pos += 1
+            return result
+        while True:
+            result.append(self.value(depth))
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("]")
+            return result
+
+    def literal(self):
+        """A number, true, false or null"""
+        while True:
+            end = LITERAL.match(self.buf, self.pos).end()
+            if end < len(self.buf) or not self.fill():
+                break
+        end = LITERAL.match(self.buf, self.pos).end()
+        token = self.buf[self.pos:end]
+        try:
+            value = json.loads(token)
+        except ValueError:
+            raise MalformedBody(f"Invalid JSON value {token[:20]!r}")
+        self.pos = end
+        return value
+
+    def string(self):
+        """Rest of a string whose opening quote was consumed"""
+        pieces = []
+        while True:
+            end = STRING_RUN.match(self.buf, self.pos).end()
+            if end < len(self.buf) and self.buf[end] == '"':
+                piece, self.pos = self._scan(self.buf, self.pos)
+                pieces.append(piece)
+                return _join(pieces)
+            if end < len(self.buf) and len(self.buf) - end >= LONGEST_ESCAPE:
+                raise MalformedBody("Invalid escape in string")
+            # The string goes on in the next chunk: decode what is complete
+            if end > self.pos:
+                pieces.append(self._scan(self.buf[self.pos:end] + '"', 0)[0])
+                self.pos = end
+            if not self.fill():
+                raise MalformedBody("Unterminated string")
+
+    @staticmethod
+    def _scan(text, start):
+        try:
+            return json.decoder.scanstring(text, start)
+        except ValueError as e:
+            raise MalformedBody(str(e))
+
+
+def _join(pieces):
+    """Join decoded pieces, pairing surrogate escapes a chunk boundary split"""
+    for i in range(len(pieces) - 1, 0, -1):
+        before, after = pieces[i - 1], pieces[i]
+        if before and after and "\ud800" <= before[-1] <= "\udbff" and "\udc00" <= after[0] <= "\udfff":
+            pair = chr(0x10000 + ((ord(before[-1]) - 0xD800) << 10) + (ord(after[0]) - 0xDC00))
+            pieces[i - 1] = before[:-1] + pair
+            pieces[i] = after[1:]
+    return pieces[0] if len(pieces) == 1 else "".join(pieces)
+
+
+def read_json(limit=BOOK_LIMIT):
+    """
+    The request's JSON object, like request.get_json()
+    Bodies over STREAM_THRESHOLD (or without a Content-Length) are parsed
+    incrementally off the stream; raises BodyTooLarge or MalformedBody
+    """
+    length = request.content_length
+    if length is not None and length <= STREAM_THRESHOLD:
+        data = request.get_json(silent=True)
+        if data is None and request.is_json and length:
+            raise MalformedBody("Body is not valid JSON")
+        return data
+    if not request.is_json:
+        return None
+    return StreamParser(request.stream, limit).parse()
+
+
+def init_app(app, limits=None, streaming=()):
+    """
+    Reject bodies over the endpoint's limit before they are read
+    limits maps endpoint names to bytes; bodies without a Content-Length
+    (chunked uploads) are only accepted by the streaming endpoints, which
+    count bytes as they read
+    """
+    limits = limits or {}
+    streaming = set(streaming)
+
+    @app.before_request
+    def _check_body_size():
+        limit = limits.get(request.endpoint, DEFAULT_LIMIT)
+        length = request.content_length
+        if length is not None:
+            if length > limit:
+                return too_large(limit)
+        elif "chunked" in request.headers.get("Transfer-Encoding", "").lower() \
+                and request.endpoint not in streaming:
+            return jsonify({
+                "status": "error",
+                "message": "Content-Length is required"
+            }), 411
@@ -0,0 +1,266 @@
+"""
+Cross-worker cache invalidation
+Every gunicorn worker keeps its own in-memory caches (style indexes,
+exports, user profiles). The bus tails MongoDB change streams on the
+watched collections and hands each change to the worker's subscribers,
+so a write made by any worker or instance evicts the affected keys
+everywhere. Standalone servers have no change streams; there the bus
+polls each collection's timestamp field instead (deletes are seen
+through book tombstones). A subscriber receives Change.reset when
+events may have been missed and should drop everything it holds.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from tracing import logger
+
+MODE = os.getenv("INVALIDATION_MODE", "auto").lower()    # auto, stream, poll, off
+POLL_SECONDS = float(os.getenv("INVALIDATION_POLL_SECONDS", 2))
+POLL_OVERLAP_SECONDS = 5    # re-read this much history each poll (clock skew between writers)
+POLL_BATCH = 1000
+RETRY_SECONDS = 5
+
+# Server error codes
+NOT_REPLICA_SET = 40573     # $changeStream on a standalone server
+HISTORY_LOST = 286          # resume token fell off the oplog
+STREAM_FATAL = 280
+
+STREAM_OPERATIONS = ["insert", "update", "replace", "delete"]
+
+
+class Change:
+    __slots__ = ("source", "op", "id", "doc")
+
+    def __init__(self, source, op, id=None, doc=None):
+        self.source = source
+        self.op = op            # insert, update, replace, delete or reset
+        self.id = id            # document _id as a string
+        self.doc = doc or {}    # the source's key fields, when known
+
+    @property
+    def reset(self):
+        return self.op == "reset"
+
+    def __repr__(self):
+        return f"Change({self.source!r}, {self.op!r}, {self.id!r}, {self.doc!r})"
+
+
+class Source:
+    """A watched collection, the fields subscribers key on and its poll timestamp"""
+
+    def __init__(self, name, collection, fields, poll_field, poll_op="update"):
+        self.name = name
+        self.collection = collection
+        self.fields = tuple(fields)
+        self.poll_field = poll_field
+        self.poll_op = poll_op
+        self.mode = None
+        self.events = 0
+        self.last_event = None
+        self.error = None
+
+
+class InvalidationBus:
+    def __init__(self, sources, mode=MODE, poll_seconds=POLL_SECONDS, retry_seconds=RETRY_SECONDS):
+        self.sources = {source.name: source for source in sources}
+        self.mode = mode
+        self.poll_seconds = poll_seconds
+        self.retry_seconds = retry_seconds
+        self.subscribers = {name: [] for name in self.sources}
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def subscribe(self, source_name, callback):
+        """callback(Change) runs on the bus thread; keep it quick"""
+        self.subscribers[source_name].append(callback)
+
+    def start(self):
+        if self.mode == "off":
+            return self
+        for source in self.sources.values():
+            thread = threading.Thread(target=self._run, args=(source,),
+                                      name=f"invalidate-{source.name}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=5):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def publish(self, change):
+        source = self.sources[change.source]
+        source.events += 1
+        source.last_event = time.time()
+        for callback in self.subscribers[change.source]:
+            try:
+                callback(change)
+            except Exception:
+                logger.exception("Invalidation subscriber failed",
+                                 extra={"fields": {"source": change.source, "op": change.op}})
+
+    def snapshot(self):
+        return {
+            name: {
+                "mode": source.mode,
+                "events": source.events,
+                "lastEventAgeSeconds": round(time.time() - source.last_event, 1) if source.last_event else None,
+                "error": source.error,
+            }
+            for name, source in self.sources.items()
+        }
+
+    def _run(self, source):
+        if self.mode in ("auto", "stream"):
+            self._stream(source)
+        if not self.stopped.is_set():
+            self._poll(source)
+
+    # ---------- change streams ----------
+
+    def _stream(self, source):
+        """Tail the change stream; returns only to fall back to polling"""
+        pipeline = [
+            {"$match": {"operationType": {"$in": STREAM_OPERATIONS}}},
+            {"$project": {"operationType": 1, "documentKey": 1,
+                          **{f"fullDocument.{field}": 1 for field in source.fields}}},
+        ]
+        token = None
+        opened = False
+        while not self.stopped.is_set():
+            try:
+                with source.collection.watch(pipeline, full_document="updateLookup",
+                                             resume_after=token, max_await_time_ms=1000) as stream:
+                    if opened and token is None:
+                        # Reconnected without a resume point: whatever happened meanwhile is lost
+                        self.publish(Change(source.name, "reset"))
+                    opened = True
+                    source.mode = "stream"
+                    source.error = None
+                    while not self.stopped.is_set():
+                        event = stream.try_next()
+                        token = stream.resume_token
+                        if event is not None:
+                            self.publish(Change(
+                                source.name,
+                                event["operationType"],
+                                str(event["documentKey"]["_id"]),
+                                {k: v for k, v in (event.get("fullDocument") or {}).items() if k in source.fields},
+                            ))
+            except OperationFailure as e:
+                if e.code == NOT_REPLICA_SET and not opened and self.mode == "auto":
+                    logger.info("Change streams unavailable, polling for invalidations",
+                                extra={"fields": {"source": source.name}})
+                    return
+                if e.code in (HISTORY_LOST, STREAM_FATAL):
+                    token = None
+                self._stream_error(source, e)
+            except PyMongoError as e:
+                self._stream_error(source, e)
+            except (TypeError, NotImplementedError, AttributeError) as e:
+                # Client without watch() support (e.g. mongomock)
+                if self.mode == "auto" and not opened:
+                    return
+                self._stream_error(source, e)
+
+    def _stream_error(self, source, error):
+        source.error = str(error)
+        logger.warning("Invalidation change stream failed, retrying",
+                       extra={"fields": {"source": source.name, "error": str(error)}})
+        self.stopped.wait(self.retry_seconds)
+
+    # ---------- polling fallback ----------
+
+    def _poll(self, source):
+        """Re-read documents whose poll_field moved since the last pass"""
+        source.mode = "poll"
+        try:
+            # Reuse an existing index on the field (e.g. the tombstones' TTL index)
+            keys = [info["key"] for info in source.collection.index_information().values()]
+            if [(source.poll_field, 1)] not in keys:
+                source.collection.create_index(source.poll_field)
+        except PyMongoError as e:
+            source.error = str(e)
+        since = datetime.now(timezone.utc)
+        seen = {}  # (id, timestamp) -> timestamp, for changes inside the overlap window
+        projection = {field: 1 for field in source.fields}
+        projection[source.poll_field] = 1
+        while not self.stopped.wait(self.poll_seconds):
+            try:
+                window = since - timedelta(seconds=POLL_OVERLAP_SECONDS)
+                docs = list(source.collection.find(
+                    {source.poll_field: {"$gt": window}}, projection
+                ).sort(source.poll_field, 1).limit(POLL_BATCH))
+                source.error = None
+            except PyMongoError as e:
+                source.error = str(e)
+                logger.warning("Invalidation poll failed",
+                               extra={"fields": {"source": source.name, "error": str(e)}})
+                continue
+            if len(docs) == POLL_BATCH:
+                # Too far behind to replay change by change
+                self.publish(Change(source.name, "reset"))
+            for doc in docs:
+                stamp = _utc(doc.get(source.poll_field))
+                key = (str(doc["_id"]), stamp)
+                if key in seen:
+                    continue
+                seen[key] = stamp
+                since = max(since, stamp)
+                if len(docs) < POLL_BATCH:
+                    self.publish(Change(source.name, source.poll_op, str(doc["_id"]),
+                                        {k: v for k, v in doc.items() if k in source.fields}))
+            cutoff = since - timedelta(seconds=POLL_OVERLAP_SECONDS)
+            seen = {key: stamp for key, stamp in seen.items() if stamp > cutoff}
+
+
+def _utc(value):
+    if value is None:
+        return datetime.min.replace(tzinfo=timezone.utc)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+class LocalCache:
+    """Small thread-safe LRU with a TTL as a safety net for missed invalidations"""
+
+    def __init__(self, max_items=1000, ttl_seconds=300):
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.items = OrderedDict()  # key -> (value, stored_at)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.ttl_seconds:
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.monotonic())
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def evict(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
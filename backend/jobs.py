@@ -0,0 +1,361 @@
+"""
+Background jobs
+CPU-heavy work (exports, summary rebuilds) is queued in the jobs
+collection instead of running on request threads; the request answers
+202 with a job ID to poll at /api/jobs/<id>. Runners claim jobs with a
+lease they keep renewing, so a job whose runner died is picked up again
+once its lease expires, and failed jobs are retried with backoff up to
+max_attempts. Jobs are claimed by priority (lower runs first) and then
+age, skipping users who already have JOB_USER_CONCURRENCY jobs running
+so one user's backlog cannot starve everyone else.
+
+    python jobs.py --processes 4     # dedicated runner with a process pool
+
+Web workers run jobs on their own process pool of JOB_PROCESSES, so job
+CPU never competes with request threads for the GIL. JOB_RUNNER=off
+leaves jobs to dedicated runners; JOB_RUNNER=thread runs them on
+JOB_THREADS threads in the web worker, an explicit opt-in for setups
+without a real MongoDB to connect from a child process (mongomock).
+"""
+
+import argparse
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from multiprocessing import get_context
+
+import gridfs
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+import exporters
+import summaries
+from tracing import logger
+
+RUNNER = os.getenv("JOB_RUNNER", "process").lower()     # process, thread or off (web workers)
+THREADS = int(os.getenv("JOB_THREADS", 1))              # JOB_RUNNER=thread only
+PROCESSES = int(os.getenv("JOB_PROCESSES", 2))          # web workers' pool and `python jobs.py`
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+USER_CONCURRENCY = int(os.getenv("JOB_USER_CONCURRENCY", 2))
+RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", 7))
+MAX_ATTEMPTS = 3
+RETRY_BASE_SECONDS = 5
+POLL_SECONDS = 1
+SWEEP_SECONDS = 600
+FILES_BUCKET = "job_files"
+
+PRIORITY_INTERACTIVE = 1    # someone is waiting for it
+PRIORITY_DEFAULT = 5
+PRIORITY_BACKGROUND = 9
+
+PUBLIC_FIELDS = ("type", "userId", "status", "priority", "attempts", "maxAttempts",
+                 "createdAt", "startedAt", "finishedAt", "result", "error")
+
+
+class JobFailed(Exception):
+    """A failure retrying cannot fix (missing book, bad payload)"""
+
+
+# ==================== HANDLERS ====================
+# handler(db, payload) -> JSON-serializable result. They run in runner
+# threads or pool processes, so they take everything from the payload and
+# the database and never touch web worker state.
+
+EXPORT_FIELDS = {"title": 1, "description": 1, "coverImage": 1, "content": 1,
+                 "revision": 1, "updatedAt": 1}
+
+
+def export_book(db, payload):
+    """Render a book export into GridFS"""
+    fmt = exporters.normalize_format(payload.get("format"))
+    if not fmt:
+        raise JobFailed("Unknown export format")
+    book = db["books"].find_one({"_id": ObjectId(payload["bookId"])}, EXPORT_FIELDS)
+    if not book:
+        raise JobFailed("Book not found")
+
+    filename = exporters.export_filename(book, fmt)
+    bucket = gridfs.GridFSBucket(db, bucket_name=FILES_BUCKET)
+    size = 0
+    with bucket.open_upload_stream(filename, metadata={
+        "bookId": payload["bookId"], "format": fmt, "contentType": exporters.FORMATS[fmt][0]
+    }) as upload:
+        for chunk in exporters.stream_export(book, fmt):
+            upload.write(chunk)
+            size += len(chunk)
+    return {"fileId": str(upload._id), "filename": filename,
+            "contentType": exporters.FORMATS[fmt][0], "bytes": size}
+
+
+def rebuild_summary(db, payload):
+    """Recompute a user's dashboard counts from their books"""
+    store = summaries.SummaryStore(db["books"], db["summaries"])
+    return summaries.format_summary(store.rebuild(payload["userId"]))
+
+
+HANDLERS = {
+    "export": export_book,
+    "summary.rebuild": rebuild_summary,
+}
+
+_process_db = None
+
+
+def _worker_db():
+    """Database handle of a pool process, opened on its first job"""
+    global _process_db
+    if _process_db is None:
+        from pymongo import MongoClient
+        client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+        _process_db = client[os.getenv("DB_NAME", "next_word_prediction")]
+    return _process_db
+
+
+def run_job(job_type, payload, db=None):
+    """Entry point inside a runner thread or pool process"""
+    return HANDLERS[job_type](db if db is not None else _worker_db(), payload)
+
+
+# ==================== QUEUE ====================
+
+class JobQueue:
+    def __init__(self, jobs_collection):
+        self.collection = jobs_collection
+        self.wake = threading.Event()  # nudges a runner in this process
+        jobs_collection.create_index([("status", 1), ("priority", 1), ("runAt", 1)])
+        jobs_collection.create_index([("status", 1), ("leaseExpiresAt", 1)])
+        jobs_collection.create_index([("dedupeKey", 1), ("status", 1)])
+        jobs_collection.create_index("finishedAt", expireAfterSeconds=RETENTION_DAYS * 86400)
+
+    def enqueue(self, job_type, payload, user_id=None, priority=PRIORITY_DEFAULT,
+                max_attempts=MAX_ATTEMPTS, dedupe_key=None):
+        """
+        Queue a job and return its document
+        With dedupe_key, a queued or running job with the same key is
+        returned instead of adding another.
+        """
+        if job_type not in HANDLERS:
+            raise ValueError(f"Unknown job type: {job_type}")
+        if dedupe_key:
+            existing = self.collection.find_one(
+                {"dedupeKey": dedupe_key, "status": {"$in": ["queued", "running"]}}
+            )
+            if existing:
+                return existing
+        now = datetime.now(timezone.utc)
+        job = {
+            "type": job_type,
+            "userId": user_id,
+            "payload": payload,
+            "priority": priority,
+            "status": "queued",
+            "attempts": 0,
+            "maxAttempts": max_attempts,
+            "dedupeKey": dedupe_key,
+            "runAt": now,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        job["_id"] = self.collection.insert_one(job).inserted_id
+        self.wake.set()
+        return job
+
+    def get(self, job_id):
+        return self.collection.find_one({"_id": ObjectId(job_id)}, {"payload": 0, "dedupeKey": 0})
+
+
+def public_job(job):
+    """Response shape for GET /api/jobs/<id>"""
+    formatted = {"id": str(job["_id"])}
+    formatted.update({field: job.get(field) for field in PUBLIC_FIELDS})
+    return formatted
+
+
+# ==================== RUNNER ====================
+
+class JobRunner:
+    """
+    Claims jobs and runs them on an executor
+    processes=0 uses a thread pool of `threads` in this process (web
+    workers); otherwise a spawn-based process pool, whose processes open
+    their own Mongo connection.
+    """
+
+    def __init__(self, queue, db, processes=0, threads=THREADS):
+        self.queue = queue
+        self.collection = queue.collection
+        self.db = db
+        self.processes = processes
+        self.slots = processes or threads
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.executor = self._new_executor()
+        self.running = {}  # job _id -> job document
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.renewed_at = 0.0
+        self.swept_at = 0.0
+
+    def _new_executor(self):
+        if self.processes:
+            return ProcessPoolExecutor(self.processes, mp_context=get_context("spawn"))
+        return ThreadPoolExecutor(self.slots, thread_name_prefix="job")
+
+    def start(self):
+        threading.Thread(target=self.run, name="job-runner", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.queue.wake.set()
+
+    def run(self):
+        logger.info("Job runner started", extra={"fields": {"owner": self.owner, "slots": self.slots}})
+        while not self.stopped.is_set():
+            try:
+                self._tick()
+            except Exception:
+                logger.exception("Job runner error")
+            self.queue.wake.wait(POLL_SECONDS)
+            self.queue.wake.clear()
+        self.executor.shutdown(wait=True)
+
+    def _tick(self):
+        now = time.monotonic()
+        if now - self.renewed_at >= LEASE_SECONDS / 3:
+            self.renewed_at = now
+            self._renew_leases()
+        while len(self.running) < self.slots and not self.stopped.is_set():
+            job = self.claim()
+            if job is None:
+                break
+            self._submit(job)
+        if now - self.swept_at >= SWEEP_SECONDS:
+            self.swept_at = now
+            self._sweep_files()
+
+    def claim(self):
+        """Lease the next runnable job (or None)"""
+        while True:
+            now = datetime.now(timezone.utc)
+            busy = [row["_id"] for row in self.collection.aggregate([
+                {"$match": {"status": "running", "leaseExpiresAt": {"$gte": now}}},
+                {"$group": {"_id": "$userId", "running": {"$sum": 1}}},
+                {"$match": {"running": {"$gte": USER_CONCURRENCY}, "_id": {"$ne": None}}},
+            ])]
+            job = self.collection.find_one_and_update(
+                {
+                    "$or": [
+                        {"status": "queued", "runAt": {"$lte": now}},
+                        {"status": "running", "leaseExpiresAt": {"$lt": now}},  # runner died
+                    ],
+                    "userId": {"$nin": busy},
+                },
+                {
+                    "$set": {"status": "running", "leaseOwner": self.owner,
+                             "leaseExpiresAt": now + timedelta(seconds=LEASE_SECONDS),
+                             "startedAt": now, "updatedAt": now},
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("priority", 1), ("runAt", 1)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if job is None or job["attempts"] <= job["maxAttempts"]:
+                return job
+            # Its runners kept dying mid-job; stop handing it out
+            self._settle(job, {"status": "failed", "error": "Job runner lost its lease too many times"})
+
+    def _submit(self, job):
+        with self.lock:
+            self.running[job["_id"]] = job
+        try:
+            if self.processes:
+                future = self.executor.submit(run_job, job["type"], job.get("payload") or {})
+            else:
+                future = self.executor.submit(run_job, job["type"], job.get("payload") or {}, self.db)
+        except BrokenProcessPool:
+            self.executor = self._new_executor()
+            future = self.executor.submit(run_job, job["type"], job.get("payload") or {})
+        future.add_done_callback(lambda f, job=job: self._finish(job, f))
+
+    def _finish(self, job, future):
+        try:
+            result = future.result()
+            update = {"status": "succeeded", "result": result, "error": None}
+        except JobFailed as e:
+            update = {"status": "failed", "error": str(e)}
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                self.executor = self._new_executor()
+            error = f"{type(e).__name__}: {e}"
+            if job["attempts"] < job["maxAttempts"]:
+                delay = RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1)
+                update = {"status": "queued", "error": error,
+                          "runAt": datetime.now(timezone.utc) + timedelta(seconds=delay)}
+            else:
+                update = {"status": "failed", "error": error}
+            logger.warning("Job failed", extra={"fields": {
+                "jobId": str(job["_id"]), "type": job["type"], "attempt": job["attempts"], "error": error
+            }})
+        try:
+            self._settle(job, update)
+        except Exception:
+            logger.exception("Error recording job result", extra={"fields": {"jobId": str(job["_id"])}})
+        finally:
+            with self.lock:
+                self.running.pop(job["_id"], None)
+            self.queue.wake.set()
+
+    def _settle(self, job, update):
+        """Record the outcome, unless another runner took the job over meanwhile"""
+        now = datetime.now(timezone.utc)
+        update["updatedAt"] = now
+        if update["status"] != "queued":
+            update["finishedAt"] = now
+        self.collection.update_one(
+            {"_id": job["_id"], "leaseOwner": self.owner},
+            {"$set": update, "$unset": {"leaseOwner": "", "leaseExpiresAt": ""}}
+        )
+
+    def _renew_leases(self):
+        with self.lock:
+            ids = list(self.running)
+        if ids:
+            self.collection.update_many(
+                {"_id": {"$in": ids}, "leaseOwner": self.owner},
+                {"$set": {"leaseExpiresAt": datetime.now(timezone.utc) + timedelta(seconds=LEASE_SECONDS)}}
+            )
+
+    def _sweep_files(self):
+        """Delete job output files older than the jobs that point to them"""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)
+        bucket = gridfs.GridFSBucket(self.db, bucket_name=FILES_BUCKET)
+        for stored in bucket.find({"uploadDate": {"$lt": cutoff}}):
+            bucket.delete(stored._id)
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=PROCESSES, help="Pool processes (0 = threads)")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"), serverSelectionTimeoutMS=5000)
+    db = client[os.getenv("DB_NAME", "next_word_prediction")]
+    runner = JobRunner(JobQueue(db["jobs"]), db, processes=args.processes)
+    print(f"🧵 Job runner {runner.owner} with {runner.slots} slot(s)")
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        runner.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Per-user style index for personalized predictions
+Each book is reduced to a small table of its distinctive words (anything
+outside a list of common English words), which of them are names, and
+the words that usually come right before them. The tables are stored per
+book and rebuilt only when that book's updatedAt changes; a user's index
+is the merge of their book tables, kept in memory and refreshed in the
+background. Predictions from Cohere are then re-ranked and supplemented
+locally from the index, so personalization costs no upstream tokens.
+"""
+
+import html
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+from tracing import logger
+
+REFRESH_SECONDS = float(os.getenv("STYLE_REFRESH_SECONDS", 60))
+CACHE_USERS = 500
+BOOK_WORDS = 400        # distinctive words kept per book
+USER_WORDS = 3000       # distinctive words kept per user
+FOLLOWERS_PER_WORD = 5  # predecessors kept per distinctive word
+MIN_FOLLOW_COUNT = 3    # how often "prev word" must precede a word to suggest it
+MAX_SUPPLEMENTS = 2     # at most this many of the 5 probable slots come from the index
+NAME_RATIO = 0.8        # share of mid-sentence uses that must be capitalized
+
+COMMON_WORDS = frozenset("""
+a about above after again against all almost also although always am among an and another any
+anything are around as at away back be because been before being below between both but by came
+can cannot could did do does doing done down during each even ever every few for from further get
+got had has have having he her here hers herself him himself his how however i if in into is it its
+itself just know like little made make many may me might more most much must my myself never new
+no nor not nothing now of off often on once one only or other our ours ourselves out over own
+perhaps quite rather really said same say see seemed she should since so some something still such
+than that the their theirs them themselves then there these they thing think this those though
+through thus to too toward towards under until up upon us very was way we well were what when where
+whether which while who whom whose why will with within without would yet you your yours yourself
+yourselves eyes face hand hands head looked man men room time woman women went
+""".split())
+
+BLOCK_TAG = re.compile(r"</?(?:p|div|h[1-6]|li|br|blockquote|pre)\b[^>]*>", re.IGNORECASE)
+TAG = re.compile(r"<[^>]*>")
+TOKEN = re.compile(r"[A-Za-z][A-Za-z'’]*|[.!?]")
+POSSESSIVE = re.compile(r"['’]s?$")
+LAST_TOKEN = re.compile(r"([A-Za-z][A-Za-z'’]*|[.!?\"”])\W*$")
+
+
+def _plain_text(content):
+    return html.unescape(TAG.sub("", BLOCK_TAG.sub(" . ", content or "")))
+
+
+def build_book_table(content):
+    """
+    Distinctive-word table of one book
+    words: {word: [display, count, midSentence, capitalized]}
+    follows: {previous word: {word: count}}
+    """
+    counts = Counter()
+    mid_sentence = Counter()
+    capitalized = Counter()
+    display = {}
+    pairs = Counter()
+    prev = None
+    sentence_start = True
+    for match in TOKEN.finditer(_plain_text(content)):
+        token = match.group()
+        if token in ".!?":
+            prev = None
+            sentence_start = True
+            continue
+        token = POSSESSIVE.sub("", token)
+        lower = token.lower()
+        if len(lower) >= 3 and lower not in COMMON_WORDS:
+            counts[lower] += 1
+            if not sentence_start:
+                mid_sentence[lower] += 1
+                if token[0].isupper():
+                    capitalized[lower] += 1
+                    display.setdefault(lower, token)
+            if prev:
+                pairs[(prev, lower)] += 1
+        prev = lower
+        sentence_start = False
+
+    words = {
+        word: [display.get(word, word), count, mid_sentence[word], capitalized[word]]
+        for word, count in counts.most_common(BOOK_WORDS)
+    }
+    return {"words": words, "follows": _top_follows(pairs, words)}
+
+
+def _top_follows(pairs, words):
+    """Keep the most frequent predecessors of each kept word"""
+    by_word = {}
+    for (prev, word), count in pairs.items():
+        if word in words:
+            by_word.setdefault(word, []).append((count, prev))
+    follows = {}
+    for word, entries in by_word.items():
+        entries.sort(reverse=True)
+        for count, prev in entries[:FOLLOWERS_PER_WORD]:
+            follows.setdefault(prev, {})[word] = count
+    return follows
+
+
+class StyleIndex:
+    """Merged book tables of one user"""
+
+    __slots__ = ("words", "follows", "books")
+
+    def __init__(self, tables=()):
+        totals = {}
+        pairs = Counter()
+        self.books = 0
+        for table in tables:
+            self.books += 1
+            for word, (shown, count, mid, caps) in table.get("words", {}).items():
+                entry = totals.get(word)
+                if entry is None:
+                    totals[word] = [shown, count, mid, caps]
+                else:
+                    if shown != word:
+                        entry[0] = shown
+                    entry[1] += count
+                    entry[2] += mid
+                    entry[3] += caps
+            for prev, followers in table.get("follows", {}).items():
+                for word, count in followers.items():
+                    pairs[(prev, word)] += count
+        ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:USER_WORDS]
+        self.words = dict(ranked)
+        self.follows = _top_follows(pairs, self.words)
+
+    def display(self, word):
+        """Capitalize names the way the author writes them"""
+        entry = self.words.get(word.lower())
+        if entry and entry[2] and entry[3] / entry[2] >= NAME_RATIO:
+            return entry[0]
+        return word
+
+    def followers(self, prev):
+        return self.follows.get(prev, {}) if prev else {}
+
+
+def last_word(text):
+    """Lowercased last word of the context, or None at a sentence boundary"""
+    match = LAST_TOKEN.search(text or "")
+    if not match or not match.group(1)[0].isalpha():
+        return None
+    return POSSESSIVE.sub("", match.group(1)).lower()
+
+
+def personalize(predictions, index, text):
+    """
+    Re-rank Cohere's probable words by how often the author follows the
+    last word with them, add up to MAX_SUPPLEMENTS of the author's own
+    frequent follow-ups, and restore the author's capitalization of names
+    """
+    if not index or not index.words:
+        return predictions
+    followers = index.followers(last_word(text))
+    probable = [p["word"] for p in predictions if p["type"] == "probable"]
+    creative = [p["word"] for p in predictions if p["type"] == "creative"]
+    seen = {w.lower() for w in probable + creative}
+
+    supplements = [
+        word for word, count in sorted(followers.items(), key=lambda item: -item[1])
+        if count >= MIN_FOLLOW_COUNT and word not in seen
+    ][:MAX_SUPPLEMENTS]
+    candidates = [(w, False) for w in probable] + [(w, True) for w in supplements]
+    # Stable sort: Cohere's order is kept among words the author has no habit for
+    candidates.sort(key=lambda c: -followers.get(c[0].lower(), 0))
+    candidates = candidates[:len(probable)]
+
+    ranked = []
+    for i, (word, personal) in enumerate(candidates):
+        prediction = {"id": i + 1, "word": index.display(word), "rank": str(i + 1), "type": "probable"}
+        if personal:
+            prediction["personal"] = True
+        ranked.append(prediction)
+    for i, word in enumerate(creative):
+        ranked.append({"id": len(candidates) + i + 1, "word": index.display(word),
+                       "rank": f"C{i + 1}", "type": "creative"})
+    return ranked
+
+
+# ==================== STORAGE / REFRESH ====================
+
+class StyleIndexer:
+    """
+    Keeps style indexes of active users in memory
+    get() never blocks on Mongo: a missing or stale index is queued for a
+    background refresh, which rebuilds only books whose updatedAt changed.
+    """
+
+    def __init__(self, books_collection, styles_collection, refresh_seconds=REFRESH_SECONDS):
+        self.books_collection = books_collection
+        self.styles_collection = styles_collection
+        self.refresh_seconds = refresh_seconds
+        self.cache = OrderedDict()  # user_id -> (StyleIndex, checked_at)
+        self.stale = set()
+        self.queued = set()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        styles_collection.create_index("bookId", unique=True)
+        styles_collection.create_index("userId")
+        threading.Thread(target=self._refresh_loop, name="style-index", daemon=True).start()
+
+    def get(self, user_id):
+        """Cached index of a user (or None), scheduling a refresh when due"""
+        if not user_id:
+            return None
+        with self.lock:
+            entry = self.cache.get(user_id)
+            if entry:
+                self.cache.move_to_end(user_id)
+            due = (entry is None or user_id in self.stale
+                   or time.monotonic() - entry[1] >= self.refresh_seconds)
+            if due and user_id not in self.queued:
+                self.queued.add(user_id)
+                self.queue.put(user_id)
+        return entry[0] if entry else None
+
+    def invalidate(self, user_id):
+        """A book of this user changed; re-check it on the next prediction"""
+        if user_id:
+            with self.lock:
+                self.stale.add(user_id)
+
+    def invalidate_all(self):
+        """Changes may have been missed; re-check every cached user"""
+        with self.lock:
+            self.stale.update(self.cache)
+
+    def _refresh_loop(self):
+        while True:
+            user_id = self.queue.get()
+            try:
+                self.refresh(user_id)
+            except Exception:
+                logger.exception("Error refreshing style index", extra={"fields": {"userId": user_id}})
+            finally:
+                with self.lock:
+                    self.queued.discard(user_id)
+
+    def refresh(self, user_id):
+        """Rebuild the tables of changed books and swap in the merged index"""
+        with self.lock:
+            self.stale.discard(user_id)
+        versions = {
+            str(book["_id"]): book.get("updatedAt")
+            for book in self.books_collection.find({"userId": user_id}, {"updatedAt": 1})
+        }
+        tables = {}
+        for doc in self.styles_collection.find({"userId": user_id}, {"_id": 0}):
+            if doc["bookId"] not in versions:
+                self.styles_collection.delete_one({"bookId": doc["bookId"]})
+            elif doc.get("sourceUpdatedAt") == versions[doc["bookId"]]:
+                tables[doc["bookId"]] = doc
+
+        for book_id, updated_at in versions.items():
+            if book_id in tables:
+                continue
+            book = self.books_collection.find_one({"_id": ObjectId(book_id)},
+                                                  {"content": 1, "updatedAt": 1})
+            if not book:
+                continue
+            table = build_book_table(book.get("content", ""))
+            table.update({
+                "userId": user_id,
+                "bookId": book_id,
+                "sourceUpdatedAt": book.get("updatedAt"),
+                "builtAt": datetime.now(timezone.utc)
+            })
+            self.styles_collection.replace_one({"bookId": book_id}, table, upsert=True)
+            tables[book_id] = table
+
+        index = StyleIndex(tables.values())
+        with self.lock:
+            self.cache[user_id] = (index, time.monotonic())
+            self.cache.move_to_end(user_id)
+            while len(self.cache) > CACHE_USERS:
+                self.cache.popitem(last=False)
+        return index
@@ -0,0 +1,169 @@
+"""
+Parser for model prediction output
+Models are asked for "8 comma-separated lowercase words", but answers
+also arrive as numbered lists, with "Creative:" labels, space-separated,
+with multi-word items or as plain prose. parse() splits the text into
+items with precompiled patterns (the common clean "word, word, ..." shape
+takes a shorter path), keeps the first word of every item, drops
+duplicates and repeats of the word the writer just typed, and scores how
+much the answer looked like what was asked for, so callers can retry or
+fall back instead of serving padding.
+"""
+
+import re
+
+WORDS_NEEDED = 8
+MAX_WORD_LENGTH = 20
+SPACE_LIST_MAX = 12     # a separator-less answer this short is a space-separated list
+RETRY_BELOW = 0.6       # quality under this is worth a retry / another provider
+
+SEPARATOR = re.compile(r"[,;|\n]")
+WORD = re.compile(r"[A-Za-z]+(?:['’][A-Za-z]+)*")     # with inner apostrophes
+SENTENCE_END = re.compile(r"[.!?]")                  # prose, unless items are separated
+# One comma-separated item that is a single word: the shape asked for
+PLAIN_ITEM = re.compile(r"\s*([A-Za-z]+(?:['’][A-Za-z]+)*)\s*")
+LETTERS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+APOSTROPHES = frozenset("'’")
+
+
+class ParseResult:
+    __slots__ = ("words", "quality")
+
+    def __init__(self, words, quality):
+        self.words = words
+        self.quality = quality
+
+    @property
+    def complete(self):
+        """All 8 words and good enough to serve as-is"""
+        return len(self.words) >= WORDS_NEEDED and self.quality >= RETRY_BELOW
+
+    def __repr__(self):
+        return f"ParseResult({self.words!r}, quality={self.quality})"
+
+
+def context_tail(text):
+    """The word the writer just typed, lowercased (or None)"""
+    if not text:
+        return None
+    # Scan back from the end instead of regex-searching the whole context
+    end = len(text)
+    while end and text[end - 1] not in LETTERS:
+        if text[end - 1].isalnum():
+            return None  # ends in a number or non-Latin word
+        end -= 1
+    start = end
+    while start and (text[start - 1] in LETTERS or
+                     (text[start - 1] in APOSTROPHES and start > 1 and text[start - 2] in LETTERS)):
+        start -= 1
+    return text[start:end].lower().replace("’", "'") if end else None
+
+
+def _new_word(token, seen, tail):
+    """token as a suggestion (added to seen), or None for a duplicate, the context's last word or junk"""
+    word = token.lower().replace("’", "'")
+    if word in seen or word == tail or len(word) > MAX_WORD_LENGTH:
+        return None
+    seen.add(word)
+    return word
+
+
+def _parse_plain(raw, tail):
+    """
+    parse() for the common clean answer, "word, word, ..." with one word
+    per item: a str.split and one fullmatch per item; None when raw has
+    any other shape
+    """
+    words = []
+    seen = set()
+    rejected = 0
+    for item in raw.split(","):
+        match = PLAIN_ITEM.fullmatch(item)
+        if match is None:
+            return None
+        if len(words) >= WORDS_NEEDED:
+            continue    # the walk stops here too, but the rest must still be plain
+        word = _new_word(match.group(1), seen, tail)
+        if word is None:
+            rejected += 1
+            continue
+        words.append(word)
+    if not words:
+        return ParseResult(words, 0.0)
+    quality = len(words) / WORDS_NEEDED * (1 - 0.25 * min(rejected, 4) / 4)
+    return ParseResult(words, round(quality, 3))
+
+
+def parse(raw, context=None):
+    """
+    Up to 8 words from raw model output and a 0..1 quality score
+    context is the text the prediction continues; its last word is never
+    suggested again.
+    """
+    tail = context_tail(context)
+    if raw and "," in raw:
+        result = _parse_plain(raw, tail)
+        if result is not None:
+            return result
+    words = []
+    seen = set()
+    items = 0          # separated items that held at least one word
+    multi = 0          # ...of which had more than one word
+    rejected = 0       # duplicates, context repeats and junk tokens
+
+    # Every piece but the last was closed by a separator; a colon ends a
+    # label ("Probable:", "Here are 8 words:") and only what follows counts
+    pieces = SEPARATOR.split(raw or "")
+    separators = len(pieces) - 1
+    last = []
+    for n, piece in enumerate(pieces):
+        if ":" in piece:
+            piece = piece[piece.rindex(":") + 1:]
+        found = WORD.findall(piece)
+        if n == separators:
+            last = found
+            break
+        if not found:
+            continue
+        items += 1
+        multi += len(found) > 1
+        word = _new_word(found[0], seen, tail)
+        if word is None:
+            rejected += 1
+            continue
+        words.append(word)
+        if len(words) >= WORDS_NEEDED:
+            last = []
+            break
+
+    space_list = False
+    if last and len(words) < WORDS_NEEDED:
+        if not separators and 1 < len(last) <= SPACE_LIST_MAX and not SENTENCE_END.search(raw):
+            space_list = True
+            candidates = last
+        else:
+            items += 1
+            multi += len(last) > 1
+            candidates = last[:1]
+        for token in candidates:
+            word = _new_word(token, seen, tail)
+            if word is None:
+                rejected += 1
+                continue
+            words.append(word)
+            if len(words) >= WORDS_NEEDED:
+                break
+
+    words = words[:WORDS_NEEDED]
+    if not words:
+        return ParseResult(words, 0.0)
+
+    quality = len(words) / WORDS_NEEDED
+    if space_list:
+        quality *= 0.9
+    elif items:
+        quality *= 1 - 0.5 * multi / items
+    if not separators and not space_list:
+        quality *= 0.25  # prose
+    quality *= 1 - 0.25 * min(rejected, 4) / 4
+    return ParseResult(words, round(quality, 3))
@@ -0,0 +1,218 @@
+"""
+On-demand profiling for live workers
+A statistical stack sampler (flamegraph-compatible collapsed output) plus
+a tracemalloc allocation snapshot, switched on for N seconds or N requests (never longer than
+MAX_PROFILE_SECONDS) through the admin endpoint or by sending SIGUSR2 to
+the worker.
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp")
+MAX_PROFILE_SECONDS = 300
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+class ProfileSession:
+    """
+    One profiling run: samples every thread's stack at a fixed interval
+    and diffs tracemalloc snapshots taken at start and stop
+    """
+
+    def __init__(self, seconds=None, requests=None, interval=0.005, top=25):
+        self.seconds = seconds
+        self.requests = requests
+        self.interval = interval
+        self.top = top
+        self.stacks = Counter()
+        self.samples = 0
+        self.requests_seen = 0
+        self.started_at = None
+        self.stopped_at = None
+        self.allocations = []
+        self._stacks_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+        self._baseline = None
+        self._owns_tracemalloc = False
+
+    @property
+    def running(self):
+        return self.started_at is not None and not self._done.is_set()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._owns_tracemalloc = True
+        self._baseline = tracemalloc.take_snapshot()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        me = threading.get_ident()
+        # Request-bounded runs are capped too, or a quiet worker would trace forever
+        deadline = time.monotonic() + (self.seconds or MAX_PROFILE_SECONDS)
+        while not self._stop.is_set():
+            sampled = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.reverse()
+                sampled.append(";".join(stack))
+            with self._stacks_lock:
+                self.stacks.update(sampled)
+            self.samples += 1
+            if time.monotonic() >= deadline:
+                break
+            self._stop.wait(self.interval)
+        self._finish()
+
+    def _finish(self):
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self._baseline, "lineno")
+        self.allocations = [
+            {
+                "location": str(stat.traceback),
+                "sizeDiffBytes": stat.size_diff,
+                "sizeBytes": stat.size,
+                "countDiff": stat.count_diff,
+            }
+            for stat in stats[:self.top]
+        ]
+        self._baseline = None
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        self.stopped_at = time.time()
+        self._done.set()
+
+    def stop(self):
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def record_request(self):
+        """Called after each request; stops once the request budget is spent"""
+        if self.requests and self.running:
+            self.requests_seen += 1
+            if self.requests_seen >= self.requests:
+                self.stop()
+
+    def collapsed(self):
+        """Brendan Gregg's collapsed-stack format: 'a;b;c count' per line"""
+        with self._stacks_lock:
+            ranked = self.stacks.most_common()
+        return "\n".join(f"{stack} {count}" for stack, count in ranked)
+
+    def summary(self):
+        return {
+            "running": self.running,
+            "seconds": self.seconds,
+            "requests": self.requests,
+            "requestsSeen": self.requests_seen,
+            "samples": self.samples,
+            "intervalMs": self.interval * 1000,
+            "startedAt": self.started_at,
+            "stoppedAt": self.stopped_at,
+        }
+
+
+_lock = threading.Lock()
+_session = None
+
+
+def current_session():
+    return _session
+
+
+def start_session(seconds=None, requests=None, interval=0.005):
+    """
+    Start a new session; returns None if one is already running
+    Raises ValueError for a non-positive or non-numeric seconds/requests.
+    Every session stops after MAX_PROFILE_SECONDS at the latest.
+    """
+    global _session
+    if seconds is not None:
+        seconds = float(seconds)
+        if not 0 < seconds < float("inf"):
+            raise ValueError("seconds must be a positive number")
+        seconds = min(seconds, MAX_PROFILE_SECONDS)
+    if requests is not None:
+        if isinstance(requests, float) and not requests.is_integer():
+            raise ValueError("requests must be a positive integer")
+        requests = int(requests)
+        if requests <= 0:
+            raise ValueError("requests must be a positive integer")
+    if seconds is None and requests is None:
+        seconds = 10.0
+    with _lock:
+        if _session and _session.running:
+            return None
+        _session = ProfileSession(seconds=seconds, requests=requests, interval=interval)
+        _session.start()
+        return _session
+
+
+def dump_to_files(session):
+    """Write collapsed stacks and allocation stats next to each other"""
+    base = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{int(session.started_at)}")
+    with open(base + ".collapsed", "w") as f:
+        f.write(session.collapsed())
+    with open(base + ".alloc.txt", "w") as f:
+        for alloc in session.allocations:
+            f.write(f"{alloc['sizeDiffBytes']:>12} {alloc['countDiff']:>8} {alloc['location']}\n")
+    return base
+
+
+def _dump_when_done(session):
+    session.wait()
+    print(f"📈 Profile written to {dump_to_files(session)}.*")
+
+
+def _handle_signal(signum, frame):
+    """SIGUSR2 toggles a profiling session; the result is dumped to PROFILE_DIR"""
+    session = _session
+    if session and session.running:
+        session.stop()
+        return
+    session = start_session(seconds=MAX_PROFILE_SECONDS)
+    if session:
+        threading.Thread(target=_dump_when_done, args=(session,), daemon=True).start()
+        print(f"📈 Profiling worker {os.getpid()} (send SIGUSR2 again to stop)")
+
+
+def init_app(app, ignore_endpoints=()):
+    """
+    Count requests for request-bounded sessions and install the signal handler
+    Requests to ignore_endpoints (the profiler's own admin routes) don't
+    use up a session's request budget.
+    """
+    from flask import request
+
+    ignore_endpoints = frozenset(ignore_endpoints)
+
+    @app.after_request
+    def _count_profiled_request(response):
+        session = _session
+        if session and request.endpoint not in ignore_endpoints:
+            session.record_request()
+        return response
+
+    if hasattr(signal, "SIGUSR2") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR2, _handle_signal)
@@ -0,0 +1,471 @@
+"""
+Prediction providers and latency-based routing
+Every backend implements Provider.complete(query) and returns raw text
+with comma-separated words. The engine keeps a smoothed latency and
+error rate per provider, routes each request to the best-scoring one
+(occasionally re-trying the others so their numbers stay current), can
+race the two best and take the first answer with all 8 words, and falls
+back down the list when a provider fails. A model answer that parses
+poorly (see prediction_parser.py) is retried once with a terse prompt
+before moving on. Backends:
+
+  cohere  Cohere chat API (COHERE_API_KEY, COHERE_MODEL)
+  local   OpenAI-compatible chat endpoint such as llama.cpp, vLLM or
+          Ollama (LOCAL_MODEL_URL, LOCAL_MODEL_NAME)
+  ngram   in-process bigram table plus the author's style index
+  mock    fixed words with configurable latency / failures, for offline runs
+"""
+
+import contextvars
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.request
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import prediction_parser
+from tracing import logger, span
+
+COHERE_MODEL = os.getenv("COHERE_MODEL", "command-a-03-2025")
+LOCAL_MODEL_URL = os.getenv("LOCAL_MODEL_URL")
+LOCAL_MODEL_NAME = os.getenv("LOCAL_MODEL_NAME", "llama3")
+PROVIDERS = os.getenv("PREDICT_PROVIDERS", "cohere,local")
+FALLBACKS = os.getenv("PREDICT_FALLBACKS", "ngram")
+RACE = os.getenv("PREDICT_RACE", "False").lower() == "true"
+TIMEOUT = float(os.getenv("PREDICT_PROVIDER_TIMEOUT", 10))
+
+WORDS_NEEDED = prediction_parser.WORDS_NEEDED
+CONTEXT_WORDS = 30      # trailing words of the manuscript sent as context
+EWMA_ALPHA = 0.2
+ERROR_PENALTY = 10      # a provider failing every call scores like one 11x slower...
+FAILURE_COST_MS = 1000  # ...plus a flat cost, so fast failures don't look attractive
+EXPLORE_EVERY = 20      # every Nth request goes to another provider to refresh its stats
+
+_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="predict-race")
+
+
+class ProviderError(Exception):
+    """No provider produced a usable answer"""
+
+
+class PredictionQuery:
+    """
+    What a provider gets: the full prompt plus the pieces it was built from
+    usage, when a list, collects (provider, input tokens, output tokens)
+    for every model call made for this query, retries and races included.
+    """
+
+    __slots__ = ("prompt", "text", "genre", "style_index", "retry_prompt", "usage")
+
+    def __init__(self, prompt, text, genre, style_index=None, retry_prompt=None, usage=None):
+        self.prompt = prompt
+        self.text = text
+        self.genre = genre
+        self.style_index = style_index
+        self.retry_prompt = retry_prompt
+        self.usage = usage
+
+    def for_retry(self):
+        return PredictionQuery(self.retry_prompt, self.text, self.genre, self.style_index, usage=self.usage)
+
+    def record_usage(self, provider, input_tokens, output_tokens):
+        if self.usage is not None:
+            self.usage.append((provider, input_tokens or 0, output_tokens or 0))
+
+
+def build_query(text, genre, style_index=None, usage=None, passages=()):
+    """
+    The prediction prompt (and terse retry prompt) for the end of text
+    passages: earlier parts of the book relevant to it (retrieval.py)
+    """
+    words_list = text.split()
+    last_words = " ".join(words_list[-CONTEXT_WORDS:]) if len(words_list) > CONTEXT_WORDS else text
+    earlier = ""
+    if passages:
+        quoted = "\n".join(f'- "{passage}"' for passage in passages)
+        earlier = f"""
+Earlier in the book (for reference only, do not continue it):
+{quoted}
+"""
+
+    prompt = f"""You are a literary-level predictive writing assistant trained to help professional novelists.
+
+You analyze narrative flow, pacing, emotional tone, and genre conventions before predicting the next words.
+
+Genre: "{genre}"
+{earlier}
+Recent Context:
+"{last_words}"
+
+Return:
+- 5 highly probable next words
+- 3 creative alternative words
+
+Format:
+comma-separated list only (8 words total, probable first then creative)
+lowercase only, no punctuation, no explanation"""
+
+    # Terse prompt for one retry when the first answer doesn't parse well
+    retry_prompt = f"""Continue this {genre} text: "{last_words}"
+Reply with exactly 8 different next words, comma-separated, lowercase, nothing else."""
+
+    return PredictionQuery(prompt, last_words, genre, style_index, retry_prompt, usage)
+
+
+def format_predictions(words):
+    """5 probable + 3 creative prediction entries, as /api/predict returns them"""
+    predictions = []
+    for i, word in enumerate(words[:5]):
+        predictions.append({
+            "id": i + 1,
+            "word": word,
+            "rank": str(i + 1),
+            "type": "probable"
+        })
+    for i, word in enumerate(words[5:8]):
+        predictions.append({
+            "id": i + 6,
+            "word": word,
+            "rank": f"C{i + 1}",
+            "type": "creative"
+        })
+    return predictions
+
+
+# ==================== PROVIDERS ====================
+
+class Provider:
+    name = "provider"
+    retryable = False  # worth a second call with the terse prompt after a poor answer
+
+    def complete(self, query):
+        """Raw model output for query"""
+        raise NotImplementedError
+
+
+class CohereProvider(Provider):
+    name = "cohere"
+    retryable = True
+
+    def __init__(self, api_key, model=COHERE_MODEL, timeout=TIMEOUT):
+        import cohere
+        self.client = cohere.ClientV2(api_key=api_key, timeout=timeout)
+        self.model = model
+
+    def complete(self, query):
+        response = self.client.chat(
+            model=self.model,
+            messages=[
+                {"role": "user", "content": query.prompt}
+            ]
+        )
+        usage = getattr(response, "usage", None)
+        tokens = usage and (usage.tokens or usage.billed_units)
+        if tokens:
+            query.record_usage(self.name, tokens.input_tokens, tokens.output_tokens)
+        return response.message.content[0].text
+
+
+class LocalModelProvider(Provider):
+    """Any server speaking the OpenAI chat completions API"""
+
+    name = "local"
+    retryable = True
+
+    def __init__(self, base_url, model=LOCAL_MODEL_NAME, timeout=TIMEOUT):
+        self.url = base_url.rstrip("/") + "/v1/chat/completions"
+        self.model = model
+        self.timeout = timeout
+
+    def complete(self, query):
+        body = json.dumps({
+            "model": self.model,
+            "messages": [{"role": "user", "content": query.prompt}],
+            "max_tokens": 40,
+            "temperature": 0.7,
+        }).encode()
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            payload = json.load(response)
+        usage = payload.get("usage") or {}
+        query.record_usage(self.name, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+        return payload["choices"][0]["message"]["content"]
+
+
+# Likely next words after common words (most likely first)
+BIGRAMS = {
+    "the": ["door", "man", "room", "other", "first", "light", "night", "old"],
+    "a": ["moment", "little", "few", "long", "man", "small", "voice", "new"],
+    "an": ["old", "hour", "instant", "empty", "answer", "eye", "idea", "open"],
+    "of": ["the", "her", "his", "a", "their", "it", "them", "my"],
+    "to": ["the", "be", "see", "make", "her", "his", "go", "find"],
+    "in": ["the", "a", "her", "his", "that", "this", "silence", "time"],
+    "and": ["the", "then", "she", "he", "i", "a", "her", "his"],
+    "was": ["a", "the", "not", "still", "no", "too", "nothing", "gone"],
+    "had": ["been", "never", "a", "to", "the", "not", "already", "seen"],
+    "she": ["said", "was", "had", "could", "looked", "felt", "knew", "turned"],
+    "he": ["said", "was", "had", "could", "looked", "felt", "knew", "turned"],
+    "it": ["was", "had", "is", "would", "seemed", "felt", "could", "might"],
+    "i": ["was", "had", "could", "said", "knew", "think", "felt", "saw"],
+    "they": ["were", "had", "would", "could", "said", "did", "walked", "knew"],
+    "we": ["were", "had", "could", "would", "should", "need", "must", "can"],
+    "you": ["are", "were", "have", "can", "know", "should", "said", "need"],
+    "said": ["the", "she", "he", "nothing", "softly", "quietly", "it", "again"],
+    "her": ["eyes", "hand", "voice", "face", "head", "mother", "heart", "own"],
+    "his": ["eyes", "hand", "voice", "face", "head", "father", "heart", "own"],
+    "at": ["the", "her", "him", "last", "once", "least", "first", "night"],
+    "on": ["the", "her", "his", "a", "its", "their", "top", "it"],
+    "with": ["a", "the", "her", "his", "an", "them", "its", "no"],
+    "from": ["the", "her", "his", "a", "their", "behind", "within", "above"],
+    "into": ["the", "her", "his", "a", "darkness", "silence", "their", "its"],
+    "for": ["a", "the", "her", "him", "them", "it", "years", "once"],
+    "that": ["she", "he", "the", "was", "it", "they", "i", "had"],
+    "there": ["was", "were", "is", "had", "would", "are", "might", "seemed"],
+    "not": ["a", "the", "to", "even", "yet", "be", "quite", "just"],
+    "could": ["not", "see", "feel", "hear", "only", "have", "be", "still"],
+    "would": ["be", "have", "not", "never", "take", "come", "make", "find"],
+}
+COMMON_NEXT = ["the", "and", "to", "a", "of", "her", "was", "in"]
+GENRE_WORDS = {
+    "fantasy": ["ancient", "enchanted", "shimmering", "forgotten", "runes"],
+    "sci-fi": ["orbital", "quantum", "flickering", "derelict", "signal"],
+    "mystery": ["clue", "shadowed", "alibi", "peculiar", "silent"],
+    "thriller": ["suddenly", "desperate", "hunted", "trembling", "ticking"],
+    "horror": ["rotting", "whispering", "hollow", "creeping", "pale"],
+    "romance": ["tender", "breathless", "longing", "blushing", "gentle"],
+}
+DEFAULT_CREATIVE = ["beneath", "whispered", "shadows", "luminous", "restless"]
+LAST_WORD = re.compile(r"([a-z']+)[^a-z']*$")
+
+
+class NgramProvider(Provider):
+    """
+    Bigram guesses without any model call
+    The author's own follow-ups (style index) come first, then a built-in
+    table of common transitions; creative slots use genre vocabulary.
+    """
+
+    name = "ngram"
+
+    def complete(self, query):
+        match = LAST_WORD.search((query.text or "").lower())
+        prev = match.group(1).replace("'", "") if match else None
+        probable = []
+        if query.style_index is not None:
+            followers = query.style_index.followers(prev)
+            probable += [w for w, _ in sorted(followers.items(), key=lambda item: -item[1])]
+        probable += BIGRAMS.get(prev, COMMON_NEXT)
+        probable += COMMON_NEXT
+        probable = list(dict.fromkeys(w for w in probable if w != prev))[:5]
+
+        creative = GENRE_WORDS.get((query.genre or "").lower(), []) + DEFAULT_CREATIVE
+        creative = [w for w in dict.fromkeys(creative) if w not in probable][:3]
+        return ", ".join(probable + creative)
+
+
+class MockProvider(Provider):
+    """Fixed answer with optional latency and failure rate"""
+
+    def __init__(self, name="mock", words=None, latency_ms=0, error_rate=0.0):
+        self.name = name
+        self.words = words or ["the", "a", "her", "his", "and", "luminous", "hollow", "drifting"]
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+
+    def complete(self, query):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            raise ProviderError(f"{self.name} failed (simulated)")
+        return ", ".join(self.words)
+
+
+# ==================== ROUTING ====================
+
+class ProviderStats:
+    __slots__ = ("latency_ms", "error_rate", "calls", "failures")
+
+    def __init__(self):
+        self.latency_ms = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.failures = 0
+
+    def record(self, elapsed_ms, ok):
+        self.calls += 1
+        if not ok:
+            self.failures += 1
+        if self.latency_ms is None:
+            self.latency_ms = elapsed_ms
+        else:
+            self.latency_ms += EWMA_ALPHA * (elapsed_ms - self.latency_ms)
+        self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def score(self):
+        """Lower is better; providers never called go first"""
+        if self.latency_ms is None:
+            return -1.0
+        return (self.latency_ms * (1 + ERROR_PENALTY * self.error_rate)
+                + FAILURE_COST_MS * self.error_rate)
+
+
+class PredictionEngine:
+    def __init__(self, providers, fallbacks=(), race=RACE, timeout=TIMEOUT):
+        self.providers = list(providers)
+        self.fallbacks = list(fallbacks)
+        self.race = race
+        self.timeout = timeout
+        self.stats = {p.name: ProviderStats() for p in self.providers + self.fallbacks}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def available(self):
+        return bool(self.providers or self.fallbacks)
+
+    def ranked(self):
+        """Routed providers, best score first"""
+        with self.lock:
+            self.requests += 1
+            order = sorted(self.providers, key=lambda p: self.stats[p.name].score())
+            if len(order) > 1 and self.requests % EXPLORE_EVERY == 0:
+                # Take turns over the others so a recovered provider gets noticed
+                other = 1 + (self.requests // EXPLORE_EVERY) % (len(order) - 1)
+                order.insert(0, order.pop(other))
+        return order
+
+    def _call(self, provider, query):
+        """Run one provider and record how it did; returns a ParseResult"""
+        started = time.perf_counter()
+        ok = False
+        try:
+            with span(f"provider.{provider.name}", promptChars=len(query.prompt)):
+                raw = provider.complete(query)
+                logger.debug("Provider response", extra={"fields": {"provider": provider.name, "raw": raw}})
+                result = prediction_parser.parse(raw, query.text)
+            ok = result.complete
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.stats[provider.name].record(elapsed_ms, ok)
+
+    def _attempt(self, provider, query):
+        """One call, plus a retry with the terse prompt if the answer was poor"""
+        result = self._call(provider, query)
+        if not result.complete and provider.retryable and query.retry_prompt:
+            logger.info("Retrying poor prediction answer", extra={"fields": {
+                "provider": provider.name, "quality": result.quality, "words": len(result.words)}})
+            retry = self._call(provider, query.for_retry())
+            if (retry.quality, len(retry.words)) > (result.quality, len(result.words)):
+                result = retry
+        return result
+
+    @staticmethod
+    def _better(best, result, name):
+        """Keep the best partial answer seen so far as (result, provider name)"""
+        if result.words and (best is None or (result.quality, len(result.words))
+                             > (best[0].quality, len(best[0].words))):
+            return result, name
+        return best
+
+    def _race(self, providers, query):
+        """First complete answer of several providers, or the best partial one"""
+        futures = {
+            _pool.submit(contextvars.copy_context().run, self._attempt, p, query): p
+            for p in providers
+        }
+        best = None
+        pending = set(futures)
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                name = futures[future].name
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning("Prediction provider failed", extra={"fields": {
+                        "provider": name, "error": str(e)}})
+                    continue
+                if result.complete:
+                    return result, name
+                best = self._better(best, result, name)
+        return best
+
+    def predict(self, query):
+        """
+        Words from the best available provider, and its name
+        Partial or low-quality answers are only returned when no provider
+        (fallbacks included) does better.
+        """
+        order = self.ranked()
+        best = None
+        if self.race and len(order) > 1:
+            best = self._race(order[:2], query)
+            if best and best[0].complete:
+                return best[0].words, best[1]
+            order = order[2:]
+
+        for provider in order + self.fallbacks:
+            try:
+                result = self._attempt(provider, query)
+            except Exception as e:
+                logger.warning("Prediction provider failed", extra={"fields": {
+                    "provider": provider.name, "error": str(e)}})
+                continue
+            if result.complete:
+                return result.words, provider.name
+            best = self._better(best, result, provider.name)
+
+        if best:
+            return best[0].words, best[1]
+        raise ProviderError("All prediction providers failed")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: {
+                    "latencyMs": round(s.latency_ms, 1) if s.latency_ms is not None else None,
+                    "errorRate": round(s.error_rate, 3),
+                    "calls": s.calls,
+                    "failures": s.failures,
+                }
+                for name, s in self.stats.items()
+            }
+
+
+def fill_words(words, query):
+    """Top up a partial answer to 8 words with n-gram guesses for the same context"""
+    if len(words) >= WORDS_NEEDED:
+        return words
+    extra = prediction_parser.parse(NgramProvider().complete(query), query.text).words
+    words = list(words)
+    words += [w for w in extra if w not in words][:WORDS_NEEDED - len(words)]
+    return words
+
+
+def _build(name, cohere_api_key):
+    if name == "cohere":
+        return CohereProvider(cohere_api_key) if cohere_api_key else None
+    if name == "local":
+        return LocalModelProvider(LOCAL_MODEL_URL) if LOCAL_MODEL_URL else None
+    if name == "ngram":
+        return NgramProvider()
+    if name == "mock":
+        return MockProvider()
+    logger.warning("Unknown prediction provider", extra={"fields": {"provider": name}})
+    return None
+
+
+def build_engine(cohere_api_key=None, providers=PROVIDERS, fallbacks=FALLBACKS):
+    """Engine from comma-separated provider names; unconfigured ones are left out"""
+    def build_all(names):
+        built = [_build(n.strip().lower(), cohere_api_key) for n in names.split(",") if n.strip()]
+        return [p for p in built if p is not None]
+    return PredictionEngine(build_all(providers), build_all(fallbacks))
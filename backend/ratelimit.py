@@ -0,0 +1,152 @@
+"""
+Rate limiting and client pacing for /api/predict
+Token buckets per user and per client IP cap how often predictions can
+be requested; a rejected call gets the time until its next token as
+Retry-After. UpstreamStats tracks Cohere latency, errors and in-flight
+calls so every response can recommend how long clients should wait
+between requests, stretching the editor's debounce when Cohere or this
+worker is saturated. State is per worker process.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+USER_RATE = float(os.getenv("PREDICT_RATE_PER_USER", 2))     # tokens per second
+USER_BURST = float(os.getenv("PREDICT_BURST_PER_USER", 6))
+IP_RATE = float(os.getenv("PREDICT_RATE_PER_IP", 6))
+IP_BURST = float(os.getenv("PREDICT_BURST_PER_IP", 20))
+CONCURRENCY = int(os.getenv("PREDICT_CONCURRENCY", 8))       # upstream calls this worker handles comfortably
+
+MIN_INTERVAL_MS = 300
+MAX_INTERVAL_MS = 5000
+EWMA_ALPHA = 0.2
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until one token is available"""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token buckets keyed by strings such as "user:<id>" or "ip:<addr>"
+    Kept as an LRU of max_buckets: a client rotating user IDs only pushes
+    out the least recently used buckets (its IP bucket keeps limiting it)
+    """
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.buckets = OrderedDict()
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+
+    def acquire(self, limits):
+        """
+        Take one token from every bucket in limits ([(key, rate, burst)])
+        Either all buckets are charged or none; returns (allowed, retry_after)
+        """
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            for key, rate, burst in limits:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(rate, burst, now)
+                    while len(self.buckets) > self.max_buckets:
+                        self.buckets.popitem(last=False)
+                else:
+                    self.buckets.move_to_end(key)
+                bucket.refill(now)
+                buckets.append(bucket)
+            retry_after = max((b.wait_time() for b in buckets), default=0.0)
+            if retry_after > 0:
+                return False, retry_after
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return True, 0.0
+
+
+class UpstreamStats:
+    """Smoothed upstream latency / error rate and current in-flight calls"""
+
+    def __init__(self, concurrency=CONCURRENCY):
+        self.concurrency = concurrency
+        self.latency_ms = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def track(self):
+        """Wrap one upstream call"""
+        with self.lock:
+            self.in_flight += 1
+        started = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.in_flight -= 1
+                if self.latency_ms is None:
+                    self.latency_ms = elapsed_ms
+                else:
+                    self.latency_ms += EWMA_ALPHA * (elapsed_ms - self.latency_ms)
+                self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def recommended_interval_ms(self):
+        """
+        How long a client should wait between prediction requests
+        Never shorter than a round trip to Cohere; stretched as this
+        worker's in-flight calls pass half its capacity and as upstream
+        errors pile up.
+        """
+        with self.lock:
+            latency = self.latency_ms or 0.0
+            load = self.in_flight / self.concurrency if self.concurrency else 0.0
+            errors = self.error_rate
+        interval = max(MIN_INTERVAL_MS, latency)
+        if load > 0.5:
+            interval *= 1 + 2 * (load - 0.5)
+        interval *= 1 + 4 * errors
+        return int(min(MAX_INTERVAL_MS, interval))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "latencyMs": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+                "errorRate": round(self.error_rate, 3),
+                "inFlight": self.in_flight,
+            }
+
+
+def predict_limits(user_id, client_ip):
+    """Buckets a prediction request is charged against"""
+    limits = [(f"ip:{client_ip}", IP_RATE, IP_BURST)]
+    if user_id:
+        limits.append((f"user:{user_id}", USER_RATE, USER_BURST))
+    return limits
+
+
+def retry_after_header(seconds):
+    """Retry-After takes whole seconds"""
+    return str(max(1, math.ceil(seconds)))
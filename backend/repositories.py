@@ -0,0 +1,283 @@
+"""
+Data access for books and users
+Route handlers read and write through a BookRepository / UserRepository
+rather than the collections, so query shapes, projections and indexes
+live in one place. The Mongo implementations are what the app runs on;
+the Memory implementations keep documents in dicts behind the same
+calls, so handlers can be benchmarked and tested at scale without
+MongoDB (bench.py --repositories memory). Background components
+(autosave flushes, collab rooms, imports, jobs, indexes, change feed)
+still use the collections directly.
+"""
+
+import threading
+from abc import ABC, abstractmethod
+
+from bson import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from summaries import SUMMARY_PROJECTION, content_preview
+
+# Fields the export routes read; content and cover are the large ones
+EXPORT_PROJECTION = {"title": 1, "description": 1, "coverImage": 1, "content": 1,
+                     "revision": 1, "updatedAt": 1}
+JOB_PROJECTION = {"userId": 1, "revision": 1, "updatedAt": 1}
+# Library listings and the change feed: everything serialize_book_summary
+# shows, with the stored contentPreview in place of the manuscript
+LIST_PROJECTION = {"title": 1, "description": 1, "coverImage": 1, "genre": 1, "wordCount": 1,
+                   "status": 1, "isFavorite": 1, "isArchived": 1, "createdAt": 1,
+                   "updatedAt": 1, "contentPreview": 1}
+
+
+def books_query(user_id, status=None, is_favorite=None, is_archived=None, genre=None):
+    """Equality query on a user's books; None leaves a filter out"""
+    query = {"userId": user_id}
+    for field, value in (("status", status), ("isFavorite", is_favorite),
+                         ("isArchived", is_archived), ("genre", genre)):
+        if value is not None:
+            query[field] = value
+    return query
+
+
+class BookRepository(ABC):
+    """
+    Book documents, keyed by their ObjectId as a string
+    Methods raise bson.errors.InvalidId for malformed IDs, as ObjectId() does.
+    """
+
+    def ensure_indexes(self):
+        pass
+
+    @abstractmethod
+    def insert(self, book):
+        """Store a new book (sets book["_id"]) and return its ID"""
+
+    @abstractmethod
+    def get(self, book_id, projection=None):
+        pass
+
+    @abstractmethod
+    def list_for_user(self, user_id, status=None, is_favorite=None, is_archived=None, genre=None):
+        """A user's books, optionally filtered by those fields (see books_query), newest updatedAt first"""
+
+    @abstractmethod
+    def update(self, book_id, update_doc):
+        """Apply {"$set": ..., "$inc": ...}; returns the summary fields from before the write, or None"""
+
+    @abstractmethod
+    def delete(self, book_id):
+        """Remove a book; returns its summary fields, or None"""
+
+    @abstractmethod
+    def summaries_for_user(self, user_id, ids):
+        """Summary fields of those of ids (ObjectIds) that user_id owns"""
+
+    @abstractmethod
+    def bulk(self, user_id, operations, ordered=True):
+        """
+        Apply ("update", ObjectId, fields) / ("delete", ObjectId, None)
+        operations to user_id's books in one round trip
+        Returns {position: error message} for operations that failed.
+        """
+
+
+class UserRepository(ABC):
+    """User profiles, keyed by Clerk user ID"""
+
+    def ensure_indexes(self):
+        pass
+
+    @abstractmethod
+    def get(self, clerk_user_id):
+        pass
+
+    @abstractmethod
+    def insert(self, user):
+        """Store a new user; raises DuplicateKeyError when the Clerk ID is taken"""
+
+
+# ==================== MONGODB ====================
+
+class MongoBookRepository(BookRepository):
+    def __init__(self, books_collection):
+        self.collection = books_collection
+
+    def ensure_indexes(self):
+        self.collection.create_index("userId")
+        self.collection.create_index([("userId", 1), ("createdAt", -1)])
+        self.backfill_previews()
+
+    def backfill_previews(self, batch_size=500):
+        """Store contentPreview on books saved before listings used it"""
+        requests = []
+        for book in self.collection.find({"contentPreview": {"$exists": False}}, {"content": 1}):
+            requests.append(UpdateOne({"_id": book["_id"], "contentPreview": {"$exists": False}},
+                                      {"$set": {"contentPreview": content_preview(book.get("content"))}}))
+            if len(requests) >= batch_size:
+                self.collection.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+    def insert(self, book):
+        return str(self.collection.insert_one(book).inserted_id)
+
+    def get(self, book_id, projection=None):
+        return self.collection.find_one({"_id": ObjectId(book_id)}, projection)
+
+    def list_for_user(self, user_id, **filters):
+        return self.collection.find(books_query(user_id, **filters), LIST_PROJECTION).sort("updatedAt", -1)
+
+    def update(self, book_id, update_doc):
+        return self.collection.find_one_and_update(
+            {"_id": ObjectId(book_id)},
+            update_doc,
+            projection=SUMMARY_PROJECTION
+        )
+
+    def delete(self, book_id):
+        return self.collection.find_one_and_delete(
+            {"_id": ObjectId(book_id)},
+            projection=SUMMARY_PROJECTION
+        )
+
+    def summaries_for_user(self, user_id, ids):
+        return list(self.collection.find({"_id": {"$in": list(ids)}, "userId": user_id},
+                                         SUMMARY_PROJECTION))
+
+    def bulk(self, user_id, operations, ordered=True):
+        requests = []
+        for op, _id, fields in operations:
+            if op == "delete":
+                requests.append(DeleteOne({"_id": _id, "userId": user_id}))
+            else:
+                requests.append(UpdateOne({"_id": _id, "userId": user_id}, {"$set": fields}))
+        failed = {}
+        if requests:
+            try:
+                self.collection.bulk_write(requests, ordered=ordered)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    failed[error["index"]] = error.get("errmsg", "Write failed")
+        return failed
+
+
+class MongoUserRepository(UserRepository):
+    def __init__(self, users_collection):
+        self.collection = users_collection
+
+    def ensure_indexes(self):
+        self.collection.create_index("clerkUserId", unique=True)
+
+    def get(self, clerk_user_id):
+        return self.collection.find_one({"clerkUserId": clerk_user_id})
+
+    def insert(self, user):
+        return str(self.collection.insert_one(user).inserted_id)
+
+
+# ==================== IN MEMORY ====================
+
+def _project(doc, projection):
+    """Copy of doc limited by a Mongo-style inclusion or exclusion projection"""
+    if not projection:
+        return dict(doc)
+    if any(projection.values()):
+        fields = [field for field, keep in projection.items() if keep]
+        if projection.get("_id", 1):
+            fields.append("_id")
+        return {field: doc[field] for field in fields if field in doc}
+    return {field: value for field, value in doc.items() if field not in projection}
+
+
+class MemoryBookRepository(BookRepository):
+    """Books in a dict, with a per-user index for listings"""
+
+    def __init__(self):
+        self.books = {}     # ObjectId -> document
+        self.by_user = {}   # userId -> set of ObjectIds
+        self.lock = threading.Lock()
+
+    def insert(self, book):
+        book.setdefault("_id", ObjectId())
+        with self.lock:
+            self.books[book["_id"]] = dict(book)
+            self.by_user.setdefault(book.get("userId"), set()).add(book["_id"])
+        return str(book["_id"])
+
+    def get(self, book_id, projection=None):
+        with self.lock:
+            book = self.books.get(ObjectId(book_id))
+            return _project(book, projection) if book else None
+
+    def list_for_user(self, user_id, **filters):
+        query = books_query(user_id, **filters)
+        with self.lock:
+            books = [self.books[_id] for _id in self.by_user.get(user_id, ())]
+            books = [_project(book, LIST_PROJECTION) for book in books
+                     if all(book.get(field) == value for field, value in query.items())]
+        # Mongo sorts missing values first, i.e. last in descending order
+        books.sort(key=lambda book: (book.get("updatedAt") is not None, book.get("updatedAt") or 0),
+                   reverse=True)
+        return books
+
+    def update(self, book_id, update_doc):
+        with self.lock:
+            book = self.books.get(ObjectId(book_id))
+            if book is None:
+                return None
+            before = _project(book, SUMMARY_PROJECTION)
+            self._apply(book, update_doc)
+            return before
+
+    @staticmethod
+    def _apply(book, update_doc):
+        book.update(update_doc.get("$set", {}))
+        for field, amount in update_doc.get("$inc", {}).items():
+            book[field] = book.get(field, 0) + amount
+
+    def delete(self, book_id):
+        with self.lock:
+            book = self.books.pop(ObjectId(book_id), None)
+            if book is None:
+                return None
+            self.by_user.get(book.get("userId"), set()).discard(book["_id"])
+            return _project(book, SUMMARY_PROJECTION)
+
+    def summaries_for_user(self, user_id, ids):
+        with self.lock:
+            return [_project(self.books[_id], SUMMARY_PROJECTION) for _id in ids
+                    if _id in self.books and self.books[_id].get("userId") == user_id]
+
+    def bulk(self, user_id, operations, ordered=True):
+        with self.lock:
+            for op, _id, fields in operations:
+                book = self.books.get(_id)
+                if book is None or book.get("userId") != user_id:
+                    continue    # like a filter that matches nothing: not an error
+                if op == "delete":
+                    del self.books[_id]
+                    self.by_user.get(user_id, set()).discard(_id)
+                else:
+                    book.update(fields)
+        return {}
+
+
+class MemoryUserRepository(UserRepository):
+    def __init__(self):
+        self.users = {}     # clerkUserId -> document
+        self.lock = threading.Lock()
+
+    def get(self, clerk_user_id):
+        with self.lock:
+            user = self.users.get(clerk_user_id)
+            return dict(user) if user else None
+
+    def insert(self, user):
+        user.setdefault("_id", ObjectId())
+        with self.lock:
+            if user["clerkUserId"] in self.users:
+                raise DuplicateKeyError(f"clerkUserId {user['clerkUserId']!r} already exists")
+            self.users[user["clerkUserId"]] = dict(user)
+        return str(user["_id"])
@@ -0,0 +1,249 @@
+"""
+Retrieval of earlier passages for predictions
+The prompt only carries the last CONTEXT_WORDS words of the manuscript.
+Each book is split into passages of about a paragraph, vectorized with
+hashed TF-IDF (no model, no vocabulary to store) and kept in memory; the
+recent context of a prediction is matched against them, and the best few
+passages that fit BUDGET_TOKENS go into the prompt, e.g. where a
+character or a place was introduced. Indexes are rebuilt in the
+background when a book's updatedAt changes, re-counting only passages
+whose text changed.
+"""
+
+import hashlib
+import math
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+from bson import ObjectId
+
+import exporters
+from personalization import COMMON_WORDS
+from tracing import logger
+
+BUDGET_TOKENS = int(os.getenv("RETRIEVAL_BUDGET_TOKENS", 120))   # 0 turns retrieval off
+REFRESH_SECONDS = float(os.getenv("RETRIEVAL_REFRESH_SECONDS", 60))
+CACHE_BOOKS = 200
+MAX_PASSAGES = 3
+PASSAGE_WORDS = 80      # paragraphs are merged or split to about this size
+QUERY_WORDS = 60        # trailing context words matched against the passages
+MIN_SCORE = 0.15        # cosine similarity a passage needs to be used
+MIN_PASSAGE_WORDS = 12  # don't add a passage trimmed below this
+TOKENS_PER_WORD = 1.35  # rough English average for the budget
+SHINGLE = 5             # passages sharing a 5-word run with the context are already in it
+HASH_BITS = 20
+
+WORD = re.compile(r"[a-z][a-z'’]*")
+POSSESSIVE = re.compile(r"['’]s?$")
+
+
+def terms(text):
+    """Hashed content words of a text (common words and short words dropped)"""
+    buckets = []
+    for word in WORD.findall(text.lower()):
+        word = POSSESSIVE.sub("", word)
+        if len(word) > 2 and word not in COMMON_WORDS:
+            buckets.append(zlib.crc32(word.encode()) & ((1 << HASH_BITS) - 1))
+    return buckets
+
+
+def paragraphs(content):
+    """Plain-text paragraphs of a book's HTML content"""
+    blocks = exporters.iter_blocks(exporters.iter_content(content or ""))
+    return [text for text in (block.text.strip() for block in blocks) if text]
+
+
+def split_passages(paras):
+    """Merge short paragraphs (dialogue) and split long ones into ~PASSAGE_WORDS chunks"""
+    passages = []
+    current = []
+    for para in paras:
+        words = para.split()
+        while len(words) > PASSAGE_WORDS * 3 // 2:
+            passages.append(" ".join(words[:PASSAGE_WORDS]))
+            words = words[PASSAGE_WORDS:]
+        if current and len(current) + len(words) > PASSAGE_WORDS:
+            passages.append(" ".join(current))
+            current = []
+        current += words
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+def _shingles(words):
+    words = [w.lower().strip(".,;:!?\"'“”‘’()") for w in words]
+    return {" ".join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)}
+
+
+def _weight(count, idf):
+    return (1 + math.log(count)) * idf
+
+
+class BookIndex:
+    """TF-IDF passage index of one book"""
+
+    __slots__ = ("user_id", "version", "passages", "counts", "postings", "idf")
+
+    def __init__(self, passages, counts, user_id=None, version=None):
+        self.user_id = user_id
+        self.version = version
+        self.passages = passages
+        self.counts = counts    # text hash -> Counter of term buckets, reused by rebuilds
+        df = Counter()
+        vectors = []
+        for text in passages:
+            tf = counts[_text_key(text)]
+            df.update(tf.keys())
+            vectors.append(tf)
+        n = len(passages)
+        # Words in nearly every passage (the narrator, the setting) score about zero
+        self.idf = {bucket: math.log((1 + n) / (1 + d)) for bucket, d in df.items()}
+        self.postings = {}  # bucket -> [(passage number, normalized weight)]
+        for i, tf in enumerate(vectors):
+            weights = {b: _weight(c, self.idf[b]) for b, c in tf.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for bucket, w in weights.items():
+                self.postings.setdefault(bucket, []).append((i, w / norm))
+
+    def search(self, text, budget_tokens=BUDGET_TOKENS, max_passages=MAX_PASSAGES):
+        """Passages most similar to the end of text, in book order, within the token budget"""
+        tail = text.split()[-QUERY_WORDS:]
+        # Later words count more: the sentence being written matters most
+        query = Counter()
+        for position, word in enumerate(tail):
+            for bucket in terms(word):
+                query[bucket] += 0.5 + 0.5 * (position + 1) / len(tail)
+        weights = {b: c * self.idf[b] for b, c in query.items() if b in self.idf}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        if not norm:
+            return []
+        scores = Counter()
+        for bucket, w in weights.items():
+            for i, pw in self.postings[bucket]:
+                scores[i] += w * pw / norm
+
+        recent = _shingles(tail)
+        budget_words = int(budget_tokens / TOKENS_PER_WORD)
+        chosen = []
+        for i, score in scores.most_common():
+            if score < MIN_SCORE or len(chosen) >= max_passages or budget_words < MIN_PASSAGE_WORDS:
+                break
+            passage = self.passages[i].split()
+            if _shingles(passage) & recent:
+                continue
+            if len(passage) > budget_words:
+                passage = passage[:budget_words] + ["…"]
+            budget_words -= len(passage)
+            chosen.append((i, " ".join(passage)))
+        return [passage for _, passage in sorted(chosen)]
+
+    def __len__(self):
+        return len(self.passages)
+
+
+def _text_key(text):
+    return hashlib.blake2b(text.encode(), digest_size=12).digest()
+
+
+def build_book_index(paras, previous=None, user_id=None, version=None):
+    """Index of a book's paragraphs, reusing term counts of passages previous already had"""
+    passages = split_passages(paras)
+    old = previous.counts if previous else {}
+    counts = {}
+    for text in passages:
+        key = _text_key(text)
+        if key not in counts:
+            counts[key] = old.get(key) or Counter(terms(text))
+    return BookIndex(passages, counts, user_id, version)
+
+
+# ==================== STORAGE / REFRESH ====================
+
+class PassageIndexer:
+    """
+    Keeps passage indexes of recently edited books in memory
+    get() never blocks on Mongo: a missing or stale index is queued for a
+    background rebuild, so the first predictions after opening a book go
+    without retrieval.
+    """
+
+    def __init__(self, books_collection, refresh_seconds=REFRESH_SECONDS):
+        self.books_collection = books_collection
+        self.refresh_seconds = refresh_seconds
+        self.cache = OrderedDict()  # book_id -> (BookIndex, checked_at)
+        self.stale = set()
+        self.queued = set()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._refresh_loop, name="passage-index", daemon=True).start()
+
+    def get(self, book_id, user_id):
+        """Cached index of a book owned by user_id (or None), scheduling a rebuild when due"""
+        if not book_id or not user_id or not ObjectId.is_valid(book_id):
+            return None
+        with self.lock:
+            entry = self.cache.get(book_id)
+            if entry:
+                self.cache.move_to_end(book_id)
+            due = (entry is None or book_id in self.stale
+                   or time.monotonic() - entry[1] >= self.refresh_seconds)
+            if due and book_id not in self.queued:
+                self.queued.add(book_id)
+                self.queue.put(book_id)
+        if entry and entry[0].user_id == user_id:
+            return entry[0]
+        return None
+
+    def invalidate(self, book_id):
+        """The book was saved; rebuild it on its next prediction"""
+        if book_id:
+            with self.lock:
+                self.stale.add(str(book_id))
+
+    def invalidate_all(self):
+        with self.lock:
+            self.stale.update(self.cache)
+
+    def _refresh_loop(self):
+        while True:
+            book_id = self.queue.get()
+            try:
+                self.refresh(book_id)
+            except Exception:
+                logger.exception("Error building passage index", extra={"fields": {"bookId": book_id}})
+            finally:
+                with self.lock:
+                    self.queued.discard(book_id)
+
+    def refresh(self, book_id):
+        """Rebuild the index if the book changed since it was built"""
+        with self.lock:
+            self.stale.discard(book_id)
+            entry = self.cache.get(book_id)
+        previous = entry[0] if entry else None
+        book = self.books_collection.find_one({"_id": ObjectId(book_id)}, {"updatedAt": 1, "userId": 1})
+        if not book:
+            with self.lock:
+                self.cache.pop(book_id, None)
+            return None
+        if previous is None or previous.version != book.get("updatedAt"):
+            book = self.books_collection.find_one({"_id": ObjectId(book_id)},
+                                                  {"content": 1, "updatedAt": 1, "userId": 1})
+            if not book:
+                return None
+            index = build_book_index(paragraphs(book.get("content", "")), previous,
+                                     book.get("userId"), book.get("updatedAt"))
+        else:
+            index = previous
+        with self.lock:
+            self.cache[book_id] = (index, time.monotonic())
+            self.cache.move_to_end(book_id)
+            while len(self.cache) > CACHE_BOOKS:
+                self.cache.popitem(last=False)
+        return index
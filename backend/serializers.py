@@ -0,0 +1,113 @@
+"""
+JSON encoding for API responses
+A Flask JSON provider backed by orjson (when installed) that encodes
+datetime and ObjectId natively, plus precompiled serializers that turn
+Mongo documents into response dicts in a single pass.
+"""
+
+from datetime import date, datetime
+
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - falls back to the stdlib encoder
+    orjson = None
+
+
+def _default(obj):
+    """Types orjson / json don't know about"""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider using orjson for both request parsing and responses"""
+
+    option = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # Skip the bytes -> str -> bytes round trip of the base implementation
+        return self._app.response_class(
+            orjson.dumps(obj, default=_default, option=self.option),
+            mimetype="application/json"
+        )
+
+
+class StdlibProvider(DefaultJSONProvider):
+    """Stdlib fallback that keeps ISO 8601 dates (Flask's default uses HTTP dates)"""
+
+    @staticmethod
+    def default(obj):
+        return _default(obj)
+
+
+def init_app(app):
+    """Install the fastest available JSON provider on the app"""
+    app.json = OrjsonProvider(app) if orjson else StdlibProvider(app)
+    return app.json
+
+
+# ==================== DOCUMENT SERIALIZERS ====================
+
+def compile_serializer(fields):
+    """
+    Build a serializer for Mongo documents
+    fields: (key, source, default) or (key, source, default, transform) tuples;
+    the resulting function always emits "id" from "_id" first.
+    Datetimes are left as-is for the JSON provider to encode.
+    """
+    plain = tuple((f[0], f[1], f[2]) for f in fields if len(f) == 3)
+    transformed = tuple(f for f in fields if len(f) == 4)
+
+    def serialize(doc):
+        get = doc.get
+        out = {"id": str(doc["_id"])}
+        for key, source, default in plain:
+            out[key] = get(source, default)
+        for key, source, default, transform in transformed:
+            value = get(source)
+            out[key] = transform(value) if value else default
+        return out
+
+    return serialize
+
+
+def content_preview(content, length=100):
+    return content[:length] + "..."
+
+
+_BOOK_COMMON = (
+    ("title", "title", ""),
+    ("description", "description", ""),
+    ("coverImage", "coverImage", ""),
+    ("genre", "genre", ""),
+    ("wordCount", "wordCount", 0),
+    ("status", "status", "draft"),
+    ("isFavorite", "isFavorite", False),
+    ("isArchived", "isArchived", False),
+    ("createdAt", "createdAt", None),
+    ("updatedAt", "updatedAt", None),
+)
+
+# Full book, as returned by GET /api/books/<id>
+serialize_book = compile_serializer(
+    (("userId", "userId", None), ("content", "content", "")) + _BOOK_COMMON
+)
+
+# Library listing entry with a short content preview; reads the stored
+# contentPreview (see repositories.LIST_PROJECTION), not the manuscript
+serialize_book_summary = compile_serializer(
+    _BOOK_COMMON + (("content", "contentPreview", "", content_preview),)
+)
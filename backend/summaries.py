@@ -0,0 +1,136 @@
+"""
+Materialized per-user library summaries
+Counts for the dashboard header (books, words, favorites, archived,
+per-genre and per-status) live in one document per user. The document
+is built once with an aggregation pipeline and then kept current with
+$inc deltas whenever a book is created, updated or deleted.
+"""
+
+from datetime import datetime, timezone
+
+# Book fields that feed the summary; pass as a projection when reading
+# the "before" state of a write
+SUMMARY_PROJECTION = {"userId": 1, "wordCount": 1, "isFavorite": 1,
+                      "isArchived": 1, "genre": 1, "status": 1}
+
+# Start of the content kept on each book as contentPreview, so listings
+# never have to read the manuscript
+PREVIEW_LENGTH = 100
+
+COUNTERS = ("totalBooks", "totalWords", "favorites", "archived")
+
+
+def _key(value, default):
+    """Make a genre/status usable as a field name"""
+    value = str(value or "").strip() or default
+    return value.replace(".", "_").replace("$", "_")
+
+
+def word_count(value):
+    """A client-sent wordCount as a non-negative int; anything unusable counts as 0"""
+    try:
+        return max(int(float(value)), 0)
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+def content_preview(content):
+    """The contentPreview stored alongside a book's content"""
+    return content[:PREVIEW_LENGTH] if isinstance(content, str) else ""
+
+
+def contribution(book):
+    """What one book adds to its owner's summary, as dotted counter paths"""
+    if not book:
+        return {}
+    return {
+        "totalBooks": 1,
+        "totalWords": word_count(book.get("wordCount")),
+        "favorites": 1 if book.get("isFavorite") else 0,
+        "archived": 1 if book.get("isArchived") else 0,
+        f"genres.{_key(book.get('genre'), 'unspecified')}": 1,
+        f"statuses.{_key(book.get('status'), 'draft')}": 1,
+    }
+
+
+class SummaryStore:
+    def __init__(self, books_collection, summaries_collection):
+        self.books_collection = books_collection
+        self.summaries_collection = summaries_collection
+        summaries_collection.create_index("userId", unique=True)
+
+    def record_change(self, before, after):
+        """
+        Apply the difference between a book's old and new state
+        before=None for inserts, after=None for deletes. Users whose
+        summary was never built are skipped; it is built on first read.
+        """
+        user_id = (after or before or {}).get("userId")
+        if not user_id:
+            return
+        inc = contribution(after)
+        for path, value in contribution(before).items():
+            inc[path] = inc.get(path, 0) - value
+        inc = {path: value for path, value in inc.items() if value}
+        if not inc:
+            return
+        self.summaries_collection.update_one(
+            {"userId": user_id},
+            {"$inc": inc, "$set": {"updatedAt": datetime.now(timezone.utc)}}
+        )
+
+    def get(self, user_id):
+        """One indexed read; falls back to building the summary"""
+        summary = self.summaries_collection.find_one({"userId": user_id}, {"_id": 0})
+        return summary or self.rebuild(user_id)
+
+    def rebuild(self, user_id):
+        """Recompute a user's summary from books_collection and store it"""
+        result = next(self.books_collection.aggregate([
+            {"$match": {"userId": user_id}},
+            {"$facet": {
+                "totals": [{"$group": {
+                    "_id": None,
+                    "totalBooks": {"$sum": 1},
+                    "totalWords": {"$sum": {"$ifNull": ["$wordCount", 0]}},
+                    "favorites": {"$sum": {"$cond": [{"$eq": ["$isFavorite", True]}, 1, 0]}},
+                    "archived": {"$sum": {"$cond": [{"$eq": ["$isArchived", True]}, 1, 0]}},
+                }}],
+                # $sum skips strings, which contribution() counts: add them below
+                "textWordCounts": [{"$match": {"wordCount": {"$type": "string"}}},
+                                   {"$project": {"_id": 0, "wordCount": 1}}],
+                "genres": [{"$group": {"_id": "$genre", "count": {"$sum": 1}}}],
+                "statuses": [{"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+            }},
+        ]), {})
+
+        totals = (result.get("totals") or [{}])[0]
+        summary = {counter: totals.get(counter, 0) for counter in COUNTERS}
+        summary["totalWords"] += sum(word_count(row["wordCount"]) for row in result.get("textWordCounts", []))
+        summary["genres"] = {}
+        for row in result.get("genres", []):
+            key = _key(row["_id"], "unspecified")
+            summary["genres"][key] = summary["genres"].get(key, 0) + row["count"]
+        summary["statuses"] = {}
+        for row in result.get("statuses", []):
+            key = _key(row["_id"], "draft")
+            summary["statuses"][key] = summary["statuses"].get(key, 0) + row["count"]
+        summary["userId"] = user_id
+        summary["updatedAt"] = datetime.now(timezone.utc)
+
+        self.summaries_collection.replace_one({"userId": user_id}, summary, upsert=True)
+        return summary
+
+
+def format_summary(summary):
+    """Response shape for GET /api/users/<id>/summary (drops emptied buckets)"""
+    return {
+        "totalBooks": summary.get("totalBooks", 0),
+        "activeBooks": summary.get("totalBooks", 0) - summary.get("archived", 0),
+        "totalWords": summary.get("totalWords", 0),
+        "favorites": summary.get("favorites", 0),
+        "archived": summary.get("archived", 0),
+        "genres": {k: v for k, v in summary.get("genres", {}).items() if v > 0},
+        "statuses": {k: v for k, v in summary.get("statuses", {}).items() if v > 0},
+        "updatedAt": summary.get("updatedAt"),
+    }
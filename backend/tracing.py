@@ -0,0 +1,330 @@
+"""
+Request tracing for the Flask backend
+Gives every request a trace ID, times nested spans (handler phases,
+MongoDB commands, Cohere calls) and writes them as structured JSON logs.
+Spans can optionally be exported to a local OpenTelemetry collector.
+"""
+
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from pymongo import monitoring
+
+# Collector endpoint, e.g. http://localhost:4318 (OTLP over HTTP/JSON)
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "").rstrip("/")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "typen-backend")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Current trace ID and innermost open span for this request/thread
+_trace_id = ContextVar("trace_id", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """Render log records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        trace_id = _trace_id.get()
+        if trace_id:
+            entry["traceId"] = trace_id
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+logger = logging.getLogger("typen")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(JsonFormatter())
+    logger.addHandler(_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def new_id(nbytes=8):
+    """Random hex ID (16 chars for spans, 32 for traces as in W3C/OTel)"""
+    return os.urandom(nbytes).hex()
+
+
+def current_trace_id():
+    """Trace ID of the active request, if any"""
+    return _trace_id.get()
+
+
+class Span:
+    """A single timed operation inside a trace"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes",
+                 "start_ns", "end_ns", "error")
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    @property
+    def duration_ms(self):
+        end = self.end_ns or time.time_ns()
+        return (end - self.start_ns) / 1_000_000
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        _emit(self)
+
+    def to_log(self):
+        entry = {
+            "span": self.name,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "durationMs": round(self.duration_ms, 3),
+        }
+        if self.attributes:
+            entry["attributes"] = self.attributes
+        if self.error:
+            entry["error"] = self.error
+        return entry
+
+
+def start_trace(trace_id=None):
+    """Begin a new trace for the current context and return its ID"""
+    trace_id = trace_id or uuid.uuid4().hex
+    _trace_id.set(trace_id)
+    _current_span.set(None)
+    return trace_id
+
+
+def end_trace():
+    _trace_id.set(None)
+    _current_span.set(None)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a block of code as a child of the current span
+    Usage: with span("cohere.chat", model=model): ...
+    """
+    parent = _current_span.get()
+    trace_id = _trace_id.get() or start_trace()
+    s = Span(name, trace_id, parent.span_id if parent else None, attributes)
+    token = _current_span.set(s)
+    error = None
+    try:
+        yield s
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _current_span.reset(token)
+        s.finish(error=error)
+
+
+def _emit(s):
+    logger.info("span", extra={"fields": s.to_log()})
+    if _exporter:
+        _exporter.submit(s)
+
+
+# ==================== MONGODB INSTRUMENTATION ====================
+
+class MongoSpanListener(monitoring.CommandListener):
+    """
+    Turns every MongoDB command into a span under the current request
+    Pass an instance to MongoClient(event_listeners=[...])
+    """
+
+    def __init__(self):
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        trace_id = _trace_id.get()
+        if not trace_id:
+            return
+        parent = _current_span.get()
+        collection = event.command.get(event.command_name)
+        s = Span(
+            f"mongo.{event.command_name}",
+            trace_id,
+            parent.span_id if parent else None,
+            {"db": event.database_name,
+             "collection": collection if isinstance(collection, str) else None},
+        )
+        with self._lock:
+            self._open[(event.request_id, event.operation_id)] = s
+
+    def _finish(self, event, error=None):
+        with self._lock:
+            s = self._open.pop((event.request_id, event.operation_id), None)
+        if s:
+            s.finish(error=error)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event, error=RuntimeError(str(event.failure)))
+
+
+# ==================== OTLP EXPORTER ====================
+
+class OtlpExporter:
+    """
+    Ships finished spans to an OTLP/HTTP collector in small batches
+    Runs on a daemon thread so requests never wait on the collector
+    """
+
+    def __init__(self, endpoint, batch_size=64, interval=2.0, max_queue=4096):
+        self.url = f"{endpoint}/v1/traces"
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        threading.Thread(target=self._run, name="otlp-exporter", daemon=True).start()
+
+    def submit(self, s):
+        try:
+            self.queue.put_nowait(s)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": SERVICE_NAME}}
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "typen.tracing"},
+                    "spans": [_otlp_span(s) for s in batch],
+                }],
+            }]
+        }
+        req = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload, default=str).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            urllib.request.urlopen(req, timeout=5).close()
+        except Exception as e:
+            # Never let the collector take the API down; just note it
+            self.dropped += len(batch)
+            print(f"OTLP export failed: {e}", file=sys.stderr)
+
+
+def _otlp_span(s):
+    span_dict = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": 1,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": [
+            {"key": k, "value": {"stringValue": str(v)}}
+            for k, v in s.attributes.items()
+        ],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+    if s.parent_id:
+        span_dict["parentSpanId"] = s.parent_id
+    return span_dict
+
+
+_exporter = OtlpExporter(OTLP_ENDPOINT) if OTLP_ENDPOINT else None
+
+
+# ==================== FLASK INTEGRATION ====================
+
+# OTLP trace IDs are 16 bytes of lowercase hex, and not all zeros
+TRACE_ID = re.compile(r"(?!0{32})[0-9a-f]{32}")
+
+
+def _incoming_trace_id(headers):
+    """Reuse the caller's W3C traceparent or X-Request-ID when it is a valid trace ID"""
+    parts = headers.get("traceparent", "").split("-")
+    if len(parts) == 4 and TRACE_ID.fullmatch(parts[1]):
+        return parts[1]
+    request_id = headers.get("X-Request-ID", "")
+    if TRACE_ID.fullmatch(request_id):
+        return request_id
+    return None
+
+
+def init_app(app):
+    """Open a root span per request and return the trace ID in X-Trace-Id"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_span():
+        trace_id = start_trace(_incoming_trace_id(request.headers))
+        root = Span("http.request", trace_id, attributes={
+            "method": request.method,
+            "route": request.url_rule.rule if request.url_rule else request.path,
+        })
+        if request.headers.get("X-Request-ID"):
+            # Kept for correlation even when it isn't usable as the trace ID
+            root.set("requestId", request.headers["X-Request-ID"][:128])
+        _current_span.set(root)
+        g.trace_span = root
+
+    @app.after_request
+    def _tag_response(response):
+        root = g.get("trace_span")
+        if root:
+            root.set("status", response.status_code)
+            response.headers["X-Trace-Id"] = root.trace_id
+        return response
+
+    @app.teardown_request
+    def _finish_request_span(exc):
+        root = g.pop("trace_span", None)
+        if root:
+            root.finish(error=exc)
+        end_trace()
@@ -0,0 +1,282 @@
+"""
+Warm predictions for common short contexts
+Many requests end in a context every writer types: the first words of a
+book or chapter, the start of a paragraph, a dialogue tag after a
+closing quote. Those contexts are reduced to a short key (context_key)
+and looked up in a per-genre table built offline, before any provider
+is called. The table is loaded once at startup into read-only dicts of
+interned word tuples, so a hit costs a dict lookup and no tokens.
+
+    python warmcache.py --corpus benchmarks/eval_corpus.json --log app.log -o warm_predictions.json
+
+Keys come from the corpus and from /api/predict's request log (every
+request ending in a short context logs a predict.warm span carrying only
+the key and genre); the most frequent ones per genre are predicted once
+with the configured providers, with the words the corpus actually
+continues them with first.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from types import MappingProxyType
+
+from tracing import logger
+
+TABLE_PATH = os.getenv("WARM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       "warm_predictions.json"))
+MAX_WORDS = 3           # longest context (after its boundary) that gets a key
+ALL_GENRES = "*"        # entries built from every genre, used when a genre has none
+FORMAT_VERSION = 1
+
+WORD = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+LINE_BREAK = re.compile(r"\s*\n\s*")
+HEADING = re.compile(r"(chapter|part|book|prologue|epilogue|interlude)\b|[ivxlc\d]+\.?$", re.IGNORECASE)
+CLOSING_QUOTE = "”"
+
+# Boundary markers a key starts with
+START = "^"         # beginning of the text
+CHAPTER = "#"       # first line after a chapter heading
+PARAGRAPH = "¶"     # first line after any other paragraph
+DIALOGUE = '"'      # after a closing quotation mark
+
+
+def _words(text):
+    return [w.lower() for w in WORD.findall(text.replace("’", "'"))]
+
+
+def _closing_quote(line):
+    """Position just after the last closing quotation mark in line, or None"""
+    curly = line.rfind(CLOSING_QUOTE)
+    straight = line.rfind('"')
+    # A straight quote closes when it is the 2nd, 4th... in the line
+    if straight > curly and line.count('"') % 2 == 0:
+        return straight + 1
+    return curly + 1 if curly >= 0 else None
+
+
+def context_key(text):
+    """Key of the short context text ends in, or None when it ends mid-paragraph"""
+    lines = LINE_BREAK.split(text.strip())
+    last = lines[-1]
+    quote = _closing_quote(last)
+    if quote is not None:
+        words = _words(last[quote:])
+        if len(words) <= MAX_WORDS:
+            return " ".join([DIALOGUE] + words)
+        return None
+    words = _words(last)
+    if len(words) > MAX_WORDS or (not words and len(lines) > 1):
+        return None
+    if len(lines) == 1:
+        marker = START
+    elif HEADING.match(lines[-2]) and len(lines[-2].split()) <= 6:
+        marker = CHAPTER
+    else:
+        marker = PARAGRAPH
+    return " ".join([marker] + words)
+
+
+def _genre(genre):
+    return (genre or "").strip().lower()
+
+
+class WarmTable:
+    """Read-only genre -> context key -> 8 words table"""
+
+    def __init__(self, genres=None, built_at=None):
+        self.genres = MappingProxyType({
+            _genre(genre): MappingProxyType({
+                key: tuple(sys.intern(w) for w in words) for key, words in entries.items()
+            })
+            for genre, entries in (genres or {}).items()
+        })
+        self.built_at = built_at
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=TABLE_PATH):
+        """Table from a file written by this module's CLI (empty when there is none)"""
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        if data.get("version") != FORMAT_VERSION:
+            logger.warning("Ignoring warm prediction table", extra={"fields": {
+                "path": path, "version": data.get("version")}})
+            return cls()
+        return cls(data.get("genres"), data.get("builtAt"))
+
+    def lookup(self, genre, text):
+        """(key, words) for text; words is None on a miss, key is None when text has no short context"""
+        key = context_key(text)
+        with self.lock:
+            self.stats["lookups"] += 1
+        if key is None:
+            return None, None
+        for table in (self.genres.get(_genre(genre)), self.genres.get(ALL_GENRES)):
+            if table and key in table:
+                with self.lock:
+                    self.stats["hits"] += 1
+                return key, list(table[key])
+        with self.lock:
+            self.stats["misses"] += 1
+        return key, None
+
+    def __len__(self):
+        return sum(len(table) for table in self.genres.values())
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = stats.get("lookups", 0)
+        return {
+            "entries": len(self),
+            "genres": len(self.genres),
+            "builtAt": self.built_at,
+            "lookups": lookups,
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),   # short contexts the table doesn't have
+            "hitRatio": round(stats.get("hits", 0) / lookups, 4) if lookups else None,
+        }
+
+
+# ==================== BUILDING ====================
+
+def corpus_contexts(text):
+    """(key, example context, next word) for every keyed position of a text"""
+    lines = LINE_BREAK.split(text.strip())
+    for n, line in enumerate(lines):
+        previous = lines[n - 1] + "\n" if n else ""
+        words = list(WORD.finditer(line.replace("’", "'")))
+        # The first words of the line, and the first words after every closing quote
+        starts = {0} | {m.end() for m in re.finditer(f'["{CLOSING_QUOTE}]', line)}
+        candidates = set()
+        for start in starts:
+            following = [m for m in words if m.start() >= start][:MAX_WORDS + 1]
+            candidates.update(following)
+        for match in sorted(candidates, key=lambda m: m.start()):
+            context = previous + line[:match.start()]
+            key = context_key(context)
+            if key is not None:
+                yield key, context[-300:], match.group().lower()
+
+
+def example_context(key):
+    """A text that ends in the context of a key, for keys only seen in the log"""
+    marker, _, words = key.partition(" ")
+    if marker == CHAPTER:
+        return "Chapter One\n" + words.capitalize()
+    if marker == DIALOGUE:
+        return '"I know," ' + words
+    return words.capitalize()
+
+
+def read_log(path):
+    """Context key counts per genre from predict.warm spans in a JSON log"""
+    counts = defaultdict(Counter)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if '"predict.warm"' not in line:
+                continue
+            try:
+                attributes = json.loads(line).get("attributes") or {}
+            except ValueError:
+                continue
+            if attributes.get("key"):
+                counts[_genre(attributes.get("genre"))][attributes["key"]] += 1
+    return counts
+
+
+def build_table(engine, corpus, log_counts, per_genre, min_count):
+    """genre -> key -> 8 words for the most frequent keys of every genre and of all of them"""
+    import prediction_parser
+    import providers
+
+    counts = defaultdict(Counter)       # genre -> key -> occurrences
+    followers = defaultdict(Counter)    # (genre, key) -> next word -> count
+    examples = {}
+    for doc in corpus:
+        genre = _genre(doc.get("genre")) or "fiction"
+        for key, context, word in corpus_contexts(doc["text"]):
+            for g in (genre, ALL_GENRES):
+                counts[g][key] += 1
+                followers[(g, key)][word] += 1
+                examples.setdefault((g, key), context)
+    for genre, keys in log_counts.items():
+        for key, count in keys.items():
+            counts[genre][key] += count
+            counts[ALL_GENRES][key] += count
+
+    genres = {}
+    for genre, keys in counts.items():
+        entries = {}
+        for key, count in keys.most_common(per_genre):
+            if count < min_count:
+                break
+            context = examples.get((genre, key)) or example_context(key)
+            query = providers.build_query(context, "fiction" if genre == ALL_GENRES else genre)
+            try:
+                words, _ = engine.predict(query)
+            except providers.ProviderError as e:
+                print(f"⚠️  {genre} / {key!r}: {e}")
+                continue
+            words = providers.fill_words(words, query)
+            # What the corpus actually continues this context with leads the probable slots
+            seen = [w for w, c in followers[(genre, key)].most_common(5) if c >= min_count]
+            probable = list(dict.fromkeys(seen + words[:5] + words[5:]))[:5]
+            creative = [w for w in words[5:] if w not in probable]
+            creative += [w for w in words if w not in probable and w not in creative]
+            entries[key] = prediction_parser.parse(", ".join(probable + creative[:3]), context).words
+        if entries:
+            genres[genre] = entries
+    return genres
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the warm prediction table")
+    parser.add_argument("--corpus", action="append", default=[], help="JSON list of {genre, text}")
+    parser.add_argument("--log", action="append", default=[], help="JSON log of the backend (predict.warm spans)")
+    parser.add_argument("--providers", default=os.getenv("PREDICT_PROVIDERS", "cohere,local"))
+    parser.add_argument("--fallbacks", default=os.getenv("PREDICT_FALLBACKS", "ngram"))
+    parser.add_argument("--per-genre", type=int, default=300, help="Keys kept per genre")
+    parser.add_argument("--min-count", type=int, default=2, help="Occurrences a key needs")
+    parser.add_argument("-o", "--output", default=TABLE_PATH)
+    args = parser.parse_args()
+
+    import providers
+
+    corpus = []
+    for path in args.corpus:
+        with open(path, encoding="utf-8") as f:
+            corpus += json.load(f)
+    log_counts = defaultdict(Counter)
+    for path in args.log:
+        for genre, keys in read_log(path).items():
+            log_counts[genre].update(keys)
+
+    engine = providers.build_engine(os.getenv("COHERE_API_KEY"), providers=args.providers,
+                                    fallbacks=args.fallbacks)
+    if not engine.available():
+        sys.exit(f"❌ None of the providers '{args.providers}' is configured")
+
+    genres = build_table(engine, corpus, log_counts, args.per_genre, args.min_count)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": FORMAT_VERSION,
+            "builtAt": datetime.now(timezone.utc).isoformat(),
+            "maxWords": MAX_WORDS,
+            "genres": genres,
+        }, f, ensure_ascii=False, separators=(",", ":"))
+    print(f"💾 {sum(len(e) for e in genres.values())} warm contexts in {len(genres)} genres saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -208,6 +208,7 @@ const Dashboard = () => {
     // State for books from database
     const [books, setBooks] = useState([]);
     const [isLoadingBooks, setIsLoadingBooks] = useState(true);
+    const syncTokenRef = useRef(null); // from the last listing, for incremental sync
 
     // State for new document modal
     const [isModalOpen, setIsModalOpen] = useState(false);
@@ -253,11 +254,11 @@ const Dashboard = () => {
         }
     }, [user?.id, activeTab]);
 
-    // Refetch books when page becomes visible (returning from editor)
+    // Sync changed books when page becomes visible (returning from editor)
     useEffect(() => {
         const handleVisibilityChange = () => {
             if (document.visibilityState === 'visible' && user?.id) {
-                fetchBooks();
+                syncBooks();
             }
         };
 
@@ -267,23 +268,31 @@ const Dashboard = () => {
         };
     }, [user?.id, activeTab]);
 
+    // Listing filters for the active tab
+    const getListQuery = () => {
+        if (activeTab === 'favorites') return 'archived=false&favorite=true';
+        if (activeTab === 'archive') return 'archived=true';
+        return 'archived=false';
+    };
+
+    // Client-side version of the active tab's filters, for synced changes
+    const matchesTab = (book) => {
+        if (activeTab === 'favorites') return !book.isArchived && book.isFavorite;
+        if (activeTab === 'archive') return book.isArchived;
+        return !book.isArchived;
+    };
+
     const fetchBooks = async () => {
         try {
             setIsLoadingBooks(true);
-            let url = `${API_URL}/api/books/user/${user.id}?archived=false`;
-            
-            // Apply tab filters
-            if (activeTab === 'favorites') {
-                url += '&favorite=true';
-            } else if (activeTab === 'archive') {
-                url = `${API_URL}/api/books/user/${user.id}?archived=true`;
-            }
+            const url = `${API_URL}/api/books/user/${user.id}?${getListQuery()}`;
             
             const response = await fetch(url);
             const data = await response.json();
             
             if (data.status === 'success') {
                 setBooks(data.books);
+                syncTokenRef.current = data.syncToken;
             } else {
                 console.error('Failed to fetch books:', data.message);
             }
@@ -294,6 +303,39 @@ const Dashboard = () => {
         }
     };
 
+    // Merge only what changed since the last listing; reload if the server asks to
+    const syncBooks = async () => {
+        if (!syncTokenRef.current) {
+            fetchBooks();
+            return;
+        }
+        try {
+            const params = new URLSearchParams({ userId: user.id, since: syncTokenRef.current });
+            const response = await fetch(`${API_URL}/api/books/changes?${params}`);
+            const data = await response.json();
+
+            if (data.status !== 'success' || data.reset) {
+                fetchBooks();
+                return;
+            }
+
+            syncTokenRef.current = data.syncToken;
+            if (!data.books.length && !data.deleted.length) return;
+
+            setBooks((prev) => {
+                const byId = new Map(prev.map((book) => [book.id, book]));
+                data.deleted.forEach((id) => byId.delete(id));
+                data.books.forEach((book) => {
+                    if (matchesTab(book)) byId.set(book.id, book);
+                    else byId.delete(book.id);
+                });
+                return [...byId.values()].sort((a, b) => (b.updatedAt || '').localeCompare(a.updatedAt || ''));
+            });
+        } catch (error) {
+            console.error('Error syncing books:', error);
+        }
+    };
+
     // Handle sign out
     const handleSignOut = async () => {
         showLoader('Signing out...');
@@ -383,27 +425,39 @@ const Dashboard = () => {
         setIsModalOpen(true);
     };
 
+    // Apply book operations and get the refreshed list in one round trip
+    const runBulk = async (operations) => {
+        const response = await fetch(`${API_URL}/api/books/bulk?${getListQuery()}`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                userId: user.id,
+                operations,
+            }),
+        });
+
+        const data = await response.json();
+
+        if (data.status === 'success') {
+            setBooks(data.books);
+            syncTokenRef.current = data.syncToken;
+        }
+        return data;
+    };
+
     // Handle toggle favorite
     const handleToggleFavorite = async (book, e) => {
         e.stopPropagation();
         setOpenMenuId(null);
         
         try {
-            const response = await fetch(`${API_URL}/api/books/${book.id}`, {
-                method: 'PUT',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    isFavorite: !book.isFavorite
-                }),
-            });
+            const data = await runBulk([
+                { op: 'update', id: book.id, fields: { isFavorite: !book.isFavorite } }
+            ]);
 
-            const data = await response.json();
-
-            if (data.status === 'success') {
-                fetchBooks(); // Refresh the list
-            } else {
+            if (data.status !== 'success' || data.errors > 0) {
                 alert('Failed to update favorite status');
             }
         } catch (error) {
@@ -422,16 +476,12 @@ const Dashboard = () => {
         }
 
         try {
-            const response = await fetch(`${API_URL}/api/books/${bookId}`, {
-                method: 'DELETE',
-            });
+            const data = await runBulk([{ op: 'delete', id: bookId }]);
 
-            const data = await response.json();
-
-            if (data.status === 'success') {
-                fetchBooks(); // Refresh the list
-            } else {
+            if (data.status !== 'success') {
                 alert('Failed to delete book: ' + data.message);
+            } else if (data.errors > 0) {
+                alert('Failed to delete book: ' + data.results[0].message);
             }
         } catch (error) {
             console.error('Error deleting book:', error);
@@ -115,7 +115,7 @@ const WordPredictionPanel = ({
                             {!isLoading && probablePredictions.map((prediction) => (
                                 <button
                                     key={prediction.id}
-                                    onClick={() => onWordClick(prediction.word)}
+                                    onClick={() => onWordClick(prediction.word, prediction)}
                                     className="word-card"
                                 >
                                     <div className="word-card-inner">
@@ -142,7 +142,7 @@ const WordPredictionPanel = ({
                                 {creativePredictions.map((prediction) => (
                                     <button
                                         key={prediction.id}
-                                        onClick={() => onWordClick(prediction.word)}
+                                        onClick={() => onWordClick(prediction.word, prediction)}
                                         className="word-card creative-card"
                                     >
                                         <div className="word-card-inner">
@@ -1236,6 +1236,20 @@ const Editor = () => {
     
     // Prediction debounce timer
     const predictionTimerRef = useRef(null);
+    // Debounce delay recommended by the server, and when a 429 lets us retry
+    const predictionIntervalRef = useRef(500);
+    const predictionBlockedUntilRef = useRef(0);
+
+    // Suggestion analytics: batched and sent every few seconds, never per keystroke
+    const sessionIdRef = useRef(
+        window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`
+    );
+    const eventsRef = useRef([]);
+    const eventsIntervalRef = useRef(15000);
+    const lastWordCountRef = useRef(null);
+    const wordsWrittenRef = useRef(0);
+    const predictionProviderRef = useRef(null);
+    const flushEventsRef = useRef(null);
 
     // Redirect to login if not authenticated
     useEffect(() => {
@@ -1272,6 +1286,27 @@ const Editor = () => {
         };
     }, [content]);
 
+    // Send analytics events periodically, and with sendBeacon when the tab is hidden or closed
+    useEffect(() => {
+        let timer;
+        const schedule = () => {
+            timer = setTimeout(() => {
+                flushEventsRef.current?.();
+                schedule();
+            }, eventsIntervalRef.current);
+        };
+        const onHidden = () => {
+            if (document.visibilityState === 'hidden') flushEventsRef.current?.(true);
+        };
+        schedule();
+        document.addEventListener('visibilitychange', onHidden);
+        return () => {
+            clearTimeout(timer);
+            document.removeEventListener('visibilitychange', onHidden);
+            flushEventsRef.current?.(true);
+        };
+    }, []);
+
     // Cleanup prediction timer on unmount
     useEffect(() => {
         return () => {
@@ -1332,8 +1367,49 @@ const Editor = () => {
 
     setWordCount(words);
     setCharCount(chars);
+
+    // Words added since the last count, reported as writing activity (the initial load doesn't count)
+    if (lastWordCountRef.current !== null && words > lastWordCountRef.current) {
+        wordsWrittenRef.current += words - lastWordCountRef.current;
+    }
+    lastWordCountRef.current = words;
 };
 
+    const trackEvent = (type, fields = {}) => {
+        eventsRef.current.push({ type, ...fields });
+    };
+
+    const flushEvents = (useBeacon = false) => {
+        if (wordsWrittenRef.current > 0) {
+            trackEvent('write', { words: wordsWrittenRef.current });
+            wordsWrittenRef.current = 0;
+        }
+        const events = eventsRef.current;
+        if (!events.length) return;
+        eventsRef.current = [];
+
+        const body = JSON.stringify({ sessionId: sessionIdRef.current, userId: user?.id, bookId, events });
+        if (useBeacon && navigator.sendBeacon) {
+            navigator.sendBeacon(`${API_URL}/api/events`, body);
+            return;
+        }
+        fetch(`${API_URL}/api/events`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body,
+            keepalive: true,
+        })
+            .then((response) => response.json())
+            .then((data) => {
+                // Server is backed up: send less often until it recovers
+                eventsIntervalRef.current = data.retryAfter
+                    ? Math.max(15000, data.retryAfter * 1000)
+                    : 15000;
+            })
+            .catch(() => {});
+    };
+    flushEventsRef.current = flushEvents;
+
     // Fetch predictions from Cohere API
     const fetchPredictions = async (text) => {
         if (!text.trim()) {
@@ -1350,14 +1426,24 @@ const Editor = () => {
                 },
                 body: JSON.stringify({ 
                     text,
-                    genre: book?.genre || 'fiction'
+                    genre: book?.genre || 'fiction',
+                    userId: user?.id,
+                    bookId
                 }),
             });
 
             const data = await response.json();
 
-            if (data.status === 'success') {
+            if (data.recommendedIntervalMs) {
+                predictionIntervalRef.current = data.recommendedIntervalMs;
+            }
+            if (response.status === 429) {
+                const retryAfter = Number(response.headers.get('Retry-After')) || 1;
+                predictionBlockedUntilRef.current = Date.now() + retryAfter * 1000;
+            } else if (data.status === 'success') {
                 setPredictions(data.predictions);
+                predictionProviderRef.current = data.provider;
+                trackEvent('impression', { provider: data.provider });
             }
         } catch (error) {
             console.error('Error fetching predictions:', error);
@@ -1375,18 +1461,31 @@ const Editor = () => {
             // Get plain text for predictions
             const plainText = editorRef.current.innerText.trim();
             
-            // Debounce prediction API calls (500ms delay)
+            // Debounce prediction API calls by the server's recommended interval
+            // (and until Retry-After has passed when we were rate limited)
             if (predictionTimerRef.current) {
                 clearTimeout(predictionTimerRef.current);
             }
+            const delay = Math.max(
+                predictionIntervalRef.current,
+                predictionBlockedUntilRef.current - Date.now()
+            );
             predictionTimerRef.current = setTimeout(() => {
                 fetchPredictions(plainText);
-            }, 500);
+            }, delay);
         }
     };
 
-    const insertWordAtCursor = (word) => {
+    const insertWordAtCursor = (word, prediction) => {
         if (!editorRef.current) return;
+
+        if (prediction) {
+            trackEvent('accept', {
+                rank: prediction.rank,
+                provider: predictionProviderRef.current,
+                personal: prediction.personal === true,
+            });
+        }
         
         editorRef.current.focus();
         
@@ -1417,7 +1516,9 @@ const Editor = () => {
             if (!isAutoSave) setIsSaving(true);
             if (isAutoSave) setAutoSaveStatus('saving');
 
-            const response = await fetch(`${API_URL}/api/books/${bookId}`, {
+            // Autosaves are buffered server-side and written behind
+            const saveUrl = `${API_URL}/api/books/${bookId}${isAutoSave ? '?autosave=true' : ''}`;
+            const response = await fetch(saveUrl, {
                 method: 'PUT',
                 headers: {
                     'Content-Type': 'application/json',